@@ -0,0 +1,133 @@
+"""
+Helpers shared by the benchmarks for building the pipelines under test and writing reports
+which can be compared between hardware and releases.
+"""
+
+import datetime
+import json
+import os
+import platform
+
+import gi
+
+from picam import encoders, sysfs
+
+gi.require_version('Gst', '1.0')
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from gi.repository import Gst
+
+Gst.init(None)
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what the camera would have done before handing the stream to the rtsp server, the device
+# encodings get the same treatment from a software encoder standing in for the camera
+CAMERA_ENCODERS = {
+    'mjpeg': (
+        'jpegenc quality=85 ! image/jpeg,width={width},height={height},framerate={framerate}'
+    ),
+    'h264': (
+        'videoconvert ! x264enc tune=zerolatency speed-preset=ultrafast key-int-max=60 bitrate=5000 '
+        '! video/x-h264,profile=main'
+    ),
+}
+
+
+def element_available(encoding):
+    """software and hardware encoders the board doesn't have are skipped"""
+    required = {
+        'mjpeg': ('jpegenc', 'jpegparse', 'rtpjpegpay'),
+        'h264': ('x264enc', 'h264parse', 'rtph264pay'),
+        'jpegenc': ('jpegenc', 'rtpjpegpay'),
+        'x264enc': ('x264enc', 'h264parse', 'rtph264pay'),
+        'vp8enc': ('vp8enc', 'rtpvp8pay'),
+        'v4l2h264enc': ('v4l2h264enc', 'h264parse', 'rtph264pay'),
+    }
+    return all(Gst.ElementFactory.find(name) for name in required.get(encoding, ()))
+
+
+def framerate_caps(framerate):
+    """'30' -> '30/1', 59.94 becomes the same fraction rtsp_server.py streams it at"""
+    if framerate in ('59.94', '59.940'):
+        return '7013/117'
+    return framerate if '/' in framerate else '{}/1'.format(framerate)
+
+
+def build_encoding_pipeline(
+    source,
+    encoding,
+    width,
+    height,
+    framerate,
+    overrides=None,
+    raw_format='I420',
+):
+    """
+    Puts the encoding's pipeline from the encoder registry, the same one rtsp_server.py uses,
+    behind a raw source in place of v4l2src.
+    """
+    raw_caps = 'video/x-raw,format={},width={},height={},framerate={}'.format(
+        raw_format,
+        width,
+        height,
+        framerate,
+    )
+    video_format = encoders.build_pipeline(encoding, width, height, framerate, overrides)
+    if encoding in CAMERA_ENCODERS:
+        camera = CAMERA_ENCODERS[encoding].format(width=width, height=height, framerate=framerate)
+        return '{} ! {} ! {} ! {}'.format(source, raw_caps, camera, video_format)
+    return '{} ! {} ! {}'.format(source, raw_caps, video_format)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def summarize(values, digits=2):
+    """min, max, mean and the percentiles of a list of measurements"""
+    if not values:
+        return None
+    return {
+        'min': round(min(values), digits),
+        'p50': round(percentile(values, 50), digits),
+        'p95': round(percentile(values, 95), digits),
+        'p99': round(percentile(values, 99), digits),
+        'max': round(max(values), digits),
+        'mean': round(sum(values) / len(values), digits),
+    }
+
+
+def host_info():
+    try:
+        with open(os.path.join(SRC_DIR, 'version.txt'), 'r', encoding='UTF-8') as version:
+            picam_version = version.read().strip()
+    except OSError:
+        picam_version = 'unknown'
+    return {
+        'hostname': platform.node(),
+        'board': sysfs.board_model(),
+        'machine': platform.machine(),
+        'kernel': platform.release(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'gstreamer': Gst.version_string(),
+        'picam': picam_version,
+    }
+
+
+def write_report(path, benchmark, results, settings):
+    report = {
+        'benchmark': benchmark,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'host': host_info(),
+        'settings': settings,
+        'results': results,
+    }
+    with open(path, 'w', encoding='UTF-8') as report_file:
+        json.dump(report, report_file, indent=2)
+    return report
@@ -0,0 +1,269 @@
+"""
+Glass to glass latency of each encoding through a real rtsp server and client.
+
+Frames are generated in place of v4l2src with their frame number stamped into the picture as a
+row of black and white blocks. They go through the encoding's pipeline from the encoder
+registry, a local RTSPServer and an rtspsrc client which depayloads and decodes them, then the
+stamp is read back to work out how long each frame took. The stamp is sized relative to the
+frame so it survives the encoders which scale the video down.
+
+    cd src && python -m benchmarks.latency --encodings x264enc,jpegenc --resolutions 1280x720 \\
+        --framerates 30,60 --duration 20 --output latency.json
+
+The decoded side has no display so the figures leave out the monitor, and the gray test
+picture is easy to encode so use benchmarks.throughput for the encoder load.
+"""
+
+import argparse
+import logging
+import threading
+import time
+from fractions import Fraction
+
+import gi
+
+from benchmarks import common
+from picam import encoders
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+gi.require_version('GstRtspServer', '1.0')
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from gi.repository import GLib, Gst, GstRtspServer, GstVideo
+
+STAMP_BITS = 24
+# blocks across the frame, the stamp uses the first STAMP_BITS of them
+STAMP_COLUMNS = 32
+STAMP_ROWS = 18
+LUMA_ON = 235
+LUMA_OFF = 16
+LUMA_BACKGROUND = 128
+# results from the first seconds are thrown away while the encoders and client settle
+WARMUP = 2.0
+MOUNT = '/benchmark'
+
+
+class FrameStamper:
+    """Builds I420 frames with the frame number in the top row of blocks"""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        luma_size = width * height
+        self.frame = bytearray([LUMA_BACKGROUND]) * (luma_size + luma_size // 2)
+        self.stamp_height = max(1, height // STAMP_ROWS)
+
+    def stamp(self, number):
+        row = bytearray()
+        for column in range(STAMP_COLUMNS):
+            start = column * self.width // STAMP_COLUMNS
+            end = (column + 1) * self.width // STAMP_COLUMNS
+            luma = LUMA_BACKGROUND
+            if column < STAMP_BITS:
+                luma = LUMA_ON if number >> (STAMP_BITS - 1 - column) & 1 else LUMA_OFF
+            row += bytes([luma]) * (end - start)
+        for line in range(self.stamp_height):
+            self.frame[line * self.width : (line + 1) * self.width] = row
+        return bytes(self.frame)
+
+
+def read_stamp(data, width, height, stride):
+    """reads the frame number back from the middle of each block of a decoded I420 frame"""
+    line = height // STAMP_ROWS // 2
+    number = 0
+    for column in range(STAMP_BITS):
+        x = (2 * column + 1) * width // (2 * STAMP_COLUMNS)
+        number = (number << 1) | (data[line * stride + x] > LUMA_BACKGROUND)
+    return number
+
+
+class LatencyRun:
+    """Streams one encoding, resolution and framerate and collects the latency of each frame"""
+
+    def __init__(self, encoding, width, height, framerate, port, overrides=None):
+        self.encoding = encoding
+        self.width = width
+        self.height = height
+        self.framerate = framerate
+        self.port = port
+        self.overrides = overrides
+        self.sent = {}
+        self.received = {}
+        self.started = None
+        self.errors = []
+        self._stop = threading.Event()
+
+    def launch_line(self):
+        source = (
+            'appsrc name=stamp is-live=true format=time do-timestamp=true '
+            'caps=video/x-raw,format=I420,width={},height={},framerate={}'
+        ).format(self.width, self.height, self.framerate)
+        pipeline = common.build_encoding_pipeline(
+            source,
+            self.encoding,
+            self.width,
+            self.height,
+            self.framerate,
+            self.overrides,
+        )
+        return '( {} )'.format(pipeline)
+
+    def feed(self, appsrc):
+        """pushes stamped frames at the framerate until the run is stopped"""
+        stamper = FrameStamper(self.width, self.height)
+        interval = 1 / float(Fraction(self.framerate))
+        number = 0
+        next_frame = time.monotonic()
+        while not self._stop.is_set():
+            buf = Gst.Buffer.new_wrapped(stamper.stamp(number))
+            self.sent[number] = time.monotonic()
+            if appsrc.emit('push-buffer', buf) != Gst.FlowReturn.OK:
+                break
+            number = (number + 1) % (1 << STAMP_BITS)
+            next_frame += interval
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def on_media_configure(self, _factory, media):
+        appsrc = media.get_element().get_by_name('stamp')
+        threading.Thread(target=self.feed, args=(appsrc,), name='feed', daemon=True).start()
+
+    def on_sample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        arrived = time.monotonic()
+        info = GstVideo.VideoInfo.new_from_caps(sample.get_caps())
+        buf = sample.get_buffer()
+        ok, mapped = buf.map(Gst.MapFlags.READ)
+        if ok:
+            try:
+                number = read_stamp(mapped.data, info.width, info.height, info.stride[0])
+            finally:
+                buf.unmap(mapped)
+            if number in self.sent and number not in self.received:
+                self.received[number] = arrived
+        return Gst.FlowReturn.OK
+
+    def on_client_message(self, _bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            error, _ = message.parse_error()
+            self.errors.append(error.message)
+            self._stop.set()
+
+    def run(self, server, duration):
+        factory = GstRtspServer.RTSPMediaFactory()
+        factory.set_launch(self.launch_line())
+        factory.set_shared(True)
+        factory.connect('media-configure', self.on_media_configure)
+        server.get_mount_points().add_factory(MOUNT, factory)
+
+        client = Gst.parse_launch(
+            'rtspsrc location=rtsp://127.0.0.1:{}{} latency=0 '
+            '! decodebin ! videoconvert ! video/x-raw,format=I420 '
+            '! appsink name=sink emit-signals=true sync=false max-buffers=4'.format(
+                self.port,
+                MOUNT,
+            )
+        )
+        client.get_by_name('sink').connect('new-sample', self.on_sample)
+        bus = client.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message', self.on_client_message)
+        self.started = time.monotonic()
+        client.set_state(Gst.State.PLAYING)
+        self._stop.wait(duration)
+        self._stop.set()
+        client.set_state(Gst.State.NULL)
+        bus.remove_signal_watch()
+        server.get_mount_points().remove_factory(MOUNT)
+        return self.results()
+
+    def results(self):
+        settled = self.started + WARMUP
+        latencies = []
+        for number, arrived in sorted(self.received.items()):
+            if self.sent[number] >= settled:
+                latencies.append((arrived - self.sent[number]) * 1000)
+        # frame loss over the frames sent after warming up which had time to arrive
+        received = [n for n, sent in self.sent.items() if sent >= settled and n in self.received]
+        expected = 0
+        if received:
+            expected = max(received) - min(received) + 1
+        # jitter as the mean difference between the latency of consecutive frames, like rfc 3550
+        deltas = [abs(b - a) for a, b in zip(latencies, latencies[1:])]
+        return {
+            'encoding': self.encoding,
+            'resolution': '{}x{}'.format(self.width, self.height),
+            'framerate': self.framerate,
+            'encoder': encoders.get_parameters(self.encoding, self.overrides),
+            'frames_sent': len(self.sent),
+            'frames_received': len(self.received),
+            'frame_loss': round(1 - len(received) / expected, 4) if expected else None,
+            'latency_ms': common.summarize(latencies),
+            'jitter_ms': round(sum(deltas) / len(deltas), 2) if deltas else None,
+            'errors': self.errors,
+        }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument(
+        '--encodings',
+        default=','.join(encoders.ENCODER_PROFILES),
+        help='comma separated encodings to measure, unavailable ones are skipped',
+    )
+    parser.add_argument('--resolutions', default='1280x720')
+    parser.add_argument('--framerates', default='30', help='e.g. 30,60,7013/117')
+    parser.add_argument('--duration', type=float, default=15.0, help='seconds per variant')
+    parser.add_argument('--port', type=int, default=8555)
+    parser.add_argument('--output', default='latency.json')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    server = GstRtspServer.RTSPServer()
+    server.set_service(str(args.port))
+    server.attach(None)
+    mainloop = GLib.MainLoop()
+    threading.Thread(target=mainloop.run, name='mainloop', daemon=True).start()
+
+    results = []
+    for encoding in args.encodings.split(','):
+        if not common.element_available(encoding):
+            logging.info('skipping %s, its elements are not installed', encoding)
+            continue
+        for resolution in args.resolutions.split(','):
+            width, height = (int(size) for size in resolution.split('x'))
+            for framerate in args.framerates.split(','):
+                run = LatencyRun(
+                    encoding,
+                    width,
+                    height,
+                    common.framerate_caps(framerate),
+                    args.port,
+                )
+                result = run.run(server, args.duration)
+                latency = result['latency_ms'] or {}
+                logging.info(
+                    '%s %s@%s p50 %s p95 %s p99 %s ms, jitter %s ms, loss %s',
+                    encoding,
+                    resolution,
+                    framerate,
+                    latency.get('p50'),
+                    latency.get('p95'),
+                    latency.get('p99'),
+                    result['jitter_ms'],
+                    result['frame_loss'],
+                )
+                results.append(result)
+    mainloop.quit()
+    settings = {'duration': args.duration, 'warmup': WARMUP}
+    common.write_report(args.output, 'latency', results, settings)
+    logging.info('wrote %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
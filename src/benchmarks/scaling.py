@@ -0,0 +1,199 @@
+"""
+Connect latency and delivered fps of a single mount as the number of clients grows.
+
+Each step connects that many rtspsrc clients to the mount at once, times how long each one
+took from starting to its first frame and then counts the frames every client receives. The
+frames are depayloaded and parsed but not decoded so the clients stay cheap next to the server.
+
+By default the mount is served from a local RTSPServer with videotestsrc and the encoding's
+pipeline from the encoder registry, with the thread pool sized like rtsp.max_threads:
+
+    cd src && python -m benchmarks.scaling --encoding x264enc --clients 1,2,4,8,16,32 \\
+        --max-threads 4
+
+or point it at a running picam to include the camera and the real server configuration,
+preferably from another machine so the clients don't take cpu from the server:
+
+    cd src && python -m benchmarks.scaling --url rtsp://picam.local:8554/playfield
+"""
+
+import argparse
+import logging
+import threading
+import time
+from fractions import Fraction
+
+import gi
+
+from benchmarks import common, throughput
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstRtspServer', '1.0')
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from gi.repository import GLib, Gst, GstRtspServer
+
+MOUNT = '/scaling'
+MIN_FPS_RATIO = 0.95
+# how long a client gets to connect before it counts as failed
+CONNECT_TIMEOUT = 10.0
+
+
+class Client:
+    """an rtspsrc client counting the frames it receives"""
+
+    def __init__(self, url, idx):
+        self.pipeline = Gst.parse_launch(
+            'rtspsrc location={} latency=0 ! parsebin ! fakesink name=sink sync=false'.format(url)
+        )
+        self.name = 'client{}'.format(idx)
+        self.started = None
+        self.first_frame = None
+        self.frames = 0
+        self.error = None
+        sink = self.pipeline.get_by_name('sink')
+        sink.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.on_frame)
+
+    def on_frame(self, _pad, _info):
+        if self.first_frame is None:
+            self.first_frame = time.monotonic()
+        self.frames += 1
+        return Gst.PadProbeReturn.OK
+
+    def start(self):
+        self.started = time.monotonic()
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def stop(self):
+        self.error = throughput.pipeline_error(self.pipeline)
+        self.pipeline.set_state(Gst.State.NULL)
+
+    def connect_latency(self):
+        if self.first_frame is None:
+            return None
+        return (self.first_frame - self.started) * 1000
+
+
+def start_server(args):
+    """serves the test stream from a local server with the thread pool under test"""
+    server = GstRtspServer.RTSPServer()
+    server.set_service(str(args.port))
+    server.get_thread_pool().set_max_threads(args.max_threads)
+    width, height = args.resolution.split('x')
+    framerate = common.framerate_caps(args.framerate)
+    pipeline = common.build_encoding_pipeline(
+        'videotestsrc is-live=true pattern={}'.format(args.pattern),
+        args.encoding,
+        width,
+        height,
+        framerate,
+    )
+    factory = GstRtspServer.RTSPMediaFactory()
+    factory.set_launch('( {} )'.format(pipeline))
+    factory.set_shared(True)
+    server.get_mount_points().add_factory(MOUNT, factory)
+    server.attach(None)
+    mainloop = GLib.MainLoop()
+    threading.Thread(target=mainloop.run, name='mainloop', daemon=True).start()
+    return 'rtsp://127.0.0.1:{}{}'.format(args.port, MOUNT), mainloop
+
+
+def measure(url, count, duration, target_fps):
+    clients = [Client(url, idx) for idx in range(count)]
+    for client in clients:
+        client.start()
+
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while time.monotonic() < deadline and any(c.first_frame is None for c in clients):
+        time.sleep(0.05)
+    start_frames = [client.frames for client in clients]
+    process_before = throughput.read_process_cpu()
+    started = time.monotonic()
+    time.sleep(duration)
+    elapsed = time.monotonic() - started
+    process_cpu = throughput.read_process_cpu() - process_before
+    fps = [(client.frames - before) / elapsed for client, before in zip(clients, start_frames)]
+    for client in clients:
+        client.stop()
+
+    latencies = [c.connect_latency() for c in clients if c.connect_latency() is not None]
+    connected = [rate for client, rate in zip(clients, fps) if client.first_frame is not None]
+    sustained = len(connected) == count and all(
+        rate >= target_fps * MIN_FPS_RATIO for rate in connected
+    )
+    return {
+        'clients': count,
+        'connected': len(connected),
+        'connect_latency_ms': common.summarize(latencies),
+        'fps': common.summarize(connected),
+        'sustained': sustained,
+        'process_cpu': round(process_cpu / elapsed, 2),
+        'errors': [client.error for client in clients if client.error],
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--url', help='mount of a running server, a local one is used otherwise')
+    parser.add_argument('--clients', default='1,2,4,8,16,32')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per step')
+    parser.add_argument('--framerate', default='30', help='the framerate the mount streams at')
+    parser.add_argument('--encoding', default='jpegenc', help='encoding of the local server')
+    parser.add_argument('--resolution', default='1280x720')
+    parser.add_argument('--pattern', default='smpte')
+    parser.add_argument('--max-threads', type=int, default=4, help='local server thread pool')
+    parser.add_argument('--port', type=int, default=8556)
+    parser.add_argument('--output', default='scaling.json')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    url = args.url
+    mainloop = None
+    if url is None:
+        if not common.element_available(args.encoding):
+            logging.error('%s is not available', args.encoding)
+            return
+        url, mainloop = start_server(args)
+    target_fps = float(Fraction(common.framerate_caps(args.framerate)))
+
+    results = []
+    for count in (int(c) for c in args.clients.split(',')):
+        result = measure(url, count, args.duration, target_fps)
+        latency = result['connect_latency_ms'] or {}
+        fps = result['fps'] or {}
+        logging.info(
+            '%d clients: %d connected, connect p50 %s p95 %s ms, fps min %s p50 %s%s',
+            count,
+            result['connected'],
+            latency.get('p50'),
+            latency.get('p95'),
+            fps.get('min'),
+            fps.get('p50'),
+            '' if result['sustained'] else ', not sustained',
+        )
+        results.append(result)
+    if mainloop is not None:
+        mainloop.quit()
+    settings = {
+        'url': args.url or 'local',
+        'duration': args.duration,
+        'framerate': args.framerate,
+        'connect_timeout': CONNECT_TIMEOUT,
+    }
+    if args.url is None:
+        settings.update(
+            {
+                'encoding': args.encoding,
+                'resolution': args.resolution,
+                'max_threads': args.max_threads,
+            }
+        )
+    common.write_report(args.output, 'scaling', results, settings)
+    logging.info('wrote %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+"""
+How many simultaneous streams of each encoding the board can sustain.
+
+Runs the encoding pipelines from the encoder registry headless, the same ones setup_uvc_device()
+streams, with videotestsrc or a looped clip in place of the camera and adds streams until they
+can't keep up. A stream keeps up when it reaches 95% of its framerate without its leaky queues
+dropping more than 1% of the frames.
+
+    cd src && python -m benchmarks.throughput --encodings x264enc,jpegenc \\
+        --resolutions 1280x720,1920x1080 --framerates 30,60,59.94 --max-streams 4
+
+--metrics adds the pad probes rtsp_server.py adds while metrics are served, run it with and
+without to see what they cost.
+
+Clips are raw YUYV (--clip-format yuyv, recorded with
+`v4l2-ctl --stream-mmap --stream-to=clip.yuv`) at the resolution being measured, or MJPEG
+(--clip-format mjpeg, `v4l2-ctl --stream-to=clip.mjpeg` with an MJPG format) for the mjpeg
+encoding which only parses and payloads what the camera sends.
+"""
+
+import argparse
+import logging
+import os
+import time
+from fractions import Fraction
+
+import gi
+
+from benchmarks import common
+from picam import encoders
+
+gi.require_version('Gst', '1.0')
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from gi.repository import Gst
+
+# a stream which falls below these has hit the limit of the board
+MIN_FPS_RATIO = 0.95
+MAX_DROP_RATIO = 0.01
+WARMUP = 3.0
+# software encoders, the device encodings need a clip of what the camera sends
+DEFAULT_ENCODINGS = ('jpegenc', 'x264enc', 'vp8enc', 'v4l2h264enc')
+
+
+def read_cpu_times():
+    """per core (busy, total) jiffies from /proc/stat"""
+    times = {}
+    with open('/proc/stat', 'r', encoding='UTF-8') as stat:
+        for line in stat:
+            if not line.startswith('cpu') or line.startswith('cpu '):
+                continue
+            fields = line.split()
+            values = [int(v) for v in fields[1:]]
+            # idle and iowait
+            idle = values[3] + values[4]
+            times[fields[0]] = (sum(values) - idle, sum(values))
+    return times
+
+
+def cpu_usage(before, after):
+    usage = {}
+    for core, (busy, total) in after.items():
+        busy_before, total_before = before.get(core, (0, 0))
+        elapsed = total - total_before
+        usage[core] = round(100 * (busy - busy_before) / elapsed, 1) if elapsed else 0.0
+    return usage
+
+
+def read_process_cpu():
+    """seconds of cpu time used by this process"""
+    times = os.times()
+    return times.user + times.system
+
+
+def read_rss():
+    """(current, peak) resident memory of this process in MiB"""
+    rss = {}
+    with open('/proc/self/status', 'r', encoding='UTF-8') as status:
+        for line in status:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                key, value = line.split(':', 1)
+                rss[key] = round(int(value.split()[0]) / 1024, 1)
+    return rss.get('VmRSS'), rss.get('VmHWM')
+
+
+def build_source(args, width, height, framerate):
+    if args.clip and args.clip_format == 'mjpeg':
+        return (
+            'multifilesrc location={} loop=true '
+            '! jpegparse ! image/jpeg,width={},height={},framerate={} '
+            '! identity sync=true'
+        ).format(args.clip, width, height, framerate)
+    if args.clip:
+        return (
+            'multifilesrc location={} loop=true '
+            '! rawvideoparse format=yuy2 width={} height={} framerate={} '
+            '! identity sync=true'
+        ).format(args.clip, width, height, framerate)
+    return 'videotestsrc is-live=true pattern={} horizontal-speed=4'.format(args.pattern)
+
+
+def build_stream(args, encoding, width, height, framerate, idx):
+    source = build_source(args, width, height, framerate)
+    if args.clip and args.clip_format == 'mjpeg':
+        # the camera's jpegs go straight into the mjpeg pipeline
+        pipeline = '{} ! {}'.format(
+            source,
+            encoders.build_pipeline(encoding, width, height, framerate, args.overrides),
+        )
+    else:
+        pipeline = common.build_encoding_pipeline(
+            source,
+            encoding,
+            width,
+            height,
+            framerate,
+            args.overrides,
+            raw_format='YUY2',
+        )
+    pipeline = Gst.parse_launch('{} ! fakesink sync=false name=sink{}'.format(pipeline, idx))
+    if args.metrics:
+        # pylint: disable=import-outside-toplevel
+        import rtsp_server
+
+        rtsp_server.instrument_pipeline(pipeline, 'stream{}'.format(idx))
+    return pipeline
+
+
+class StreamCounters:
+    """counts the frames reaching the payloader and the frames dropped by leaky queues"""
+
+    def __init__(self, pipeline):
+        self.frames = 0
+        self.drops = 0
+        payloader = pipeline.get_by_name('pay0')
+        payloader.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.on_frame)
+        iterator = pipeline.iterate_recurse()
+        while True:
+            result, element = iterator.next()
+            if result != Gst.IteratorResult.OK:
+                break
+            factory = element.get_factory()
+            if factory is not None and factory.get_name() == 'queue':
+                element.connect('overrun', self.on_overrun)
+
+    def on_frame(self, _pad, _info):
+        self.frames += 1
+        return Gst.PadProbeReturn.OK
+
+    def on_overrun(self, _queue):
+        self.drops += 1
+
+    def snapshot(self):
+        return (self.frames, self.drops)
+
+
+def pipeline_error(pipeline):
+    message = pipeline.get_bus().pop_filtered(Gst.MessageType.ERROR)
+    if message is None:
+        return None
+    error, _ = message.parse_error()
+    return error.message
+
+
+def measure(args, encoding, width, height, framerate, streams):
+    """runs the streams side by side and measures each of them after warming up"""
+    pipelines = [build_stream(args, encoding, width, height, framerate, i) for i in range(streams)]
+    counters = [StreamCounters(pipeline) for pipeline in pipelines]
+    for pipeline in pipelines:
+        pipeline.set_state(Gst.State.PLAYING)
+    time.sleep(WARMUP)
+
+    start_counts = [c.snapshot() for c in counters]
+    cpu_before = read_cpu_times()
+    process_before = read_process_cpu()
+    started = time.monotonic()
+    time.sleep(args.duration)
+    elapsed = time.monotonic() - started
+    end_counts = [c.snapshot() for c in counters]
+    cpu_after = read_cpu_times()
+    process_cpu = read_process_cpu() - process_before
+    rss, peak_rss = read_rss()
+
+    errors = [error for error in (pipeline_error(p) for p in pipelines) if error]
+    for pipeline in pipelines:
+        pipeline.set_state(Gst.State.NULL)
+
+    target_fps = float(Fraction(framerate))
+    stream_results = []
+    for (frames_before, drops_before), (frames, drops) in zip(start_counts, end_counts):
+        frames -= frames_before
+        drops -= drops_before
+        fps = frames / elapsed
+        stream_results.append(
+            {
+                'fps': round(fps, 2),
+                'dropped': drops,
+                'drop_ratio': round(drops / (frames + drops), 4) if frames + drops else 0.0,
+            }
+        )
+    sustained = not errors and all(
+        s['fps'] >= target_fps * MIN_FPS_RATIO and s['drop_ratio'] <= MAX_DROP_RATIO
+        for s in stream_results
+    )
+    return {
+        'encoding': encoding,
+        'resolution': '{}x{}'.format(width, height),
+        'framerate': framerate,
+        'streams': streams,
+        'sustained': sustained,
+        'min_fps': min(s['fps'] for s in stream_results),
+        'stream_results': stream_results,
+        'cpu_per_core': cpu_usage(cpu_before, cpu_after),
+        # cores worth of cpu used by the pipelines
+        'process_cpu': round(process_cpu / elapsed, 2),
+        'rss_mb': rss,
+        'peak_rss_mb': peak_rss,
+        'errors': errors,
+    }
+
+
+def describe_encoder(encoding, overrides):
+    """the parameters which matter most for the cost of the encoding e.g. x264enc superfast"""
+    params = encoders.get_parameters(encoding, overrides)
+    details = [encoding]
+    if 'preset' in params:
+        details.append(params['preset'])
+    if params.get('output_size'):
+        details.append('-> {}'.format(params['output_size']))
+    return ' '.join(details)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--encodings', default=','.join(DEFAULT_ENCODINGS))
+    parser.add_argument('--resolutions', default='1280x720,1920x1080')
+    parser.add_argument('--framerates', default='30,60,59.94')
+    parser.add_argument('--max-streams', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per measurement')
+    parser.add_argument('--pattern', default='smpte', help='videotestsrc pattern, snow is worst')
+    parser.add_argument('--clip', help='recorded clip to loop instead of videotestsrc')
+    parser.add_argument('--clip-format', choices=('yuyv', 'mjpeg'), default='yuyv')
+    parser.add_argument(
+        '--encoder',
+        action='append',
+        default=[],
+        help='encoder parameter override e.g. --encoder preset=ultrafast',
+    )
+    parser.add_argument(
+        '--metrics',
+        action='store_true',
+        help='add the metrics pad probes to each stream',
+    )
+    parser.add_argument('--output', default='throughput.json')
+    args = parser.parse_args()
+    args.overrides = dict(option.split('=', 1) for option in args.encoder)
+    return args
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    board = common.host_info()['board']
+    results = []
+    capacity = []
+    for encoding in args.encodings.split(','):
+        if not common.element_available(encoding):
+            logging.info('skipping %s, its elements are not installed', encoding)
+            continue
+        if args.clip and (args.clip_format == 'mjpeg') != (encoding == 'mjpeg'):
+            logging.info('skipping %s, it can not use a %s clip', encoding, args.clip_format)
+            continue
+        for resolution in args.resolutions.split(','):
+            width, height = (int(size) for size in resolution.split('x'))
+            for framerate_option in args.framerates.split(','):
+                framerate = common.framerate_caps(framerate_option)
+                max_streams = 0
+                for streams in range(1, args.max_streams + 1):
+                    result = measure(args, encoding, width, height, framerate, streams)
+                    results.append(result)
+                    logging.info(
+                        '%s %s@%s x%d: min %.1f fps, %.2f cores, %s MiB%s',
+                        encoding,
+                        resolution,
+                        framerate_option,
+                        streams,
+                        result['min_fps'],
+                        result['process_cpu'],
+                        result['rss_mb'],
+                        '' if result['sustained'] else ', not sustained',
+                    )
+                    if not result['sustained']:
+                        break
+                    max_streams = streams
+                summary = '{} {}@{}: {} stream{} max on {}'.format(
+                    describe_encoder(encoding, args.overrides),
+                    resolution,
+                    framerate_option,
+                    max_streams,
+                    '' if max_streams == 1 else 's',
+                    board,
+                )
+                capacity.append(
+                    {
+                        'encoding': encoding,
+                        'resolution': resolution,
+                        'framerate': framerate,
+                        'max_streams': max_streams,
+                        'summary': summary,
+                    }
+                )
+
+    print('\n'.join(entry['summary'] for entry in capacity))
+    settings = {
+        'duration': args.duration,
+        'warmup': WARMUP,
+        'source': args.clip or 'videotestsrc pattern={}'.format(args.pattern),
+        'overrides': args.overrides,
+        'metrics': args.metrics,
+        'min_fps_ratio': MIN_FPS_RATIO,
+        'max_drop_ratio': MAX_DROP_RATIO,
+    }
+    common.write_report(
+        args.output,
+        'throughput',
+        {'runs': results, 'capacity': capacity},
+        settings,
+    )
+    logging.info('wrote %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Copies per frame between the camera and a v4l2 hardware encoder, with and without zero_copy.
+
+Each mode runs the conversion from encoders.build_hardware_input(), the same one the
+v4l2h264enc pipeline uses, between v4l2src and the encoder and watches the buffers going
+through every element. A software transform which isn't in passthrough writes each frame out
+again and a v4l2 element fed anything other than dmabufs copies it into its own buffers, so
+zero_copy should come out at 0 copies per frame where v4l2convert is available.
+
+Without a camera and hardware encoder it can be checked against the virtual drivers, vivid for
+the camera, vim2m for v4l2convert and vicodec for the encoder:
+
+    sudo modprobe vivid && sudo modprobe vim2m && sudo modprobe vicodec
+    cd src && python -m benchmarks.zerocopy --device /dev/video0 --encoder v4l2fwhtenc \\
+        --resolution 1280x720 --framerate 30
+"""
+
+import argparse
+import logging
+import time
+
+import gi
+
+from benchmarks import common, throughput
+from picam import encoders
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstAllocators', '1.0')
+gi.require_version('GstBase', '1.0')
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from gi.repository import Gst, GstAllocators, GstBase
+
+WARMUP = 2.0
+MODES = {
+    'software': {'zero_copy': False},
+    'zero_copy': {'zero_copy': True},
+}
+
+
+def build_chain(args, zero_copy):
+    width, height = args.resolution.split('x')
+    params = encoders.get_parameters('v4l2h264enc', {'zero_copy': zero_copy})
+    params['output_size'] = args.output_size
+    conversion, io_mode = encoders.build_hardware_input(params)
+    return (
+        'v4l2src device={device} io-mode=4 '
+        '! video/x-raw,width={width},height={height},framerate={framerate} '
+        '{conversion}'
+        '! {encoder} name=enc0 {io_mode}'
+        '! fakesink sync=false'
+    ).format(
+        device=args.device,
+        width=width,
+        height=height,
+        framerate=common.framerate_caps(args.framerate),
+        conversion=conversion,
+        encoder=args.encoder,
+        io_mode=io_mode,
+    )
+
+
+def is_dmabuf(buf):
+    return buf.n_memory() > 0 and GstAllocators.is_dmabuf_memory(buf.peek_memory(0))
+
+
+class Stage:
+    """counts the frames going into an element and how many of them it had to copy"""
+
+    def __init__(self, element):
+        self.element = element
+        self.name = element.get_factory().get_name()
+        self.hardware = self.name.startswith('v4l2')
+        self.frames = 0
+        self.dmabufs = 0
+        self.copies = 0
+        element.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.on_input)
+
+    def on_input(self, _pad, info):
+        dmabuf = is_dmabuf(info.get_buffer())
+        self.frames += 1
+        self.dmabufs += dmabuf
+        if self.hardware:
+            if not dmabuf:
+                self.copies += 1
+        elif isinstance(self.element, GstBase.BaseTransform):
+            if not self.element.is_passthrough():
+                self.copies += 1
+        return Gst.PadProbeReturn.OK
+
+    def reset(self):
+        self.frames = 0
+        self.dmabufs = 0
+        self.copies = 0
+
+    def result(self):
+        return {
+            'element': self.name,
+            'frames': self.frames,
+            'dmabuf_ratio': round(self.dmabufs / self.frames, 3) if self.frames else None,
+            'copies': self.copies,
+        }
+
+
+def find_stages(pipeline):
+    """every element between the source and the sink, in the order the frames go through them"""
+    stages = []
+    pad = pipeline.get_by_name('enc0').get_static_pad('sink')
+    while pad is not None:
+        element = pad.get_peer().get_parent_element()
+        if element.get_static_pad('sink') is None:
+            break
+        stages.insert(0, element)
+        pad = element.get_static_pad('sink')
+    stages.append(pipeline.get_by_name('enc0'))
+    return [Stage(element) for element in stages]
+
+
+def measure(args, mode):
+    launch = build_chain(args, **MODES[mode])
+    logging.info(launch)
+    pipeline = Gst.parse_launch(launch)
+    stages = find_stages(pipeline)
+    pipeline.set_state(Gst.State.PLAYING)
+    time.sleep(WARMUP)
+    for stage in stages:
+        stage.reset()
+    process_before = throughput.read_process_cpu()
+    started = time.monotonic()
+    time.sleep(args.duration)
+    elapsed = time.monotonic() - started
+    process_cpu = throughput.read_process_cpu() - process_before
+    results = [stage.result() for stage in stages]
+    error = throughput.pipeline_error(pipeline)
+    pipeline.set_state(Gst.State.NULL)
+
+    encoded = results[-1]['frames']
+    copies = sum(stage['copies'] for stage in results)
+    return {
+        'mode': mode,
+        'launch': launch,
+        'fps': round(encoded / elapsed, 2),
+        'copies_per_frame': round(copies / encoded, 2) if encoded else None,
+        'process_cpu': round(process_cpu / elapsed, 2),
+        'stages': results,
+        'error': error,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--device', default='/dev/video0')
+    parser.add_argument('--encoder', default='v4l2h264enc', help='e.g. v4l2fwhtenc for vicodec')
+    parser.add_argument('--resolution', default='1920x1080')
+    parser.add_argument('--framerate', default='30')
+    parser.add_argument('--output-size', default='1280x720', help='WIDTHxHEIGHT to scale to')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per mode')
+    parser.add_argument('--output', default='zerocopy.json')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    modes = args.modes.split(',')
+    if Gst.ElementFactory.find(args.encoder) is None:
+        logging.error('%s is not available', args.encoder)
+        return
+    if Gst.ElementFactory.find('v4l2convert') is None and 'zero_copy' in modes:
+        # the rtsp server falls back to the software conversion in this case
+        logging.warning('v4l2convert is not available, skipping zero_copy')
+        modes.remove('zero_copy')
+    results = []
+    for mode in modes:
+        result = measure(args, mode)
+        logging.info(
+            '%s: %.1f fps, %s copies per frame, %.2f cores%s',
+            mode,
+            result['fps'],
+            result['copies_per_frame'],
+            result['process_cpu'],
+            ', {}'.format(result['error']) if result['error'] else '',
+        )
+        results.append(result)
+    settings = {
+        'device': args.device,
+        'encoder': args.encoder,
+        'resolution': args.resolution,
+        'framerate': args.framerate,
+        'output_size': args.output_size,
+        'duration': args.duration,
+        'warmup': WARMUP,
+    }
+    common.write_report(args.output, 'zerocopy', results, settings)
+    logging.info('wrote %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+"""
+In-process ALSA helpers.
+
+Mixer levels are read and written through alsa-lib's simple mixer api with a handle kept open
+per card.
+
+Capture capabilities are read from /proc/asound/cardN/stream0 which the usb audio driver keeps
+up to date even while the card is in use. Other cards are asked through alsa-lib's hw_params
+which doesn't start a capture but does need the pcm to be free, so results are kept in the
+persistent capability cache.
+"""
+
+import errno
+import functools
+import ctypes
+import ctypes.util
+import logging
+import re
+import threading
+
+from picam.capabilities import capability_cache
+from picam.writer import CoalescingWriter
+
+# sample rates offered in the web ui
+AUDIO_RATES = (32000, 44100, 48000)
+
+SND_PCM_STREAM_CAPTURE = 1
+SND_PCM_NONBLOCK = 0x1
+
+# snd_pcm_format_t values for the formats usb microphones commonly support
+SND_PCM_FORMATS = {
+    'S16_LE': 2,
+    'S24_LE': 6,
+    'S32_LE': 10,
+    'FLOAT_LE': 14,
+    'S24_3LE': 32,
+}
+
+
+@functools.cache
+def _load_libasound():
+    library = ctypes.util.find_library('asound')
+    if library is None:
+        raise OSError('alsa-lib is not available')
+    return ctypes.CDLL(library, use_errno=True)
+
+
+def _expand_rates(rates_line):
+    """handles both '32000, 44100, 48000' and '8000 - 48000 (continuous)'"""
+    m = re.match(r'(\d+)\s*-\s*(\d+)', rates_line)
+    if m:
+        low, high = int(m.group(1)), int(m.group(2))
+        return [rate for rate in AUDIO_RATES if low <= rate <= high]
+    return [int(rate) for rate in re.findall(r'\d+', rates_line)]
+
+
+def parse_stream_capture(stream_text):
+    """
+    Parses the Capture section of /proc/asound/cardN/stream0 into the rates, channel counts and
+    sample formats of all of its altsettings.
+    """
+    rates = set()
+    channels = set()
+    formats = set()
+    in_capture = False
+    for line in stream_text.split('\n'):
+        stripped = line.strip()
+        if not line.startswith(' ') and stripped.endswith(':'):
+            in_capture = stripped == 'Capture:'
+            continue
+        if not in_capture:
+            continue
+        if stripped.startswith('Format:'):
+            formats.update(f.strip() for f in stripped.split(':', 1)[1].split(','))
+        elif stripped.startswith('Channels:'):
+            channels.add(int(stripped.split(':', 1)[1]))
+        elif stripped.startswith('Rates:'):
+            rates.update(_expand_rates(stripped.split(':', 1)[1]))
+    return {
+        'sample_rates': sorted(rates),
+        'channels': sorted(channels),
+        'formats': sorted(formats),
+    }
+
+
+def _probe_proc_stream(card_idx):
+    try:
+        with open(f'/proc/asound/card{card_idx}/stream0', 'r', encoding='UTF-8') as stream:
+            capabilities = parse_stream_capture(stream.read())
+    except OSError:
+        return None
+    if not capabilities['sample_rates']:
+        return None
+    return capabilities
+
+
+def _probe_hw_params(card_idx):
+    """asks alsa-lib what the capture pcm supports without starting a capture"""
+    lib = _load_libasound()
+    pcm = ctypes.c_void_p()
+    ret = lib.snd_pcm_open(
+        ctypes.byref(pcm),
+        f'hw:{card_idx}'.encode(),
+        SND_PCM_STREAM_CAPTURE,
+        SND_PCM_NONBLOCK,
+    )
+    if ret < 0:
+        raise OSError(-ret, 'unable to open hw:{}'.format(card_idx))
+    hw_params = ctypes.c_void_p()
+    try:
+        lib.snd_pcm_hw_params_malloc(ctypes.byref(hw_params))
+        lib.snd_pcm_hw_params_any(pcm, hw_params)
+        rates = [
+            rate
+            for rate in AUDIO_RATES
+            if lib.snd_pcm_hw_params_test_rate(pcm, hw_params, rate, 0) == 0
+        ]
+        formats = [
+            name
+            for name, fmt in SND_PCM_FORMATS.items()
+            if lib.snd_pcm_hw_params_test_format(pcm, hw_params, fmt) == 0
+        ]
+        min_channels = ctypes.c_uint()
+        max_channels = ctypes.c_uint()
+        lib.snd_pcm_hw_params_get_channels_min(hw_params, ctypes.byref(min_channels))
+        lib.snd_pcm_hw_params_get_channels_max(hw_params, ctypes.byref(max_channels))
+        channels = list(range(min_channels.value, min(max_channels.value, 8) + 1))
+    finally:
+        if hw_params:
+            lib.snd_pcm_hw_params_free(hw_params)
+        lib.snd_pcm_close(pcm)
+    return {
+        'sample_rates': rates,
+        'channels': channels,
+        'formats': formats,
+    }
+
+
+def probe_capabilities(card_idx):
+    """Returns the capture capabilities of the card or None if they can't be determined"""
+    capabilities = _probe_proc_stream(card_idx)
+    if capabilities is None:
+        try:
+            capabilities = _probe_hw_params(card_idx)
+        except OSError as e:
+            logging.info('unable to probe hw:%s: %s', card_idx, e)
+    return capabilities
+
+
+def get_capabilities(card_idx, serial, usb_id=''):
+    """
+    Returns the capture capabilities for a card from the capability cache, probing it the first
+    time the device is seen.
+    """
+    cache_key = f'{serial}:{usb_id}'
+    capabilities = capability_cache.get('audio', cache_key)
+    if capabilities is None:
+        capabilities = probe_capabilities(card_idx)
+        if capabilities is None:
+            return {'sample_rates': [], 'channels': [], 'formats': []}
+        capability_cache.set('audio', cache_key, capabilities)
+    return capabilities
+
+
+# capture elements to prefer when a card has several, usb microphones usually only have 'Mic'
+CAPTURE_ELEMENTS = ('Mic', 'Capture', 'Mic Capture', 'Line', 'Digital', 'Headset')
+
+SND_MIXER_SCHN_MONO = 0
+
+
+def _setup_mixer_prototypes(lib):
+    lib.snd_mixer_first_elem.restype = ctypes.c_void_p
+    lib.snd_mixer_first_elem.argtypes = [ctypes.c_void_p]
+    lib.snd_mixer_elem_next.restype = ctypes.c_void_p
+    lib.snd_mixer_elem_next.argtypes = [ctypes.c_void_p]
+    lib.snd_mixer_selem_get_name.restype = ctypes.c_char_p
+    lib.snd_mixer_selem_get_name.argtypes = [ctypes.c_void_p]
+    lib.snd_mixer_selem_has_capture_volume.argtypes = [ctypes.c_void_p]
+    lib.snd_mixer_selem_get_capture_volume_range.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_long),
+        ctypes.POINTER(ctypes.c_long),
+    ]
+    lib.snd_mixer_selem_get_capture_volume.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_long),
+    ]
+    lib.snd_mixer_selem_set_capture_volume_all.argtypes = [ctypes.c_void_p, ctypes.c_long]
+
+
+class Mixer:
+    """
+    An open alsa simple mixer handle for a card's capture volume, replaces running
+    `amixer -c N sget/set Mic` for every read and write.
+    """
+
+    def __init__(self, card_idx):
+        self.card_idx = card_idx
+        self._lib = _load_libasound()
+        _setup_mixer_prototypes(self._lib)
+        self._lock = threading.Lock()
+        self._handle = ctypes.c_void_p()
+        self._check(self._lib.snd_mixer_open(ctypes.byref(self._handle), 0), 'open')
+        try:
+            card = f'hw:{card_idx}'.encode()
+            self._check(self._lib.snd_mixer_attach(self._handle, card), 'attach')
+            self._check(self._lib.snd_mixer_selem_register(self._handle, None, None), 'register')
+            self._check(self._lib.snd_mixer_load(self._handle), 'load')
+            self.element_name, self._elem = self._find_capture_element()
+        except OSError:
+            self.close()
+            raise
+
+    def _check_open(self):
+        """call with the lock held, the element belongs to the handle and is freed with it"""
+        if not self._handle:
+            raise OSError(errno.EBADF, 'mixer for hw:{} is closed'.format(self.card_idx))
+
+    def _check(self, ret, action):
+        if ret < 0:
+            raise OSError(-ret, 'mixer {} failed for hw:{}'.format(action, self.card_idx))
+
+    def _find_capture_element(self):
+        elements = {}
+        elem = self._lib.snd_mixer_first_elem(self._handle)
+        while elem:
+            if self._lib.snd_mixer_selem_has_capture_volume(elem):
+                name = self._lib.snd_mixer_selem_get_name(elem).decode(errors='replace')
+                elements.setdefault(name, elem)
+            elem = self._lib.snd_mixer_elem_next(elem)
+        if not elements:
+            raise OSError('no capture volume on hw:{}'.format(self.card_idx))
+        for name in CAPTURE_ELEMENTS:
+            if name in elements:
+                return name, elements[name]
+        name = next(iter(elements))
+        return name, elements[name]
+
+    def _volume_range(self):
+        min_vol = ctypes.c_long()
+        max_vol = ctypes.c_long()
+        self._lib.snd_mixer_selem_get_capture_volume_range(
+            self._elem,
+            ctypes.byref(min_vol),
+            ctypes.byref(max_vol),
+        )
+        return min_vol.value, max_vol.value
+
+    def get_level(self):
+        """Returns the capture volume as a percentage the same way amixer reports it"""
+        with self._lock:
+            self._check_open()
+            # pick up changes made by anything else since the last read
+            self._lib.snd_mixer_handle_events(self._handle)
+            min_vol, max_vol = self._volume_range()
+            volume = ctypes.c_long()
+            self._check(
+                self._lib.snd_mixer_selem_get_capture_volume(
+                    self._elem,
+                    SND_MIXER_SCHN_MONO,
+                    ctypes.byref(volume),
+                ),
+                'read',
+            )
+        if max_vol <= min_vol:
+            return 0
+        return round((volume.value - min_vol) * 100 / (max_vol - min_vol))
+
+    def set_level(self, level):
+        """Sets the capture volume of all channels from a percentage"""
+        with self._lock:
+            self._check_open()
+            min_vol, max_vol = self._volume_range()
+            volume = min_vol + round(int(level) * (max_vol - min_vol) / 100)
+            self._check(
+                self._lib.snd_mixer_selem_set_capture_volume_all(self._elem, volume),
+                'write',
+            )
+
+    def close(self):
+        """frees the handle once no read or write is using it, later ones raise OSError"""
+        with self._lock:
+            handle = self._handle
+            self._handle = ctypes.c_void_p()
+            self._elem = None
+            if handle:
+                self._lib.snd_mixer_close(handle)
+
+
+_mixers = {}
+_mixers_lock = threading.Lock()
+
+
+def get_mixer(card_idx):
+    """
+    Returns the open mixer for the card, opening it on first use.
+
+    Raises:
+        OSError if alsa-lib isn't available or the card has no capture volume
+    """
+    card_idx = str(card_idx)
+    with _mixers_lock:
+        mixer = _mixers.get(card_idx)
+        if mixer is None:
+            mixer = Mixer(card_idx)
+            _mixers[card_idx] = mixer
+        return mixer
+
+
+def close_mixer(card_idx):
+    with _mixers_lock:
+        mixer = _mixers.pop(str(card_idx), None)
+    if mixer is not None:
+        mixer.close()
+
+
+def get_recording_levels(card_indexes):
+    """Reads the capture level of each card, leaving out the ones which can't be read"""
+    levels = {}
+    for card_idx in card_indexes:
+        try:
+            levels[str(card_idx)] = get_mixer(card_idx).get_level()
+        except OSError:
+            close_mixer(card_idx)
+    return levels
+
+
+class MixerWriter(CoalescingWriter):
+    """Applies recording level changes for a card, coalescing slider moves"""
+
+    ack_event = 'audio-ack'
+
+    def __init__(self, card_idx, min_interval=0.05):
+        self.card_idx = str(card_idx)
+        get_mixer(self.card_idx)
+        super().__init__(f'hw:{self.card_idx}', min_interval)
+
+    def on_error(self, error):
+        # the card may have been unplugged, reopen on the next write
+        close_mixer(self.card_idx)
+
+    def write(self, settings):
+        mixer = get_mixer(self.card_idx)
+        mixer.set_level(settings['rec_level'])
+        return {'rec_level': {'value': mixer.get_level(), 'element': mixer.element_name}}
+
+
+_mixer_writers = {}
+_mixer_writers_lock = threading.Lock()
+
+
+def get_mixer_writer(card_idx):
+    """
+    Returns the shared writer for the card, creating it on first use.
+
+    Raises:
+        OSError if the card's mixer can't be opened
+    """
+    card_idx = str(card_idx)
+    with _mixer_writers_lock:
+        writer = _mixer_writers.get(card_idx)
+        if writer is None:
+            writer = MixerWriter(card_idx)
+            _mixer_writers[card_idx] = writer
+        return writer
@@ -6,6 +6,8 @@ from flask import current_app as app
 from flask import redirect, render_template, request
 from flask.views import MethodView
 
+from picam import alsa, sysfs
+
 
 def render_json(json_data):
     resp = app.make_response(json.dumps(json_data))
@@ -13,7 +15,7 @@ def render_json(json_data):
     return resp
 
 
-def get_current_recording_level(card_idx):
+def _get_recording_level_amixer(card_idx):
     cmd = subprocess.run(
         ('amixer', '-c', card_idx, 'sget', 'Mic'),
         stdout=subprocess.PIPE,
@@ -29,13 +31,26 @@ def get_current_recording_level(card_idx):
     return rec_level
 
 
-def adjust_audio_volume(card_idx, level):
-    """Use amixer to change the volumne level of the audio device
+def get_current_recording_level(card_idx):
+    """Reads the capture level through the card's open mixer, falling back to amixer"""
+    try:
+        return str(alsa.get_mixer(card_idx).get_level())
+    except OSError:
+        alsa.close_mixer(card_idx)
+        return _get_recording_level_amixer(str(card_idx))
 
-    Args:
-        card_idx: the alsa device id e.g. 0 for /proc/asound/card0
-        level: the volume level for the device in percentage
-    """
+
+def get_recording_levels(card_indexes):
+    """Reads the capture level of every card in one go, {card_idx: level}"""
+    levels = alsa.get_recording_levels(card_indexes)
+    levels = {card_idx: str(level) for card_idx, level in levels.items()}
+    for card_idx in card_indexes:
+        if str(card_idx) not in levels:
+            levels[str(card_idx)] = _get_recording_level_amixer(str(card_idx))
+    return levels
+
+
+def _adjust_audio_volume_amixer(card_idx, level):
     subprocess.run(
         ('amixer', '-c', card_idx, 'set', 'Mic', f'{level}%'),
         stdout=subprocess.PIPE,
@@ -43,6 +58,26 @@ def adjust_audio_volume(card_idx, level):
     )
 
 
+def adjust_audio_volume(card_idx, level):
+    """Queue a change to the volumne level of the audio device
+
+    Writes go through the card's mixer writer so a dragged slider only writes the latest level,
+    amixer is used when the mixer can't be opened.
+
+    Args:
+        card_idx: the alsa device id e.g. 0 for /proc/asound/card0
+        level: the volume level for the device in percentage
+
+    Returns:
+        the sequence number of the queued write or None if amixer was used
+    """
+    try:
+        return alsa.get_mixer_writer(card_idx).submit({'rec_level': int(level)})
+    except OSError:
+        _adjust_audio_volume_amixer(str(card_idx), level)
+        return None
+
+
 def get_asound_devices(recordable_devices):
     cmd1 = subprocess.run(
         ('cat', '/proc/asound/cards'),
@@ -89,15 +124,9 @@ def get_recordable_devices():
     return devices
 
 
-def find_audio_devices(with_rates=False):  # pylint: disable=too-many-locals
-    """
-    Look at all of the usb sound devices available and create a dict with the alsa index based
-    on the card id found and the serial if available.
-
-    Special cases can be handled here for devices like Snowballs and such that do not have serials
-    and only support one of that type connected to the Pi.
-    """
-    devices = {}
+def _find_usb_sound_cards_udevadm():
+    """asks udevadm about each usb sound device, used when sysfs isn't available"""
+    cards = []
     snd_cmd = subprocess.run(
         ('ls', '-1', '/dev/snd/by-id'),
         stdout=subprocess.PIPE,
@@ -109,6 +138,8 @@ def find_audio_devices(with_rates=False):  # pylint: disable=too-many-locals
         serial = None
         card_idx = None
         model = ''
+        vendor_id = ''
+        model_id = ''
         cmd1 = subprocess.run(
             ('/bin/udevadm', 'info', f'--name=/dev/snd/by-id/{usb_device}'),
             stdout=subprocess.PIPE,
@@ -125,50 +156,76 @@ def find_audio_devices(with_rates=False):  # pylint: disable=too-many-locals
             elif 'ID_MODEL=' in line:
                 model = line.strip().split('=')[1]
                 model = model.replace('_', ' ')
-        if card_idx and serial:
-            sample_rates = []
-            if with_rates:
-                for sample_rate in [32000, 44100, 48000]:
-                    # test available audio rates checking with caps from gstreamer
-                    pipeline = (
-                        'gst-launch-1.0 alsasrc device=hw:{card_idx} num-buffers=10 '
-                        '! audio/x-raw,rate={sample_rate} '
-                        '! fakesink'
-                    ).format(card_idx=card_idx, sample_rate=sample_rate)
-                    cmd = subprocess.run(
-                        pipeline.split(),
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                    )
-                    if cmd.returncode == 0:
-                        sample_rates.append(sample_rate)
-            rec_level = get_current_recording_level(card_idx)
-            devices.update(
-                {
-                    serial: {
-                        'alsa_idx': card_idx,
-                        'description': model,
-                        'rec_level': rec_level,
-                        'sample_rates': sample_rates,
-                    }
+            elif 'ID_VENDOR_ID=' in line:
+                vendor_id = line.strip().split('=')[1]
+            elif 'ID_MODEL_ID=' in line:
+                model_id = line.strip().split('=')[1]
+        cards.append((card_idx, serial, model, f'{vendor_id}:{model_id}'))
+    return cards
+
+
+def find_usb_sound_cards():
+    """Returns (card_idx, serial, model, usb_id) for each usb sound card"""
+    if not sysfs.available():
+        return _find_usb_sound_cards_udevadm()
+    cards = []
+    for card_idx, usb_info in sysfs.resolve_sound_cards().items():
+        serial = usb_info['serial']
+        if not serial and usb_info['quirks']:
+            # devices like Snowballs do not have serials and only support one of that type
+            serial = usb_info['quirks']['serial']
+        cards.append((card_idx, serial, usb_info['product'], usb_info['usb_id']))
+    return cards
+
+
+def find_audio_devices(with_rates=False):
+    """
+    Look at all of the usb sound devices available and create a dict with the alsa index based
+    on the card id found and the serial if available.
+
+    Special cases for devices like Snowballs and such that do not have serials and only support
+    one of that type connected to the Pi are handled by the quirks in picam.sysfs.
+    """
+    devices = {}
+    sound_cards = [card for card in find_usb_sound_cards() if card[0] and card[1]]
+    rec_levels = get_recording_levels([card[0] for card in sound_cards])
+    for card_idx, serial, model, usb_id in sound_cards:
+        sample_rates = []
+        channels = []
+        if with_rates:
+            # read from the driver or the capability cache, works while the card is streaming
+            capabilities = alsa.get_capabilities(card_idx, serial, usb_id)
+            sample_rates = [r for r in capabilities['sample_rates'] if r in alsa.AUDIO_RATES]
+            channels = capabilities['channels']
+        rec_level = rec_levels[str(card_idx)]
+        devices.update(
+            {
+                serial: {
+                    'alsa_idx': card_idx,
+                    'description': model,
+                    'rec_level': rec_level,
+                    'sample_rates': sample_rates,
+                    'channels': channels,
                 }
-            )
+            }
+        )
     return devices
 
 
 class AudioDeviceHandler(MethodView):
     def get(self, serial):
         audio_configs = app.picam_config.audio_devices
-        audio_devices = find_audio_devices(with_rates=True)
+        audio_devices = app.device_inventory.audio_devices(with_rates=True)
         device_info = audio_devices.get(serial)
+        rec_level = get_current_recording_level(device_info['alsa_idx'])
         device_config = audio_configs.get(serial, {})
-        device_config.update({'rec_level': device_info['rec_level']})
+        device_config.update({'rec_level': rec_level})
         model = {
             'alsa_idx': device_info['alsa_idx'],
             'description': device_info['description'],
             'serial': serial,
             'audio_device': serial,
-            'rec_level': device_info['rec_level'],
+            'rec_level': rec_level,
             'device_config': device_config,
             'sample_rates': device_info['sample_rates'],
             'menu': 'devices',
@@ -214,7 +271,7 @@ class AudioDeviceHandler(MethodView):
 
 class AudioDeviceApiHandler(MethodView):
     def post(self, serial):
-        app.logger('updating audio level for %s', serial)
+        app.logger.info('updating audio level for %s', serial)
         data = request.json
-        adjust_audio_volume(data['alsa_idx'], data['rec_level'])
-        return render_json({'status': 'ok'})
+        seq = adjust_audio_volume(data['alsa_idx'], data['rec_level'])
+        return render_json({'status': 'ok', 'seq': seq})
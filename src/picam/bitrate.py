@@ -0,0 +1,159 @@
+"""
+Adapts an encoder's bitrate to the link quality the rtsp clients report.
+
+The rtsp server polls the rtcp receiver reports of each stream and feeds the worst packet loss
+and jitter into a BitrateController. Bad reports cut the bitrate right away, it only creeps back
+up after several good reports in a row and reports in between the two thresholds leave it alone
+so the bitrate doesn't flap on a marginal wifi link.
+
+Run `python -m picam.bitrate` to watch the controller against a simulated link, see
+bin/simulate-lossy-link for degrading a real one.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+
+# loss as a fraction of packets, jitter in ms
+LOSS_HIGH = 0.05
+LOSS_LOW = 0.01
+JITTER_HIGH = 40.0
+JITTER_LOW = 15.0
+
+
+class BitrateController:
+    """
+    Args:
+        name: the mount the controller is for, used in the logs and metrics
+        bitrate: the starting bitrate in bit/s
+        min_bitrate: lowest bitrate to drop to
+        max_bitrate: highest bitrate to climb back to
+        decrease: factor the bitrate is multiplied by on a bad report
+        increase_step: fraction of max_bitrate added after enough good reports
+        increase_after: good reports in a row needed before increasing
+    """
+
+    def __init__(
+        self,
+        name,
+        bitrate,
+        min_bitrate,
+        max_bitrate,
+        decrease=0.75,
+        increase_step=0.05,
+        increase_after=3,
+    ):
+        self.name = name
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.bitrate = min(max(bitrate, min_bitrate), max_bitrate)
+        self.decrease = decrease
+        self.increase_step = increase_step
+        self.increase_after = increase_after
+        self.good_reports = 0
+        self.stats = {
+            'bitrate': self.bitrate,
+            'loss': 0.0,
+            'jitter': 0.0,
+            'reports': 0,
+            'increases': 0,
+            'decreases': 0,
+        }
+
+    def update(self, loss, jitter):
+        """
+        Takes the worst loss and jitter the receivers reported since the last update.
+
+        Returns:
+            the new bitrate in bit/s or None if it should stay the same
+        """
+        self.stats['reports'] += 1
+        self.stats['loss'] = loss
+        self.stats['jitter'] = jitter
+        bitrate = self.bitrate
+        reason = None
+        if loss > LOSS_HIGH or jitter > JITTER_HIGH:
+            self.good_reports = 0
+            bitrate = max(self.min_bitrate, int(self.bitrate * self.decrease))
+            reason = 'decrease'
+        elif loss < LOSS_LOW and jitter < JITTER_LOW:
+            self.good_reports += 1
+            if self.good_reports >= self.increase_after:
+                self.good_reports = 0
+                step = int(self.max_bitrate * self.increase_step)
+                bitrate = min(self.max_bitrate, self.bitrate + step)
+                reason = 'increase'
+        else:
+            # in between the thresholds, hold the current bitrate
+            self.good_reports = 0
+        if bitrate == self.bitrate:
+            return None
+        decision = {
+            'mount': self.name,
+            'from': self.bitrate,
+            'to': bitrate,
+            'loss': round(loss, 4),
+            'jitter': round(jitter, 2),
+        }
+        logging.info('bitrate %s %s', reason, json.dumps(decision))
+        self.stats['{}s'.format(reason)] += 1
+        self.stats['bitrate'] = bitrate
+        self.bitrate = bitrate
+        return bitrate
+
+
+# mount path -> BitrateController for the running streams
+controllers = {}
+controllers_lock = threading.Lock()
+
+
+def register(controller):
+    with controllers_lock:
+        controllers[controller.name] = controller
+
+
+def unregister(name):
+    with controllers_lock:
+        controllers.pop(name, None)
+
+
+def get_stats():
+    with controllers_lock:
+        return {name: dict(controller.stats) for name, controller in controllers.items()}
+
+
+def simulate(capacity, seconds=60, interval=1.0, realtime=False):
+    """
+    Runs a controller against a link which loses whatever is sent over its capacity.
+
+    Args:
+        capacity: function returning the link capacity in bit/s for a point in time
+    """
+    controller = BitrateController('simulation', 5000000, 1000000, 5000000)
+    for tick in range(int(seconds / interval)):
+        now = tick * interval
+        available = capacity(now)
+        overflow = max(0.0, controller.bitrate - available) / controller.bitrate
+        loss = min(1.0, overflow + random.uniform(0, 0.005))
+        jitter = 5.0 + 100.0 * overflow + random.uniform(0, 5)
+        controller.update(loss, jitter)
+        print(
+            '{:5.1f}s capacity {:>9} bitrate {:>9} loss {:.3f} jitter {:5.1f}'.format(
+                now,
+                int(available),
+                controller.bitrate,
+                loss,
+                jitter,
+            )
+        )
+        if realtime:
+            time.sleep(interval)
+    return controller.stats
+
+
+if __name__ == '__main__':
+    # the link drops to 2.5 Mbit/s for 20 seconds then recovers
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(simulate(lambda t: 2500000 if 15 <= t < 35 else 8000000), indent=2))
@@ -0,0 +1,64 @@
+"""
+Persistent cache for device capabilities which are expensive or impossible to probe while the
+device is busy streaming. Entries are grouped in sections (e.g. 'audio') and keyed by whatever
+identifies the hardware, so a different device plugged into the same port gets probed again.
+"""
+
+import logging
+import os
+import threading
+
+import yaml
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'picam-cache.yaml')
+
+
+class CapabilityCache:
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = None
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+        self._data = {}
+        try:
+            with open(self.path, 'r', encoding='UTF-8') as cache_file:
+                self._data = yaml.safe_load(cache_file) or {}
+        except FileNotFoundError:
+            pass
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception('failed to parse capability cache, starting over')
+        return self._data
+
+    def get(self, section, key):
+        with self._lock:
+            return self._load().get(section, {}).get(key)
+
+    def _save(self, data):
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='UTF-8') as cache_file:
+                yaml.safe_dump(data, cache_file, default_flow_style=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logging.exception('failed to write capability cache')
+
+    def set(self, section, key, value):
+        with self._lock:
+            data = self._load()
+            data.setdefault(section, {})[key] = value
+            self._save(data)
+
+    def delete(self, section, key=None):
+        with self._lock:
+            data = self._load()
+            if key is None:
+                data.pop(section, None)
+            else:
+                data.get(section, {}).pop(key, None)
+            self._save(data)
+
+
+capability_cache = CapabilityCache()
@@ -0,0 +1,170 @@
+"""
+Shares one capture of a camera between several renditions.
+
+A v4l2 device can only be opened once, so a device with renditions is captured by a pipeline of
+its own which splits the frames with a tee. Each rendition is a normal rtsp mount whose
+pipeline starts with an appsrc the frames are pushed into:
+
+    v4l2src ! caps ! tee ! valve ! leaky queue ! appsink  ->  appsrc ! leaky queue ! encoder ...
+                         \\ valve ! leaky queue ! appsink  ->  appsrc ! leaky queue ! encoder ...
+
+The leaky queues on both sides drop frames for a rendition which falls behind instead of
+stalling the capture or the other renditions. Each frame's timestamp is moved from the
+capture's running time to the rendition's, keeping how long ago it was captured, so a rendition
+started after the capture isn't offset by how long the capture has been running.
+
+The encoders only exist while a rendition's media is prepared, the valve of a rendition nobody
+is watching drops its frames straight away and the capture itself only runs while at least one
+rendition is being watched.
+"""
+
+import logging
+import threading
+
+import gi
+
+gi.require_version('Gst', '1.0')
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from gi.repository import Gst
+
+# the appsrc each rendition's pipeline starts with
+APPSRC_NAME = 'capsrc'
+BRANCH_QUEUE = 'queue max-size-buffers=2 max-size-time=0 max-size-bytes=0 leaky=downstream'
+
+
+def build_capture_launch(source, caps, branches):
+    """
+    Returns the launch line of the shared capture.
+
+    Args:
+        source: the source element(s) e.g. from encoders.build_video_source()
+        caps: the caps to capture with e.g. from encoders.build_capture_caps()
+        branches: a name for each rendition
+    """
+    launch = ['{} ! {} ! tee name=tee allow-not-linked=true'.format(source, caps)]
+    for branch in branches:
+        launch.append(
+            'tee. ! valve name=valve_{branch} drop=true ! {queue} ! appsink name=sink_{branch} '
+            'emit-signals=true sync=false max-buffers=1 drop=true'.format(
+                branch=branch,
+                queue=BRANCH_QUEUE,
+            )
+        )
+    return ' '.join(launch)
+
+
+def build_rendition_source(decode=''):
+    """the start of a rendition's pipeline, the encoding's pipeline goes after it"""
+    return 'appsrc name={} is-live=true format=time do-timestamp=true ! {} ! {}'.format(
+        APPSRC_NAME, BRANCH_QUEUE, decode
+    )
+
+
+def rebase_timestamp(pts, capture_pipeline, appsrc):
+    """
+    Converts a pts in the capture's running time into the running time of the rendition's
+    pipeline, or None when either isn't playing yet and appsrc should stamp it on arrival.
+    The two pipelines may run on different clocks, e.g. a rendition with audio runs on the
+    audio device's, so the frame's age is measured on one and carried over to the other.
+    """
+    capture_clock = capture_pipeline.get_clock()
+    clock = appsrc.get_clock()
+    if pts == Gst.CLOCK_TIME_NONE or capture_clock is None or clock is None:
+        return None
+    age = capture_clock.get_time() - (capture_pipeline.get_base_time() + pts)
+    running_time = clock.get_time() - appsrc.get_base_time() - max(age, 0)
+    if running_time < 0:
+        # captured before the rendition started
+        return None
+    return running_time
+
+
+class SharedCapture:
+    """
+    Runs the capture pipeline while any rendition is attached and forwards each branch's
+    frames to the appsrc of the rendition's media.
+    """
+
+    def __init__(self, name, launch):
+        self.name = name
+        self.launch = launch
+        self._lock = threading.Lock()
+        self._pipeline = None
+        self._consumers = {}
+
+    def _start(self):
+        pipeline = Gst.parse_launch(self.launch)
+        iterator = pipeline.iterate_sinks()
+        while True:
+            result, sink = iterator.next()
+            if result != Gst.IteratorResult.OK:
+                break
+            branch = sink.get_name()[len('sink_') :]
+            sink.connect('new-sample', self._on_sample, branch)
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message::error', self._on_error)
+        pipeline.set_state(Gst.State.PLAYING)
+        logging.info('started capture of %s', self.name)
+        return pipeline
+
+    def _stop(self):
+        self._pipeline.get_bus().remove_signal_watch()
+        self._pipeline.set_state(Gst.State.NULL)
+        self._pipeline = None
+        logging.info('stopped capture of %s', self.name)
+
+    def _on_sample(self, appsink, branch):
+        sample = appsink.emit('pull-sample')
+        appsrc = self._consumers.get(branch)
+        if appsrc is None or sample is None:
+            return Gst.FlowReturn.OK
+        # shares the memory, only the metadata is copied so the timestamps can be changed
+        buffer = sample.get_buffer().copy()
+        pts = rebase_timestamp(buffer.pts, appsink.get_parent(), appsrc)
+        buffer.pts = Gst.CLOCK_TIME_NONE if pts is None else pts
+        buffer.dts = Gst.CLOCK_TIME_NONE
+        appsrc.emit('push-sample', Gst.Sample.new(buffer, sample.get_caps(), None, None))
+        return Gst.FlowReturn.OK
+
+    def _on_error(self, _bus, message):
+        error, debug = message.parse_error()
+        logging.error('capture of %s failed: %s %s', self.name, error.message, debug or '')
+
+    def attach(self, branch, appsrc):
+        """starts feeding a rendition, opening the device for the first one"""
+        with self._lock:
+            if self._pipeline is None:
+                self._pipeline = self._start()
+            self._consumers[branch] = appsrc
+            valve = self._pipeline.get_by_name('valve_{}'.format(branch))
+            if valve is not None:
+                valve.set_property('drop', False)
+
+    def detach(self, branch):
+        """stops feeding a rendition, releasing the device once nothing is attached"""
+        with self._lock:
+            self._consumers.pop(branch, None)
+            if self._pipeline is None:
+                return
+            valve = self._pipeline.get_by_name('valve_{}'.format(branch))
+            if valve is not None:
+                valve.set_property('drop', True)
+            if not self._consumers:
+                self._stop()
+
+    def force_keyframe(self, branch, event):
+        """sends an upstream force-key-unit event from a branch to the capture's source"""
+        with self._lock:
+            if self._pipeline is None:
+                return
+            sink = self._pipeline.get_by_name('sink_{}'.format(branch))
+            if sink is not None:
+                sink.get_static_pad('sink').push_event(event)
+
+    def close(self):
+        with self._lock:
+            self._consumers.clear()
+            if self._pipeline is not None:
+                self._stop()
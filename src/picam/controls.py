@@ -0,0 +1,268 @@
+"""
+Applies a whole set of v4l2 controls to a device at once.
+
+The target state is ordered so auto modes are committed before the absolute values that depend
+on them, absolutes whose auto mode stays on are skipped, and each stage is written with a single
+VIDIOC_S_EXT_CTRLS. One readback afterwards reports what the driver clamped or rejected.
+"""
+
+import logging
+import os
+import threading
+
+from picam import v4l2
+from picam.writer import CoalescingWriter
+
+# absolute controls which can only be set while their auto mode is off, listing the auto
+# controls under their current and deprecated names with the values that mean manual
+CONTROL_DEPENDENCIES = {
+    'exposure_absolute': {
+        # manual and shutter priority both leave the exposure time to us
+        'auto_exposure': (1, 2),
+        'exposure_auto': (1, 2),
+    },
+    'exposure_time_absolute': {
+        'auto_exposure': (1, 2),
+        'exposure_auto': (1, 2),
+    },
+    'focus_absolute': {
+        'focus_auto': (0,),
+        'focus_automatic_continuous': (0,),
+    },
+    'white_balance_temperature': {
+        'white_balance_temperature_auto': (0,),
+        'white_balance_automatic': (0,),
+    },
+}
+
+AUTO_CONTROLS = {auto for deps in CONTROL_DEPENDENCIES.values() for auto in deps}
+
+
+def is_auto_control(name):
+    return name in AUTO_CONTROLS or name.endswith('_auto')
+
+
+def build_plan(snapshot, settings):
+    """
+    Works out the order the settings need to be written in.
+
+    Args:
+        snapshot: the device's v4l2.control_snapshot()
+        settings: the control values to apply e.g. {'exposure_auto': 1, 'exposure_absolute': 150}
+
+    Returns:
+        dict with the 'auto' and 'values' stages as lists of (ctrl, value) along with the
+        'skipped', 'rejected' and 'unknown' settings which won't be written
+    """
+    plan = {
+        'auto': [],
+        'values': [],
+        'skipped': {},
+        'rejected': {},
+        'unknown': [],
+    }
+    requested = {}
+    for name, value in settings.items():
+        if name not in snapshot:
+            plan['unknown'].append(name)
+            continue
+        if snapshot[name]['flags'] & v4l2.V4L2_CTRL_FLAG_READ_ONLY:
+            plan['rejected'][name] = 'read only'
+            continue
+        try:
+            requested[name] = int(value)
+        except (TypeError, ValueError):
+            plan['rejected'][name] = 'invalid value {}'.format(value)
+
+    # the state the device ends up in, used to check which auto modes will be on
+    target = {name: ctrl['value'] for name, ctrl in snapshot.items()}
+    target.update(requested)
+    for name, value in requested.items():
+        if is_auto_control(name):
+            plan['auto'].append((snapshot[name], value))
+            continue
+        auto_on = [
+            auto
+            for auto, manual_values in CONTROL_DEPENDENCIES.get(name, {}).items()
+            if auto in target and target[auto] not in manual_values
+        ]
+        if auto_on:
+            plan['skipped'][name] = '{} is on'.format(auto_on[0])
+            continue
+        plan['values'].append((snapshot[name], value))
+    return plan
+
+
+def _commit(fd, stage, report):
+    """writes a stage in one ioctl, retrying each control alone to find the ones which failed"""
+    if not stage:
+        return
+    report['ioctls'] += 1
+    try:
+        v4l2.set_controls(fd, stage)
+        return
+    except OSError:
+        pass
+    for ctrl, value in stage:
+        report['ioctls'] += 1
+        try:
+            v4l2.set_controls(fd, [(ctrl, value)])
+        except OSError as e:
+            report['rejected'][v4l2.name_to_var(ctrl['name'])] = e.strerror
+
+
+def apply_controls(device, settings):
+    """
+    Applies the settings to the device and verifies them.
+
+    Args:
+        device: the v4l2 device e.g. /dev/video0
+        settings: the control values from the device config
+
+    Returns:
+        dict of the 'applied' values, what the driver 'clamped' to a different value, the
+        settings 'rejected', 'skipped' because of an auto mode or 'unknown' to the device and
+        the number of 'ioctls' it took to write them
+
+    Raises:
+        OSError if the device can't be opened or queried
+    """
+    with v4l2.open_device(device) as fd:
+        plan = build_plan(v4l2.control_snapshot(fd), settings)
+        report = {
+            'applied': {},
+            'clamped': {},
+            'rejected': plan['rejected'],
+            'skipped': plan['skipped'],
+            'unknown': plan['unknown'],
+            'ioctls': 0,
+        }
+        _commit(fd, plan['auto'], report)
+        _commit(fd, plan['values'], report)
+        readback = v4l2.control_snapshot(fd)
+    v4l2.invalidate_control_snapshot(device)
+
+    for ctrl, value in plan['auto'] + plan['values']:
+        name = v4l2.name_to_var(ctrl['name'])
+        if name in report['rejected']:
+            continue
+        actual = readback.get(name, {}).get('value')
+        if actual is not None and actual != value:
+            report['clamped'][name] = {'requested': value, 'actual': actual}
+        else:
+            report['applied'][name] = value
+    return report
+
+
+def log_report(device, report):
+    logging.info(
+        'applied %d controls to %s with %d ioctls',
+        len(report['applied']),
+        device,
+        report['ioctls'],
+    )
+    for name, clamped in report['clamped'].items():
+        logging.warning(
+            '%s: %s clamped from %s to %s',
+            device,
+            name,
+            clamped['requested'],
+            clamped['actual'],
+        )
+    for name, reason in report['rejected'].items():
+        logging.warning('%s: %s rejected (%s)', device, name, reason)
+    for name, reason in report['skipped'].items():
+        logging.info('%s: %s skipped, %s', device, name, reason)
+    for name in report['unknown']:
+        logging.info('%s: %s is not supported by the device', device, name)
+
+
+class ControlWriter(CoalescingWriter):
+    """Applies live control changes to a video device through a long lived fd"""
+
+    def __init__(self, device, min_interval=0.05):
+        self._fd = None
+        self._snapshot = None
+        self.device = device
+        self._open()
+        super().__init__(device, min_interval)
+
+    def _open(self):
+        self._fd = os.open(self.device, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            self._snapshot = v4l2.control_snapshot(self._fd)
+        except OSError:
+            self._close_fd()
+            raise
+
+    def _close_fd(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def close(self):
+        super().close()
+        self._close_fd()
+
+    def on_error(self, error):
+        # most likely unplugged, reopen on the next write
+        self._close_fd()
+
+    def _refresh_auto_controls(self):
+        """
+        Re-reads the auto modes the absolute controls depend on, the rtsp server or the config
+        page may have changed them since the snapshot was taken.
+        """
+        autos = [ctrl for name, ctrl in self._snapshot.items() if name in AUTO_CONTROLS]
+        values = v4l2.get_controls(self._fd, autos)
+        for ctrl in autos:
+            ctrl['value'] = values.get(ctrl['id'], ctrl['value'])
+
+    def write(self, settings):
+        if self._fd is None:
+            self._open()
+        else:
+            self._refresh_auto_controls()
+        plan = build_plan(self._snapshot, settings)
+        report = {'rejected': plan['rejected'], 'ioctls': 0}
+        _commit(self._fd, plan['auto'], report)
+        _commit(self._fd, plan['values'], report)
+        written = [ctrl for ctrl, _ in plan['auto'] + plan['values']]
+        values = v4l2.get_controls(self._fd, written)
+        v4l2.invalidate_control_snapshot(self.device)
+        results = {}
+        for name in settings:
+            ctrl = self._snapshot.get(name)
+            actual = values.get(ctrl['id']) if ctrl else None
+            if actual is not None:
+                ctrl['value'] = actual
+            results[name] = {
+                'value': actual,
+                'skipped': plan['skipped'].get(name),
+                'rejected': report['rejected'].get(name),
+            }
+        return results
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_control_writer(device):
+    """
+    Returns the shared writer for the device, creating it on first use.
+
+    Raises:
+        OSError if the device can't be opened
+    """
+    with _writers_lock:
+        writer = _writers.get(device)
+        if writer is None:
+            writer = ControlWriter(device)
+            _writers[device] = writer
+        return writer
+
+
+def find_control_writer(device):
+    with _writers_lock:
+        return _writers.get(device)
@@ -2,9 +2,7 @@ from flask import current_app as app
 from flask import render_template
 from flask.views import MethodView
 
-from picam.audio import find_audio_devices
 from picam.utils import render_json
-from picam.video import find_video_devices
 from picam.wifi import get_hostname
 
 
@@ -12,7 +10,7 @@ def _load_video_devices():
     video_devices = []
     video_configs = app.picam_config.video_devices
     video_device_serials = {}
-    for video_device, device_info in find_video_devices().items():
+    for video_device, device_info in app.device_inventory.video_devices().items():
         serial = device_info['serial']
         video_device_serials.update({serial: serial})
         video_devices.append(
@@ -29,7 +27,7 @@ def _load_video_devices():
 def _load_audio_devices():
     audio_devices = []
     audio_configs = app.picam_config.audio_devices
-    for serial, device_info in find_audio_devices(with_rates=False).items():
+    for serial, device_info in app.device_inventory.audio_devices().items():
         audio_devices.append(
             {
                 'serial': serial,
@@ -68,3 +66,15 @@ class DevicesApiHander(MethodView):
                 'data': model,
             }
         )
+
+
+class DevicesRefreshApiHandler(MethodView):
+    """Exposes the device inventory cache stats and allows forcing a re-probe of the devices."""
+
+    def get(self):
+        return render_json({'status': 'ok', 'data': app.device_inventory.stats})
+
+    def post(self):
+        app.logger.info('refreshing device inventory')
+        app.device_inventory.invalidate()
+        return render_json({'status': 'ok', 'data': app.device_inventory.stats})
@@ -0,0 +1,184 @@
+"""
+Picks the encoding for devices configured with `encoding: auto`.
+
+Each candidate the device and board support is run for a few seconds in process, cheapest
+first, and the first one which sustains the configured framerate is used. The decision is kept
+in the capability cache under the device model, board, resolution and framerate so the trials
+only run the first time that combination is seen.
+"""
+
+import json
+import logging
+import threading
+import time
+from fractions import Fraction
+
+import gi
+
+from picam import encoders, sysfs
+from picam.capabilities import capability_cache
+
+gi.require_version('Gst', '1.0')
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from gi.repository import Gst
+
+TRIAL_WARMUP = 1.5
+TRIAL_DURATION = 3.0
+MIN_FPS_RATIO = 0.95
+# the device formats each encoding reads
+INPUT_FORMATS = {
+    encoding: profile['input_format'] for encoding, profile in encoders.ENCODER_PROFILES.items()
+}
+# used when nothing sustains the framerate or the device can't be trialled
+FALLBACK_ENCODING = 'jpegenc'
+# devices are set up concurrently on startup, a trial sharing the cpu with another device's
+# would measure less than the encoding can do and the result is cached for good
+_trial_lock = threading.Lock()
+
+
+def supports(video_options, pixel_format, resolution, framerate):
+    framerates = (video_options or {}).get(pixel_format, {}).get(resolution, [])
+    return str(framerate) in [str(f) for f in framerates]
+
+
+def candidates(video_options, resolution, framerate, uvch264=True):
+    """the encodings the device formats and installed elements allow, cheapest first"""
+    available = []
+    for encoding in encoders.AUTO_CANDIDATES:
+        profile = encoders.ENCODER_PROFILES[encoding]
+        if not supports(video_options, INPUT_FORMATS[encoding], resolution, framerate):
+            continue
+        elements = list(profile['elements'])
+        if encoding == 'h264' and uvch264:
+            elements.append('uvch264src')
+        if all(Gst.ElementFactory.find(element) for element in elements):
+            available.append(encoding)
+    return sorted(available, key=lambda e: encoders.ENCODER_PROFILES[e]['cost'])
+
+
+def run_trial(launch):
+    """
+    Runs the pipeline into a fakesink and counts the frames reaching the payloader.
+
+    Returns:
+        the achieved fps and the error if the pipeline failed
+    """
+    pipeline = Gst.parse_launch('{} ! fakesink sync=false'.format(launch))
+    frames = [0]
+
+    def on_frame(_pad, _info):
+        frames[0] += 1
+        return Gst.PadProbeReturn.OK
+
+    pipeline.get_by_name('pay0').get_static_pad('sink').add_probe(
+        Gst.PadProbeType.BUFFER,
+        on_frame,
+    )
+    try:
+        pipeline.set_state(Gst.State.PLAYING)
+        time.sleep(TRIAL_WARMUP)
+        start = frames[0]
+        started = time.monotonic()
+        time.sleep(TRIAL_DURATION)
+        fps = (frames[0] - start) / (time.monotonic() - started)
+        message = pipeline.get_bus().pop_filtered(Gst.MessageType.ERROR)
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+    error = None
+    if message is not None:
+        error = message.parse_error()[0].message
+    return round(fps, 2), error
+
+
+def log_decision(video_device, decision, cached):
+    details = dict(decision, device=video_device, cached=cached)
+    logging.info('encoder auto %s', json.dumps(details))
+
+
+def cache_key(model, resolution, framerate):
+    return '{}:{}:{}@{}'.format(model, sysfs.board_model(), resolution, framerate)
+
+
+def choose_encoding(
+    video_device,
+    model,
+    config_options,
+    video_options,
+    framerate,
+    uvch264=True,
+    mounted_encoding=None,
+):
+    """
+    Returns the encoding to stream the device with, trialling the candidates the first time.
+
+    Args:
+        video_device: the v4l2 device e.g. /dev/video0
+        model: identifies the kind of camera e.g. its usb id and product name
+        config_options: the device config, for the resolution, framerate and encoder overrides
+        video_options: the formats the device supports from video.probe_video_device()
+        framerate: the framerate caps e.g. 30/1
+        uvch264: False if the camera doesn't work with uvch264src
+        mounted_encoding: the encoding the device streams with now, used instead of trials
+            when nothing is cached as the running mount holds the device open
+    """
+    resolution = config_options.get('resolution', '1280x720')
+    framerate_option = config_options.get('framerate', 30)
+    key = cache_key(model, resolution, framerate_option)
+    decision = capability_cache.get('encoders', key)
+    if decision is None and mounted_encoding:
+        log_decision(video_device, {'encoding': mounted_encoding, 'mounted': True}, cached=False)
+        return mounted_encoding
+    if decision is None:
+        with _trial_lock:
+            # another camera of the same model may have been trialled while this one waited
+            decision = capability_cache.get('encoders', key)
+            if decision is None:
+                return run_trials(
+                    video_device, key, config_options, video_options, framerate, uvch264
+                )
+    log_decision(video_device, decision, cached=True)
+    return decision['encoding']
+
+
+def run_trials(video_device, key, config_options, video_options, framerate, uvch264):
+    """trials the candidates in turn, see choose_encoding()"""
+    resolution = config_options.get('resolution', '1280x720')
+    framerate_option = config_options.get('framerate', 30)
+    width, height = resolution.split('x')
+    target_fps = float(Fraction(framerate))
+    encoder_options = config_options.get('encoder', {})
+    trials = []
+    chosen = None
+    for encoding in candidates(video_options, resolution, framerate_option, uvch264):
+        launch = '{} ! {}'.format(
+            encoders.build_video_source(video_device, encoding, encoder_options, uvch264),
+            encoders.build_pipeline(encoding, width, height, framerate, encoder_options),
+        )
+        try:
+            fps, error = run_trial(launch)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            fps, error = 0.0, str(e)
+        trials.append({'encoding': encoding, 'fps': fps, 'error': error})
+        if error is None and fps >= target_fps * MIN_FPS_RATIO:
+            chosen = encoding
+            break
+
+    selected = chosen
+    if selected is None:
+        # nothing keeps up, go with whatever came closest
+        selected = FALLBACK_ENCODING
+        working = [trial for trial in trials if trial['error'] is None]
+        if working:
+            selected = max(working, key=lambda trial: trial['fps'])['encoding']
+    decision = {
+        'encoding': selected,
+        'sustained': chosen is not None,
+        'target_fps': round(target_fps, 2),
+        'trials': trials,
+    }
+    log_decision(video_device, decision, cached=False)
+    if chosen is not None:
+        # a failed decision is retried next time, e.g. when the device was busy
+        capability_cache.set('encoders', key, decision)
+    return decision['encoding']
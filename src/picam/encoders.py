@@ -0,0 +1,509 @@
+"""
+Registry of the video encodings the rtsp server can stream.
+
+Each profile declares the parameters it can be tuned with and their defaults. Any of them can be
+overridden per device in picam.yaml so the cpu / quality trade off can be made per camera:
+
+    video_devices:
+        SERIAL:
+            encoding: x264enc
+            encoder:
+                bitrate: 4000
+                preset: ultrafast
+                output_size: 1280x720
+"""
+
+import logging
+from fractions import Fraction
+
+# parameters shared by the profiles that run a software or hardware encoder
+#   output_size: scale to WIDTHxHEIGHT before encoding, None keeps the capture size
+#   queue_size: buffers queued in front of the encoder, 0 leaves the queue out
+#   leaky: which buffers the queue drops when the encoder falls behind, 'no' blocks instead
+#   gop: seconds between keyframes, None leaves it to the encoder
+#   adaptive_bitrate: follow the link quality the clients report, see picam.bitrate
+#   min_bitrate / max_bitrate: bounds for the adaptive bitrate in the encoder's bitrate unit,
+#       None for a quarter of and exactly the configured bitrate
+
+
+def _keyframe_interval(framerate, gop):
+    return max(1, round(float(Fraction(framerate)) * gop))
+
+
+def _scale(params):
+    if not params.get('output_size'):
+        return ''
+    width, height = params['output_size'].split('x')
+    return '! videoscale ! video/x-raw,width={},height={} '.format(width, height)
+
+
+def _queue(params):
+    if not params.get('queue_size'):
+        return ''
+    return '! queue max-size-buffers={} max-size-time=0 max-size-bytes=0 leaky={} '.format(
+        params['queue_size'],
+        params['leaky'],
+    )
+
+
+def _h264_pipeline(width, height, framerate, params):
+    return (
+        "video/x-h264,width={width},height={height},framerate={framerate},profile={profile} "
+        "! h264parse config-interval={config_interval} "
+        "! rtph264pay name=pay0 pt=96 "
+    ).format(
+        width=width,
+        height=height,
+        framerate=framerate,
+        profile=params['profile'],
+        config_interval=params['config_interval'],
+    )
+
+
+def _mjpeg_pipeline(width, height, framerate, params):
+    queue = '! queue leaky={} '.format(params['leaky'])
+    if params['queue_size']:
+        queue = _queue(params)
+    return (
+        "image/jpeg,width={width},height={height},framerate={framerate} "
+        "{queue}"
+        "! jpegparse "
+        "! rtpjpegpay name=pay0 pt=26 "
+    ).format(
+        width=width,
+        height=height,
+        framerate=framerate,
+        queue=queue,
+    )
+
+
+def _jpegenc_pipeline(width, height, framerate, params):
+    return (
+        "video/x-raw,width={width},height={height},framerate={framerate} "
+        "{scale}"
+        "{queue}"
+        "! jpegenc quality={quality} "
+        "! rtpjpegpay name=pay0 pt=96"
+    ).format(
+        width=width,
+        height=height,
+        framerate=framerate,
+        scale=_scale(params),
+        queue=_queue(params),
+        quality=params['quality'],
+    )
+
+
+def _x264enc_pipeline(width, height, framerate, params):
+    keyframes = ''
+    if params['gop']:
+        keyframes = 'key-int-max={} '.format(_keyframe_interval(framerate, params['gop']))
+    return (
+        "video/x-raw,width={width},height={height},framerate={framerate} "
+        "{scale}"
+        "! videoconvert ! video/x-raw,format=I420 "
+        "{queue}"
+        "! x264enc name=enc0 bitrate={bitrate} speed-preset={preset} tune={tune} threads={threads} "
+        "{keyframes}"
+        "! video/x-h264,profile={profile} "
+        "! h264parse config-interval={config_interval} "
+        "! rtph264pay name=pay0 pt=96 "
+    ).format(
+        width=width,
+        height=height,
+        framerate=framerate,
+        scale=_scale(params),
+        queue=_queue(params),
+        bitrate=params['bitrate'],
+        preset=params['preset'],
+        tune=params['tune'],
+        threads=params['threads'],
+        keyframes=keyframes,
+        profile=params['profile'],
+        config_interval=params['config_interval'],
+    )
+
+
+def _vp8enc_pipeline(width, height, framerate, params):
+    keyframes = ''
+    if params['gop']:
+        keyframes = 'keyframe-max-dist={} '.format(_keyframe_interval(framerate, params['gop']))
+    return (
+        "video/x-raw,width={width},height={height},framerate={framerate} "
+        "{scale}"
+        "! videoconvert ! video/x-raw,format=I420 "
+        "{queue}"
+        "! vp8enc name=enc0 end-usage=cbr deadline={deadline} threads={threads} {keyframes}"
+        "target-bitrate={bitrate} "
+        "! rtpvp8pay name=pay0 pt=96 "
+    ).format(
+        width=width,
+        height=height,
+        framerate=framerate,
+        scale=_scale(params),
+        queue=_queue(params),
+        deadline=params['deadline'],
+        threads=params['threads'],
+        keyframes=keyframes,
+        bitrate=params['bitrate'],
+    )
+
+
+def build_hardware_input(params):
+    """
+    Returns (conversion, encoder io options) feeding raw video to a v4l2 mem2mem encoder.
+
+    With zero_copy the frames stay in dmabufs from v4l2src (io-mode=4 exports them) through
+    v4l2convert, which scales and converts them in hardware, into the encoder which imports
+    them, instead of videoscale and videoconvert writing each frame out again in software.
+    """
+    if params.get('zero_copy'):
+        size = ''
+        if params.get('output_size'):
+            size = ',width={},height={}'.format(*params['output_size'].split('x'))
+        conversion = (
+            '! v4l2convert output-io-mode=dmabuf-import capture-io-mode=dmabuf '
+            '! video/x-raw,format=I420{} '.format(size)
+        )
+        return conversion, 'output-io-mode=dmabuf-import '
+    return '{}! videoconvert ! video/x-raw,format=I420 '.format(_scale(params)), ''
+
+
+def _v4l2h264enc_pipeline(width, height, framerate, params):
+    extra_controls = [
+        'h264_level={}'.format(params['level']),
+        'h264_profile={}'.format(params['profile']),
+        'video_bitrate={}'.format(params['bitrate']),
+    ]
+    if params['gop']:
+        extra_controls.append(
+            'h264_i_frame_period={}'.format(_keyframe_interval(framerate, params['gop']))
+        )
+    conversion, io_mode = build_hardware_input(params)
+    return (
+        "video/x-raw,width={width},height={height},framerate={framerate} "
+        "{conversion}"
+        "{queue}"
+        "! v4l2h264enc name=enc0 {io_mode}extra-controls=encode,{extra_controls} "
+        "! h264parse config-interval={config_interval} "
+        "! rtph264pay name=pay0 pt=96 "
+    ).format(
+        width=width,
+        height=height,
+        framerate=framerate,
+        conversion=conversion,
+        queue=_queue(params),
+        io_mode=io_mode,
+        extra_controls=','.join(extra_controls),
+        config_interval=params['config_interval'],
+    )
+
+
+ENCODER_PROFILES = {
+    'h264': {
+        'description': 'h264 from the camera',
+        'input_format': 'H264',
+        'parameters': {
+            # bit/s, only used by uvch264src, other cameras keep their own settings
+            'bitrate': 5000000,
+            'iframe_period': 2000,
+            'profile': 'main',
+            'config_interval': 1,
+            # the range the adaptive bitrate stays in, in the same unit as bitrate
+            'adaptive_bitrate': False,
+            'min_bitrate': None,
+            'max_bitrate': None,
+        },
+        'pipeline': _h264_pipeline,
+        'elements': ('h264parse', 'rtph264pay'),
+        'cost': 0,
+        'bitrate_control': {'element': 'src0', 'property': 'average-bitrate', 'unit': 1},
+    },
+    'mjpeg': {
+        'description': 'mjpeg from the camera',
+        'input_format': 'MJPG',
+        'parameters': {
+            'queue_size': 0,
+            'leaky': 'downstream',
+        },
+        'pipeline': _mjpeg_pipeline,
+        'elements': ('jpegparse', 'rtpjpegpay'),
+        'cost': 1,
+    },
+    'jpegenc': {
+        'description': 'software mjpeg',
+        'input_format': 'YUYV',
+        'parameters': {
+            'quality': 85,
+            # scale video down to get enough performance out of the software encoder
+            'output_size': '1280x720',
+            'queue_size': 2,
+            'leaky': 'downstream',
+        },
+        'pipeline': _jpegenc_pipeline,
+        'elements': ('jpegenc', 'rtpjpegpay'),
+        'cost': 3,
+    },
+    'x264enc': {
+        'description': 'software h264',
+        'input_format': 'YUYV',
+        'parameters': {
+            # kbit/s
+            'bitrate': 5600,
+            'preset': 'superfast',
+            'tune': 'zerolatency',
+            'threads': 0,
+            'gop': 2.0,
+            'profile': 'high',
+            'config_interval': 2,
+            'output_size': None,
+            'queue_size': 4,
+            'leaky': 'downstream',
+            # the range the adaptive bitrate stays in, in the same unit as bitrate
+            'adaptive_bitrate': False,
+            'min_bitrate': None,
+            'max_bitrate': None,
+        },
+        'pipeline': _x264enc_pipeline,
+        'elements': ('x264enc', 'h264parse', 'rtph264pay'),
+        'cost': 4,
+        'bitrate_control': {'element': 'enc0', 'property': 'bitrate', 'unit': 1000},
+    },
+    'vp8enc': {
+        'description': 'software vp8',
+        'input_format': 'YUYV',
+        'parameters': {
+            # bit/s
+            'bitrate': 4000000,
+            'deadline': 1,
+            'threads': 8,
+            'gop': 2.0,
+            'output_size': '1024x576',
+            'queue_size': 0,
+            'leaky': 'downstream',
+            # the range the adaptive bitrate stays in, in the same unit as bitrate
+            'adaptive_bitrate': False,
+            'min_bitrate': None,
+            'max_bitrate': None,
+        },
+        'pipeline': _vp8enc_pipeline,
+        'elements': ('vp8enc', 'rtpvp8pay'),
+        'cost': 5,
+        'bitrate_control': {'element': 'enc0', 'property': 'target-bitrate', 'unit': 1},
+    },
+    'v4l2h264enc': {
+        'description': 'hardware h264 on the pi',
+        'input_format': 'YUYV',
+        'parameters': {
+            # bit/s
+            'bitrate': 10000000,
+            # V4L2_MPEG_VIDEO_H264_LEVEL_4_2 and V4L2_MPEG_VIDEO_H264_PROFILE_HIGH
+            'level': 13,
+            'profile': 4,
+            'gop': None,
+            'config_interval': 2,
+            'output_size': '1280x720',
+            'queue_size': 0,
+            'leaky': 'downstream',
+            # the range the adaptive bitrate stays in, in the same unit as bitrate
+            'adaptive_bitrate': False,
+            'min_bitrate': None,
+            'max_bitrate': None,
+            # dmabufs from the camera to the encoder with v4l2convert, see build_hardware_input()
+            'zero_copy': False,
+        },
+        'pipeline': _v4l2h264enc_pipeline,
+        'elements': ('v4l2h264enc', 'h264parse', 'rtph264pay'),
+        'zero_copy_elements': ('v4l2convert',),
+        'cost': 2,
+        # changed at runtime through the encoder's extra-controls
+        'bitrate_control': {'element': 'enc0', 'extra_control': 'video_bitrate', 'unit': 1},
+    },
+}
+
+LEAKY_VALUES = ('no', 'upstream', 'downstream')
+# what a quoted boolean override can be spelled as
+TRUE_VALUES = ('true', 'yes', 'on', '1')
+FALSE_VALUES = ('false', 'no', 'off', '0')
+
+# caps of each device format when one capture is shared by several renditions
+CAPTURE_CAPS = {
+    'H264': 'video/x-h264,width={width},height={height},framerate={framerate}',
+    'MJPG': 'image/jpeg,width={width},height={height},framerate={framerate}',
+    'YUYV': 'video/x-raw,format=YUY2,width={width},height={height},framerate={framerate}',
+}
+# turns a compressed capture back into raw video for the renditions with their own encoder
+CAPTURE_DECODERS = {
+    'H264': 'h264parse ! avdec_h264',
+    'MJPG': 'jpegdec',
+}
+
+# lets the rtsp server measure which encoding the device and board can sustain, see
+# picam.encoder_trial
+AUTO = 'auto'
+# the encodings `auto` picks from, cheapest first
+AUTO_CANDIDATES = ('h264', 'mjpeg', 'v4l2h264enc', 'jpegenc', 'x264enc')
+
+
+def _parse_bool(name, value):
+    if isinstance(value, (bool, int, float)):
+        return bool(value)
+    if isinstance(value, str):
+        if value.strip().lower() in TRUE_VALUES:
+            return True
+        if value.strip().lower() in FALSE_VALUES:
+            return False
+    raise ValueError('invalid value {!r} for {}, expected true or false'.format(value, name))
+
+
+def _parse_number(value):
+    """int or float from a quoted number, anything else e.g. an output_size is left alone"""
+    if not isinstance(value, str):
+        return value
+    for number_type in (int, float):
+        try:
+            return number_type(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _coerce(name, value, default):
+    """converts an override to the type of the default, yaml may have quoted it"""
+    if value is None or isinstance(default, str):
+        return value
+    if isinstance(default, bool):
+        return _parse_bool(name, value)
+    if default is None:
+        # optional parameters like gop or min_bitrate are numbers when they're set
+        return _parse_number(value)
+    try:
+        return type(default)(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError('invalid value {!r} for {}'.format(value, name)) from e
+
+
+def get_parameters(encoding, overrides=None):
+    """
+    Merges the per device overrides onto the encoding's defaults.
+
+    Unknown or invalid overrides are logged and ignored so a typo in picam.yaml doesn't take
+    the stream down.
+
+    Raises:
+        KeyError if the encoding isn't in the registry
+    """
+    defaults = ENCODER_PROFILES[encoding]['parameters']
+    params = dict(defaults)
+    for name, value in (overrides or {}).items():
+        if name not in defaults:
+            logging.warning('%s does not support the %s parameter', encoding, name)
+            continue
+        try:
+            value = _coerce(name, value, defaults[name])
+        except ValueError as e:
+            logging.warning('%s: %s', encoding, e)
+            continue
+        if name == 'leaky' and value not in LEAKY_VALUES:
+            logging.warning('%s: leaky must be one of %s', encoding, ', '.join(LEAKY_VALUES))
+            continue
+        if name == 'output_size' and value and len(str(value).split('x')) != 2:
+            logging.warning('%s: output_size must be WIDTHxHEIGHT', encoding)
+            continue
+        params[name] = value
+    return params
+
+
+def build_video_source(video_device, encoding, overrides=None, uvch264=True):
+    """
+    Returns the source element for the device, uvch264src gets better control over the iframe
+    period of cameras with h264 than v4l2src's default which is way too many seconds.
+
+    Args:
+        uvch264: False for cameras like the kiyos which don't support the module
+    """
+    if encoding == 'h264' and uvch264:
+        params = get_parameters(encoding, overrides)
+        return (
+            'uvch264src device={device} initial-bitrate={bitrate} average-bitrate={bitrate} '
+            'auto-start=true iframe-period={iframe_period} name=src0 fixed-framerate=true '
+            'src0.vidsrc'
+        ).format(
+            device=video_device,
+            bitrate=params['bitrate'],
+            iframe_period=params['iframe_period'],
+        )
+    return 'v4l2src device={} io-mode=4 do-timestamp=1'.format(video_device)
+
+
+def build_capture_caps(encoding, width, height, framerate, overrides=None):
+    """the caps the device is captured with for the encoding, see build_rendition_input()"""
+    caps = CAPTURE_CAPS[ENCODER_PROFILES[encoding]['input_format']].format(
+        width=width,
+        height=height,
+        framerate=framerate,
+    )
+    if encoding == 'h264':
+        # uvch264src picks the profile from its downstream caps
+        caps += ',profile={}'.format(get_parameters(encoding, overrides)['profile'])
+    return caps
+
+
+def build_rendition_input(capture_encoding, encoding):
+    """
+    Returns what has to go between a capture made for capture_encoding and the pipeline of
+    another rendition of it, '' if the rendition can take the capture as it is or None if it
+    can't be made from it e.g. mjpeg from the camera's h264.
+    """
+    capture_format = ENCODER_PROFILES[capture_encoding]['input_format']
+    input_format = ENCODER_PROFILES[encoding]['input_format']
+    if input_format == capture_format:
+        return ''
+    if input_format == 'YUYV':
+        return '{} ! '.format(CAPTURE_DECODERS[capture_format])
+    return None
+
+
+def build_pipeline(encoding, width, height, framerate, overrides=None):
+    """
+    Returns the part of the launch line from the capture caps up to the payloader.
+
+    Args:
+        encoding: one of ENCODER_PROFILES
+        width: capture width
+        height: capture height
+        framerate: capture framerate as a fraction e.g. 30/1
+        overrides: the device's encoder parameters from picam.yaml
+    """
+    params = get_parameters(encoding, overrides)
+    return ENCODER_PROFILES[encoding]['pipeline'](width, height, framerate, params)
+
+
+def get_bitrate_control(encoding, overrides=None):
+    """
+    Returns how to adjust the encoder's bitrate at runtime with the bounds in bit/s, or None
+    if adaptive bitrate isn't enabled or supported for the encoding.
+    """
+    profile = ENCODER_PROFILES.get(encoding, {})
+    if 'bitrate_control' not in profile:
+        return None
+    params = get_parameters(encoding, overrides)
+    if not params['adaptive_bitrate']:
+        return None
+    unit = profile['bitrate_control']['unit']
+    bitrate = params['bitrate'] * unit
+    min_bitrate = bitrate // 4
+    if params['min_bitrate']:
+        min_bitrate = int(params['min_bitrate']) * unit
+    max_bitrate = bitrate
+    if params['max_bitrate']:
+        max_bitrate = int(params['max_bitrate']) * unit
+    control = dict(profile['bitrate_control'])
+    control.update(
+        {
+            'bitrate': bitrate,
+            'min_bitrate': min_bitrate,
+            'max_bitrate': max_bitrate,
+        }
+    )
+    return control
@@ -0,0 +1,179 @@
+"""
+Pushes dashboard state to browsers as server-sent events.
+
+A single publisher thread polls the configured devices while anyone is listening and publishes
+only what changed, so every connected browser costs one long lived connection instead of
+repeatedly reloading the page and probing the devices.
+"""
+
+import itertools
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+
+from picam import v4l2
+
+RTSP_PORT = 8554
+
+
+class EventBus:
+    """Fans events out to subscriber queues, dropping the oldest events for slow subscribers"""
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event_type, data):
+        event = {'id': next(self._ids), 'type': event_type, 'data': data}
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+        return event
+
+
+event_bus = EventBus()
+
+
+def format_sse(event):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event['id'],
+        event['type'],
+        json.dumps(event['data']),
+    )
+
+
+def rtsp_server_up(port=RTSP_PORT):
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+class DashboardPublisher:
+    """
+    Polls the control values, recording levels and rtsp server health of the configured devices
+    and publishes the changes on the event bus.
+
+    Args:
+        app: the flask app, used for the config and device inventory
+        read_levels: function returning {card_idx: level} for a list of alsa card indexes
+        interval: seconds between polls of the controls and levels
+        health_interval: seconds between rtsp server health checks
+    """
+
+    def __init__(self, app, read_levels, bus=event_bus, interval=0.5, health_interval=5.0):
+        self.app = app
+        self.read_levels = read_levels
+        self.bus = bus
+        self.interval = interval
+        self.health_interval = health_interval
+        self.state = {'controls': {}, 'audio_levels': {}, 'stream_health': {}}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def current_state(self):
+        with self._lock:
+            return json.loads(json.dumps(self.state))
+
+    def ensure_running(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='dashboard-events', daemon=True)
+            self._thread.start()
+
+    def _has_subscribers(self):
+        """
+        Checked under the same lock as ensure_running() so a browser subscribing while the thread
+        is about to exit gets a new thread instead of one which has already stopped.
+        """
+        with self._lock:
+            if self.bus.subscriber_count():
+                return True
+            self._thread = None
+            return False
+
+    def _run(self):
+        last_health = 0.0
+        while self._has_subscribers():
+            try:
+                self.poll_controls()
+                self.poll_audio_levels()
+                if time.monotonic() - last_health >= self.health_interval:
+                    self.poll_stream_health()
+                    last_health = time.monotonic()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception('failed polling dashboard state')
+            time.sleep(self.interval)
+
+    def _publish_changes(self, section, key, values, event_type):
+        with self._lock:
+            previous = self.state[section].get(key, {})
+            changed = {k: v for k, v in values.items() if previous.get(k) != v}
+            self.state[section][key] = values
+        if changed:
+            self.bus.publish(event_type, {'serial': key, 'values': changed})
+
+    def poll_controls(self):
+        video_configs = self.app.picam_config.video_devices
+        for video_device, device_info in self.app.device_inventory.video_devices().items():
+            serial = device_info['serial']
+            if serial not in video_configs:
+                continue
+            try:
+                snapshot = v4l2.get_control_snapshot(video_device, max_age=self.interval / 2)
+            except OSError:
+                continue
+            values = {name: ctrl['value'] for name, ctrl in snapshot.items()}
+            self._publish_changes('controls', serial, values, 'controls')
+
+    def poll_audio_levels(self):
+        audio_configs = self.app.picam_config.audio_devices
+        devices = {
+            serial: device_info
+            for serial, device_info in self.app.device_inventory.audio_devices().items()
+            if serial in audio_configs
+        }
+        levels = self.read_levels([device_info['alsa_idx'] for device_info in devices.values()])
+        for serial, device_info in devices.items():
+            level = levels.get(str(device_info['alsa_idx']))
+            if level is None:
+                continue
+            self._publish_changes('audio_levels', serial, {'rec_level': level}, 'audio-level')
+
+    def poll_stream_health(self):
+        self._publish_changes(
+            'stream_health',
+            'rtsp',
+            {'up': rtsp_server_up(), 'port': RTSP_PORT},
+            'stream-health',
+        )
@@ -1,9 +1,13 @@
+import queue
+
+from flask import Response
 from flask import current_app as app
 from flask import render_template
 from flask.views import MethodView
 
-from picam.audio import find_audio_devices
-from picam.video import find_video_devices, get_device_settings
+from picam.audio import get_current_recording_level
+from picam.events import event_bus, format_sse
+from picam.video import CONTROL_SNAPSHOT_TTL, get_device_settings
 
 
 class IndexHandler(MethodView):
@@ -12,9 +16,9 @@ class IndexHandler(MethodView):
     def get(self):
         video_devices = {}
         video_configs = app.picam_config.video_devices
-        for video_device, device_info in find_video_devices().items():
+        for video_device, device_info in app.device_inventory.video_devices().items():
             serial = device_info['serial']
-            device_settings = get_device_settings(video_device)
+            device_settings = get_device_settings(video_device, max_age=CONTROL_SNAPSHOT_TTL)
             if serial in video_configs.keys():
                 camera_path = video_configs[serial]['endpoint']
                 device_settings.update(
@@ -29,7 +33,7 @@ class IndexHandler(MethodView):
 
         audio_devices = {}
         audio_configs = app.picam_config.audio_devices
-        for serial, device_info in find_audio_devices().items():
+        for serial, device_info in app.device_inventory.audio_devices().items():
             if serial in audio_configs.keys():
                 audio_path = audio_configs[serial]['endpoint']
                 device_settings = {
@@ -37,7 +41,7 @@ class IndexHandler(MethodView):
                     'alsa_idx': device_info['alsa_idx'],
                     'description': device_info['description'],
                     'device_config': audio_configs.get(serial, {}),
-                    'rec_level': device_info['rec_level'],
+                    'rec_level': get_current_recording_level(device_info['alsa_idx']),
                 }
                 audio_devices.update({serial: device_settings})
 
@@ -48,3 +52,44 @@ class IndexHandler(MethodView):
         }
 
         return render_template('index.html', **model)
+
+
+# comment sent to keep proxies from closing idle event streams
+KEEPALIVE_INTERVAL = 15
+
+
+class DashboardEventsHandler(MethodView):
+    """
+    Streams dashboard state as server-sent events. The current state is sent first, followed by
+    'controls', 'control-ack', 'audio-level' and 'stream-health' events as things change.
+    Control changes are still posted to the device apis and acknowledged on this stream.
+    """
+
+    def get(self):
+        publisher = app.dashboard_publisher
+        subscriber = event_bus.subscribe()
+        publisher.ensure_running()
+        initial_state = {'id': 0, 'type': 'state', 'data': publisher.current_state()}
+
+        def stream():
+            try:
+                yield 'retry: 2000\n\n'
+                yield format_sse(initial_state)
+                while True:
+                    try:
+                        event = subscriber.get(timeout=KEEPALIVE_INTERVAL)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    yield format_sse(event)
+            finally:
+                event_bus.unsubscribe(subscriber)
+
+        return Response(
+            stream(),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no',
+            },
+        )
@@ -0,0 +1,224 @@
+"""
+Process-wide cache of the attached video and audio devices.
+
+Probing every device is expensive and the attached hardware rarely changes, so the results are
+kept until the kernel tells us something was plugged in or removed. Changes are picked up from
+inotify events in /dev and /dev/snd as well as kernel uevents on the netlink socket udev listens
+to. If neither is available the cache can always be dropped through the refresh endpoint.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from picam.audio import find_audio_devices
+from picam.video import find_video_devices
+
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+NETLINK_KOBJECT_UEVENT = 15
+
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+VIDEO = 'video'
+AUDIO = 'audio'
+
+
+class _Inotify:
+    """Minimal inotify binding, only what's needed to watch a few directories"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_watch(self, path, mask=IN_WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        self.watches[wd] = path
+        return wd
+
+    def read_events(self):
+        """returns (directory, name, mask) for each queued event"""
+        events = []
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset + _INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = data[offset : offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            events.append((self.watches.get(wd, ''), name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _open_uevent_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+    # group 1 receives the kernel events, udev itself rebroadcasts on group 2. Port id 0 lets
+    # the kernel pick a free one, the pid may already be taken by another netlink socket
+    sock.bind((0, 1))
+    sock.setblocking(False)
+    return sock
+
+
+def _uevent_subsystem(data):
+    for field in data.split(b'\0'):
+        if field.startswith(b'SUBSYSTEM='):
+            return field.split(b'=', 1)[1].decode(errors='replace')
+    return None
+
+
+class DeviceInventory:
+    """
+    Caches the results of find_video_devices() and find_audio_devices() until a hotplug event
+    invalidates them. The returned dicts are shared between requests so treat them as read only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        # bumped by invalidate() so a probe which raced a hotplug event isn't cached
+        self._generation = 0
+        self._watcher = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'refreshes': {},
+            'watching': [],
+        }
+
+    def video_devices(self):
+        return self._get(VIDEO, find_video_devices)
+
+    def audio_devices(self, with_rates=False):
+        if with_rates:
+            return self._get((AUDIO, 'rates'), lambda: find_audio_devices(with_rates=True))
+        return self._get(AUDIO, find_audio_devices)
+
+    def _get(self, key, probe):
+        """
+        Probes outside the lock so cache hits and invalidations don't wait for it, two requests
+        missing at the same time both probe and the last one is kept.
+        """
+        self._start_watcher()
+        with self._lock:
+            if key in self._entries:
+                self.stats['hits'] += 1
+                return self._entries[key]
+            self.stats['misses'] += 1
+            generation = self._generation
+        start = time.monotonic()
+        devices = probe()
+        elapsed = time.monotonic() - start
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = devices
+            name = key if isinstance(key, str) else '-'.join(key)
+            refresh = self.stats['refreshes'].setdefault(
+                name, {'count': 0, 'last_seconds': 0.0, 'total_seconds': 0.0}
+            )
+            refresh['count'] += 1
+            refresh['last_seconds'] = round(elapsed, 4)
+            refresh['total_seconds'] = round(refresh['total_seconds'] + elapsed, 4)
+            logging.info('probed %s devices in %.3fs', name, elapsed)
+            return devices
+
+    def invalidate(self, kind=None):
+        """Drops the cached devices of the given kind, or everything when kind is None"""
+        with self._lock:
+            for key in list(self._entries.keys()):
+                key_kind = key if isinstance(key, str) else key[0]
+                if kind is None or key_kind == kind:
+                    del self._entries[key]
+            self._generation += 1
+            self.stats['invalidations'] += 1
+
+    def _start_watcher(self):
+        if self._watcher is not None:
+            return
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(
+                target=self._watch,
+                name='device-inventory-watcher',
+                daemon=True,
+            )
+            self._watcher.start()
+
+    def _watch(self):
+        inotify = None
+        uevents = None
+        try:
+            inotify = _Inotify()
+            for path in ('/dev', '/dev/snd', '/dev/snd/by-id'):
+                if os.path.isdir(path):
+                    inotify.add_watch(path)
+            with self._lock:
+                self.stats['watching'].append('inotify')
+        except (OSError, AttributeError, TypeError):
+            logging.warning('inotify unavailable, devices changes will not be detected')
+            inotify = None
+        try:
+            uevents = _open_uevent_socket()
+            with self._lock:
+                self.stats['watching'].append('uevent')
+        except (OSError, AttributeError):
+            logging.warning('uevent socket unavailable, devices changes will not be detected')
+            uevents = None
+
+        fds = [f for f in (inotify.fd if inotify else None, uevents) if f is not None]
+        while fds:
+            readable, _, _ = select.select(fds, [], [])
+            if uevents is not None and uevents in readable:
+                self._handle_uevents(uevents)
+            if inotify is not None and inotify.fd in readable:
+                self._handle_inotify(inotify)
+
+    def _handle_uevents(self, sock):
+        while True:
+            try:
+                data = sock.recv(8192)
+            except BlockingIOError:
+                return
+            subsystem = _uevent_subsystem(data)
+            if subsystem == 'video4linux':
+                self.invalidate(VIDEO)
+            elif subsystem == 'sound':
+                self.invalidate(AUDIO)
+
+    def _handle_inotify(self, inotify):
+        for directory, name, mask in inotify.read_events():
+            if directory == '/dev' and name.startswith('video'):
+                self.invalidate(VIDEO)
+            elif directory.startswith('/dev/snd'):
+                if directory == '/dev/snd' and name == 'by-id' and mask & IN_CREATE:
+                    # created when the first usb audio device is plugged in
+                    try:
+                        inotify.add_watch('/dev/snd/by-id')
+                    except OSError:
+                        logging.warning('unable to watch /dev/snd/by-id')
+                self.invalidate(AUDIO)
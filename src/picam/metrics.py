@@ -0,0 +1,169 @@
+"""
+Prometheus style metrics served from the rtsp server process.
+
+Pad probes only bump plain counters held by Sample objects so the streaming threads never take
+a lock, everything else (client counts, per client stats) is collected when /metrics is
+scraped. Scrape it with e.g. `curl http://picam.local:9101/metrics`.
+"""
+
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = 9101
+
+METRIC_TYPES = {}
+METRIC_HELP = {}
+
+
+def describe(name, metric_type, help_text):
+    METRIC_TYPES[name] = metric_type
+    METRIC_HELP[name] = help_text
+
+
+describe('picam_buffers_total', 'counter', 'Buffers out of the sources, encoder and payloader')
+describe('picam_queue_drops_total', 'counter', 'Buffers dropped by leaky queues')
+describe('picam_encoder_latency_seconds', 'summary', 'Time buffers spend in the encoder')
+describe('picam_output_bytes_total', 'counter', 'RTP bytes produced by the payloader')
+describe('picam_output_packets_total', 'counter', 'RTP packets produced by the payloader')
+describe('picam_keyframes_total', 'counter', 'Keyframes sent to the payloader')
+describe('picam_keyframe_interval_seconds', 'gauge', 'Time between the last two keyframes')
+describe('picam_bus_messages_total', 'counter', 'Errors, warnings and qos messages per pipeline')
+describe('picam_clients', 'gauge', 'RTSP sessions connected to each mount')
+describe('picam_clients_refused_total', 'counter', 'Sessions refused by the max_clients of a mount')
+describe('picam_client_bytes_sent_total', 'counter', 'Bytes sent to each udp client')
+describe('picam_client_packets_sent_total', 'counter', 'Packets sent to each udp client')
+describe('picam_rtx_requests_total', 'counter', 'Packets clients asked to be resent with a NACK')
+describe('picam_rtx_packets_total', 'counter', 'Packets resent through the RTX stream')
+describe('picam_adaptive_bitrate', 'gauge', 'Bitrate in bit/s chosen by the adaptive bitrate')
+describe('picam_adaptive_bitrate_changes_total', 'counter', 'Adaptive bitrate changes')
+describe(
+    'picam_keyframe_requests_total',
+    'counter',
+    'Keyframes asked for joining clients, sent or limited by keyframe_min_interval',
+)
+describe(
+    'picam_time_to_first_frame_seconds',
+    'summary',
+    'Time from a client asking for a mount to the first keyframe sent to it',
+)
+
+
+class Sample:
+    """A single labelled value, updated directly by whoever owns it"""
+
+    __slots__ = ('name', 'labels', 'value')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._collectors = []
+        # set once /metrics is served, nothing is instrumented otherwise
+        self.enabled = False
+
+    def sample(self, name, **labels):
+        """Returns the sample for the name and labels, creating it at 0 the first time"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            sample = self._samples.get(key)
+            if sample is None:
+                sample = Sample(name, labels)
+                self._samples[key] = sample
+            return sample
+
+    def remove(self, **labels):
+        """Drops every sample matching the labels e.g. when a mount's media goes away"""
+        with self._lock:
+            for key, sample in list(self._samples.items()):
+                if all(sample.labels.get(k) == v for k, v in labels.items()):
+                    del self._samples[key]
+
+    def add_collector(self, collector):
+        """
+        Adds a function called on every scrape returning a list of (name, labels, value) for
+        values which are cheaper to read on demand than to keep up to date.
+        """
+        self._collectors.append(collector)
+
+    def collect(self):
+        with self._lock:
+            samples = [(s.name, s.labels, s.value) for s in self._samples.values()]
+        for collector in self._collectors:
+            try:
+                samples.extend(collector())
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception('metrics collector failed')
+        return samples
+
+    def render(self):
+        families = {}
+        for name, labels, value in self.collect():
+            families.setdefault(metric_family(name), []).append((name, labels, value))
+        lines = []
+        for family in sorted(families):
+            if family in METRIC_TYPES:
+                lines.append('# HELP {} {}'.format(family, METRIC_HELP[family]))
+                lines.append('# TYPE {} {}'.format(family, METRIC_TYPES[family]))
+            for name, labels, value in sorted(families[family], key=lambda s: s[0]):
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def metric_family(name):
+    """summaries are written as NAME_sum and NAME_count"""
+    for suffix in ('_sum', '_count'):
+        if name.endswith(suffix) and name[: -len(suffix)] in METRIC_TYPES:
+            return name[: -len(suffix)]
+    return name
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(key, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+registry = MetricsRegistry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        # scrapes every few seconds would flood the journal
+        pass
+
+
+def serve(port=METRICS_PORT, address=''):
+    """Serves /metrics from a daemon thread, returns the server or None if the port is taken"""
+    try:
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+    except OSError as e:
+        logging.warning('unable to serve metrics on port %s: %s', port, e)
+        return None
+    server.daemon_threads = True
+    registry.enabled = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logging.info('serving metrics on port %s', port)
+    return server
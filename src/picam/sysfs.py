@@ -0,0 +1,176 @@
+"""
+Resolves the USB details (serial, vendor/product ids, product name) of video and sound devices
+by walking sysfs once, instead of asking udevadm about each device node.
+"""
+
+import glob
+import logging
+import os
+import platform
+import re
+
+SYSFS_VIDEO = '/sys/class/video4linux'
+SYSFS_SOUND = '/sys/class/sound'
+DEVICE_TREE_MODEL = '/proc/device-tree/model'
+
+# Devices which need special handling, keyed by USB vendor:product id. Devices which don't report
+# a serial number are assigned a fixed one, so only one of each model can be configured at a time.
+# 'match' catches other hardware revisions of the same model by their product name, the more
+# specific names need to come first.
+#   serial: the serial to use when the device doesn't report one
+#   v4l2_options: overrides merged into the control ranges reported by the driver
+#   persistent_controls: the device keeps its controls so they aren't preset on startup
+#   uvch264: the device supports the uvch264src element
+DEVICE_QUIRKS = {
+    '0fd9:0066': {
+        'serial': 'CAMLINK',
+        'match': 'Cam Link',
+    },
+    '1532:0e0a': {
+        'serial': 'KIYOPROULTRA',
+        'match': 'Kiyo Pro Ultra',
+        'v4l2_options': {
+            'exposure_time_absolute': {'min': 10, 'max': 156},
+            # psuedo properties for exp_shutter speed and exp_iso handled by cameractrls
+            'exp_shutter': {'default': 30},
+            'exp_iso': {'default': 400},
+        },
+        'persistent_controls': True,
+        'uvch264': False,
+    },
+    '1532:0e05': {
+        'serial': 'KIYOPRO',
+        'match': 'Kiyo Pro',
+        'v4l2_options': {
+            'exposure_time_absolute': {'min': 10, 'max': 156},
+        },
+        'persistent_controls': True,
+        'uvch264': False,
+    },
+    '0d8c:0005': {
+        'serial': 'SNOWBALL',
+        'match': 'Snowball',
+    },
+}
+
+
+def available():
+    return os.path.isdir(SYSFS_VIDEO) or os.path.isdir(SYSFS_SOUND)
+
+
+def find_quirks(usb_id=None, product=''):
+    """Looks up the quirks for a device by its vendor:product id then by its product name"""
+    if usb_id in DEVICE_QUIRKS:
+        return DEVICE_QUIRKS[usb_id]
+    for quirks in DEVICE_QUIRKS.values():
+        if product and quirks['match'] in product:
+            return quirks
+    return {}
+
+
+def quirks_for_serial(serial):
+    for quirks in DEVICE_QUIRKS.values():
+        if quirks['serial'] == serial:
+            return quirks
+    return {}
+
+
+def sanitize_serial(value):
+    """Replicates how udev builds ID_SERIAL_SHORT out of the usb serial attribute"""
+    value = re.sub(r'\s+', '_', value.strip())
+    return re.sub(r'[^0-9A-Za-z#+\-.:=@_]', '_', value)
+
+
+def _read_attr(path, name):
+    try:
+        with open(os.path.join(path, name), 'r', encoding='UTF-8', errors='replace') as attr:
+            return attr.read().strip()
+    except OSError:
+        return ''
+
+
+def _usb_parent(path):
+    """walks up from a class device to the usb device it belongs to"""
+    try:
+        current = os.path.realpath(os.path.join(path, 'device'))
+    except OSError:
+        return None
+    while current.startswith('/sys/devices') and current != '/sys/devices':
+        if os.path.exists(os.path.join(current, 'idVendor')):
+            return current
+        current = os.path.dirname(current)
+    return None
+
+
+def _usb_info(class_path):
+    usb_path = _usb_parent(class_path)
+    if usb_path is None:
+        return None
+    vendor_id = _read_attr(usb_path, 'idVendor')
+    product_id = _read_attr(usb_path, 'idProduct')
+    usb_id = '{}:{}'.format(vendor_id, product_id)
+    product = _read_attr(usb_path, 'product')
+    return {
+        'serial': sanitize_serial(_read_attr(usb_path, 'serial')),
+        'vendor_id': vendor_id,
+        'product_id': product_id,
+        'usb_id': usb_id,
+        'product': product,
+        'manufacturer': _read_attr(usb_path, 'manufacturer'),
+        'usb_path': usb_path,
+        'quirks': find_quirks(usb_id, product),
+    }
+
+
+def _index(name):
+    m = re.search(r'(\d+)$', name)
+    return int(m.group(1)) if m else 0
+
+
+def resolve_video_devices():
+    """
+    Returns a mapping of /dev/videoN to the usb details of the device it belongs to,
+    non usb devices like the pi camera module are left out.
+    """
+    devices = {}
+    for class_path in sorted(glob.glob(f'{SYSFS_VIDEO}/video*'), key=_index):
+        info = _usb_info(class_path)
+        if info is not None:
+            devices['/dev/{}'.format(os.path.basename(class_path))] = info
+    return devices
+
+
+def resolve_sound_cards():
+    """Returns a mapping of the alsa card index (as a string) to the usb details of the card"""
+    cards = {}
+    for class_path in sorted(glob.glob(f'{SYSFS_SOUND}/card*'), key=_index):
+        info = _usb_info(class_path)
+        if info is not None:
+            card_idx = str(_index(class_path))
+            info['card_idx'] = card_idx
+            info['card_id'] = _read_attr(class_path, 'id')
+            cards[card_idx] = info
+    return cards
+
+
+def resolve_devices():
+    """Resolves every usb video and sound device in one pass"""
+    devices = {
+        'video': resolve_video_devices(),
+        'sound': resolve_sound_cards(),
+    }
+    logging.debug(
+        'resolved %d video and %d sound devices from sysfs',
+        len(devices['video']),
+        len(devices['sound']),
+    )
+    return devices
+
+
+def board_model():
+    """the board e.g. 'Raspberry Pi 4 Model B Rev 1.4', or the cpu architecture on other boards"""
+    try:
+        with open(DEVICE_TREE_MODEL, 'r', encoding='UTF-8', errors='replace') as model:
+            return model.read().strip('\x00\n')
+    except OSError:
+        return platform.machine()
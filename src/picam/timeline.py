@@ -0,0 +1,54 @@
+"""
+Records how long each step of bringing up the rtsp server takes so slow devices stand out.
+Every step is logged as a json line when it finishes, and the whole timeline once at the end.
+The same timeline is used for config reloads, logged under their own name.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupTimeline:
+    def __init__(self, name='startup'):
+        self.name = name
+        self.started = time.monotonic()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, device, stage, start, end, **details):
+        event = {
+            'device': device,
+            'stage': stage,
+            'start': round(start - self.started, 3),
+            'duration': round(end - start, 3),
+            'thread': threading.current_thread().name,
+        }
+        event.update(details)
+        with self._lock:
+            self.events.append(event)
+        logging.info('%s %s', self.name, json.dumps(event))
+
+    @contextmanager
+    def stage(self, device, stage, **details):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(device, stage, start, time.monotonic(), **details)
+
+    def mark(self, device, stage, **details):
+        now = time.monotonic()
+        self.record(device, stage, now, now, **details)
+
+    def report(self):
+        with self._lock:
+            events = sorted(self.events, key=lambda e: e['start'])
+        timeline = {
+            'total': round(time.monotonic() - self.started, 3),
+            'events': events,
+        }
+        logging.info('%s timeline %s', self.name, json.dumps(timeline))
+        return timeline
@@ -0,0 +1,627 @@
+"""
+In-process access to V4L2 devices through ioctls.
+
+Mirrors what picam previously scraped out of `v4l2-ctl` so device listings don't need a
+fork/exec per device. The structures follow include/uapi/linux/videodev2.h.
+
+To compare against v4l2-ctl on a machine without cameras, load the virtual driver with
+`sudo modprobe vivid` and run `python3 -m picam.v4l2` from the src directory.
+"""
+
+import ctypes
+import errno
+import fcntl
+import glob
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# ioctl request encoding, see include/uapi/asm-generic/ioctl.h
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+
+def _ioc(direction, nr, struct):
+    return (direction << 30) | (ctypes.sizeof(struct) << 16) | (ord('V') << 8) | nr
+
+
+def _ior(nr, struct):
+    return _ioc(_IOC_READ, nr, struct)
+
+
+def _iowr(nr, struct):
+    return _ioc(_IOC_READ | _IOC_WRITE, nr, struct)
+
+
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+
+V4L2_FRMSIZE_TYPE_DISCRETE = 1
+V4L2_FRMIVAL_TYPE_DISCRETE = 1
+
+V4L2_CTRL_FLAG_DISABLED = 0x0001
+V4L2_CTRL_FLAG_READ_ONLY = 0x0004
+V4L2_CTRL_FLAG_WRITE_ONLY = 0x0040
+V4L2_CTRL_FLAG_NEXT_CTRL = 0x80000000
+V4L2_CTRL_FLAG_NEXT_COMPOUND = 0x40000000
+
+V4L2_CTRL_TYPE_INTEGER = 1
+V4L2_CTRL_TYPE_BOOLEAN = 2
+V4L2_CTRL_TYPE_MENU = 3
+V4L2_CTRL_TYPE_BUTTON = 4
+V4L2_CTRL_TYPE_INTEGER64 = 5
+V4L2_CTRL_TYPE_CTRL_CLASS = 6
+V4L2_CTRL_TYPE_BITMASK = 8
+V4L2_CTRL_TYPE_INTEGER_MENU = 9
+
+# control types which carry a plain integer value
+VALUE_CTRL_TYPES = (
+    V4L2_CTRL_TYPE_INTEGER,
+    V4L2_CTRL_TYPE_BOOLEAN,
+    V4L2_CTRL_TYPE_MENU,
+    V4L2_CTRL_TYPE_INTEGER64,
+    V4L2_CTRL_TYPE_BITMASK,
+    V4L2_CTRL_TYPE_INTEGER_MENU,
+)
+
+V4L2_CTRL_WHICH_CUR_VAL = 0
+
+# only the pixel formats the web ui knows how to configure
+PIXEL_FORMATS = ('YUYV', 'MJPG', 'H264', 'NV12')
+
+
+class v4l2_capability(ctypes.Structure):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('driver', ctypes.c_char * 16),
+        ('card', ctypes.c_char * 32),
+        ('bus_info', ctypes.c_char * 32),
+        ('version', ctypes.c_uint32),
+        ('capabilities', ctypes.c_uint32),
+        ('device_caps', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 3),
+    ]
+
+
+class v4l2_fmtdesc(ctypes.Structure):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('index', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('description', ctypes.c_char * 32),
+        ('pixelformat', ctypes.c_uint32),
+        ('mbus_code', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 3),
+    ]
+
+
+class v4l2_frmsize_discrete(ctypes.Structure):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('width', ctypes.c_uint32),
+        ('height', ctypes.c_uint32),
+    ]
+
+
+class v4l2_frmsize_stepwise(ctypes.Structure):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('min_width', ctypes.c_uint32),
+        ('max_width', ctypes.c_uint32),
+        ('step_width', ctypes.c_uint32),
+        ('min_height', ctypes.c_uint32),
+        ('max_height', ctypes.c_uint32),
+        ('step_height', ctypes.c_uint32),
+    ]
+
+
+class _frmsize_union(ctypes.Union):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('discrete', v4l2_frmsize_discrete),
+        ('stepwise', v4l2_frmsize_stepwise),
+    ]
+
+
+class v4l2_frmsizeenum(ctypes.Structure):  # pylint: disable=invalid-name
+    _anonymous_ = ('u',)
+    _fields_ = [
+        ('index', ctypes.c_uint32),
+        ('pixel_format', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('u', _frmsize_union),
+        ('reserved', ctypes.c_uint32 * 2),
+    ]
+
+
+class v4l2_fract(ctypes.Structure):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('numerator', ctypes.c_uint32),
+        ('denominator', ctypes.c_uint32),
+    ]
+
+
+class v4l2_frmival_stepwise(ctypes.Structure):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('min', v4l2_fract),
+        ('max', v4l2_fract),
+        ('step', v4l2_fract),
+    ]
+
+
+class _frmival_union(ctypes.Union):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('discrete', v4l2_fract),
+        ('stepwise', v4l2_frmival_stepwise),
+    ]
+
+
+class v4l2_frmivalenum(ctypes.Structure):  # pylint: disable=invalid-name
+    _anonymous_ = ('u',)
+    _fields_ = [
+        ('index', ctypes.c_uint32),
+        ('pixel_format', ctypes.c_uint32),
+        ('width', ctypes.c_uint32),
+        ('height', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('u', _frmival_union),
+        ('reserved', ctypes.c_uint32 * 2),
+    ]
+
+
+class v4l2_query_ext_ctrl(ctypes.Structure):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('id', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('name', ctypes.c_char * 32),
+        ('minimum', ctypes.c_int64),
+        ('maximum', ctypes.c_int64),
+        ('step', ctypes.c_uint64),
+        ('default_value', ctypes.c_int64),
+        ('flags', ctypes.c_uint32),
+        ('elem_size', ctypes.c_uint32),
+        ('elems', ctypes.c_uint32),
+        ('nr_of_dims', ctypes.c_uint32),
+        ('dims', ctypes.c_uint32 * 4),
+        ('reserved', ctypes.c_uint32 * 32),
+    ]
+
+
+class _ext_control_union(ctypes.Union):  # pylint: disable=invalid-name
+    _pack_ = 1
+    _fields_ = [
+        ('value', ctypes.c_int32),
+        ('value64', ctypes.c_int64),
+        ('ptr', ctypes.c_void_p),
+    ]
+
+
+class v4l2_ext_control(ctypes.Structure):  # pylint: disable=invalid-name
+    _pack_ = 1
+    _anonymous_ = ('u',)
+    _fields_ = [
+        ('id', ctypes.c_uint32),
+        ('size', ctypes.c_uint32),
+        ('reserved2', ctypes.c_uint32 * 1),
+        ('u', _ext_control_union),
+    ]
+
+
+class v4l2_ext_controls(ctypes.Structure):  # pylint: disable=invalid-name
+    _fields_ = [
+        ('which', ctypes.c_uint32),
+        ('count', ctypes.c_uint32),
+        ('error_idx', ctypes.c_uint32),
+        ('request_fd', ctypes.c_int32),
+        ('reserved', ctypes.c_uint32 * 1),
+        ('controls', ctypes.POINTER(v4l2_ext_control)),
+    ]
+
+
+VIDIOC_QUERYCAP = _ior(0, v4l2_capability)
+VIDIOC_ENUM_FMT = _iowr(2, v4l2_fmtdesc)
+VIDIOC_G_EXT_CTRLS = _iowr(71, v4l2_ext_controls)
+VIDIOC_S_EXT_CTRLS = _iowr(72, v4l2_ext_controls)
+VIDIOC_ENUM_FRAMESIZES = _iowr(74, v4l2_frmsizeenum)
+VIDIOC_ENUM_FRAMEINTERVALS = _iowr(75, v4l2_frmivalenum)
+VIDIOC_QUERY_EXT_CTRL = _iowr(103, v4l2_query_ext_ctrl)
+
+
+def available():
+    """
+    True if the kernel answers VIDIOC_QUERYCAP with the structures defined here, tried on the
+    video nodes until one of them can be opened. Nodes which are busy or gone don't count
+    against it and a system without any has nothing to enumerate either way.
+    """
+    for device in sorted(glob.glob('/dev/video*'), key=_device_sort_key):
+        try:
+            with open_device(device) as fd:
+                query_capabilities(fd)
+            return True
+        except OSError as e:
+            if e.errno in (errno.ENOTTY, errno.EINVAL):
+                logging.info('%s does not understand VIDIOC_QUERYCAP', device)
+                return False
+    return os.path.isdir('/dev')
+
+
+def fourcc_to_str(fourcc):
+    return ''.join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4))
+
+
+def name_to_var(name):
+    """
+    Converts a control name to the identifier v4l2-ctl uses for it,
+    e.g. 'White Balance Temperature, Auto' -> 'white_balance_temperature_auto'
+    """
+    var = ''
+    add_underscore = False
+    for char in name:
+        if char.isalnum():
+            if add_underscore:
+                var += '_'
+            add_underscore = False
+            var += char.lower()
+        elif var:
+            add_underscore = True
+    return var
+
+
+def _ioctl(fd, request, arg):
+    """ioctl which retries on EINTR like the v4l2 utils do"""
+    while True:
+        try:
+            return fcntl.ioctl(fd, request, arg)
+        except InterruptedError:
+            continue
+
+
+@contextmanager
+def open_device(device):
+    fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def query_capabilities(fd):
+    cap = v4l2_capability()
+    _ioctl(fd, VIDIOC_QUERYCAP, cap)
+    device_caps = cap.device_caps
+    if not cap.capabilities & V4L2_CAP_DEVICE_CAPS:
+        device_caps = cap.capabilities
+    return {
+        'driver': cap.driver.decode(errors='replace'),
+        'card': cap.card.decode(errors='replace'),
+        'bus_info': cap.bus_info.decode(errors='replace'),
+        'capabilities': cap.capabilities,
+        'device_caps': device_caps,
+    }
+
+
+def _format_fps(interval):
+    """formats framerates the same way find_resolutions() used to parse them"""
+    if not interval.numerator:
+        return None
+    framerate_str = '{:.3f}'.format(interval.denominator / interval.numerator)
+    if framerate_str == '59.940':
+        return framerate_str
+    return int(float(framerate_str))
+
+
+def enum_frameintervals(fd, pixel_format, width, height):
+    framerates = []
+    frmival = v4l2_frmivalenum(pixel_format=pixel_format, width=width, height=height)
+    while True:
+        try:
+            _ioctl(fd, VIDIOC_ENUM_FRAMEINTERVALS, frmival)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            break
+        if frmival.type == V4L2_FRMIVAL_TYPE_DISCRETE:
+            framerate = _format_fps(frmival.discrete)
+        else:
+            # continuous and stepwise ranges, advertise the fastest rate
+            framerate = _format_fps(frmival.stepwise.min)
+        if framerate is not None and framerate not in framerates:
+            framerates.append(framerate)
+        if frmival.type != V4L2_FRMIVAL_TYPE_DISCRETE:
+            break
+        frmival.index += 1  # pylint: disable=no-member
+    return framerates
+
+
+def enum_framesizes(fd, pixel_format):
+    sizes = []
+    frmsize = v4l2_frmsizeenum(pixel_format=pixel_format)
+    while True:
+        try:
+            _ioctl(fd, VIDIOC_ENUM_FRAMESIZES, frmsize)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            break
+        if frmsize.type == V4L2_FRMSIZE_TYPE_DISCRETE:
+            sizes.append((frmsize.discrete.width, frmsize.discrete.height))
+        else:
+            # continuous and stepwise ranges only report their bounds
+            stepwise = frmsize.stepwise
+            sizes.append((stepwise.min_width, stepwise.min_height))
+            sizes.append((stepwise.max_width, stepwise.max_height))
+            break
+        frmsize.index += 1  # pylint: disable=no-member
+    return sizes
+
+
+def enum_formats(fd):
+    formats = []
+    fmtdesc = v4l2_fmtdesc(type=V4L2_BUF_TYPE_VIDEO_CAPTURE)
+    while True:
+        try:
+            _ioctl(fd, VIDIOC_ENUM_FMT, fmtdesc)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            break
+        formats.append(fmtdesc.pixelformat)
+        fmtdesc.index += 1  # pylint: disable=no-member
+    return formats
+
+
+def find_resolutions(fd):
+    """
+    Builds the same structure as video.find_resolutions() e.g.
+    {'MJPG': {'1920x1080': [30, 24], ...}, ...}
+    """
+    options = {}
+    for pixel_format in enum_formats(fd):
+        format_name = fourcc_to_str(pixel_format)
+        if format_name not in PIXEL_FORMATS:
+            continue
+        resolutions = {}
+        for width, height in enum_framesizes(fd, pixel_format):
+            resolutions['{}x{}'.format(width, height)] = enum_frameintervals(
+                fd, pixel_format, width, height
+            )
+        options[format_name] = resolutions
+    return options
+
+
+def query_controls(fd):
+    """Walks every control on the device, skipping disabled ones"""
+    controls = []
+    ctrl_id = V4L2_CTRL_FLAG_NEXT_CTRL | V4L2_CTRL_FLAG_NEXT_COMPOUND
+    while True:
+        qctrl = v4l2_query_ext_ctrl(id=ctrl_id)
+        try:
+            _ioctl(fd, VIDIOC_QUERY_EXT_CTRL, qctrl)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            break
+        ctrl_id = qctrl.id  # pylint: disable=no-member
+        if not qctrl.flags & V4L2_CTRL_FLAG_DISABLED:
+            controls.append(
+                {
+                    'id': ctrl_id,
+                    'type': qctrl.type,
+                    'name': qctrl.name.decode(errors='replace'),
+                    'minimum': qctrl.minimum,
+                    'maximum': qctrl.maximum,
+                    'step': qctrl.step,
+                    'default': qctrl.default_value,
+                    'flags': qctrl.flags,
+                }
+            )
+        ctrl_id |= V4L2_CTRL_FLAG_NEXT_CTRL | V4L2_CTRL_FLAG_NEXT_COMPOUND
+    return controls
+
+
+def get_control(fd, ctrl_id, ctrl_type=V4L2_CTRL_TYPE_INTEGER):
+    ctrl = v4l2_ext_control(id=ctrl_id)
+    ext_ctrls = v4l2_ext_controls(
+        which=V4L2_CTRL_WHICH_CUR_VAL, count=1, controls=ctypes.pointer(ctrl)
+    )
+    _ioctl(fd, VIDIOC_G_EXT_CTRLS, ext_ctrls)
+    return ctrl.value64 if ctrl_type == V4L2_CTRL_TYPE_INTEGER64 else ctrl.value
+
+
+def control_class(ctrl_id):
+    return ctrl_id & 0x0FFF0000
+
+
+def _readable(ctrl):
+    return ctrl['type'] in VALUE_CTRL_TYPES and not ctrl['flags'] & V4L2_CTRL_FLAG_WRITE_ONLY
+
+
+def get_controls(fd, controls):
+    """
+    Reads the current value of each control with a single VIDIOC_G_EXT_CTRLS per control class,
+    returning a dict of control id to value. Controls which can't be read are left out.
+    """
+    by_class = {}
+    for ctrl in controls:
+        if _readable(ctrl):
+            by_class.setdefault(control_class(ctrl['id']), []).append(ctrl)
+    values = {}
+    for ctrl_class, class_ctrls in by_class.items():
+        ext_ctrl_array = (v4l2_ext_control * len(class_ctrls))()
+        for idx, ctrl in enumerate(class_ctrls):
+            ext_ctrl_array[idx].id = ctrl['id']
+        ext_ctrls = v4l2_ext_controls(
+            which=ctrl_class,
+            count=len(class_ctrls),
+            controls=ctypes.cast(ext_ctrl_array, ctypes.POINTER(v4l2_ext_control)),
+        )
+        try:
+            _ioctl(fd, VIDIOC_G_EXT_CTRLS, ext_ctrls)
+        except OSError:
+            # one inactive or busy control fails the whole batch, read them one by one instead
+            for ctrl in class_ctrls:
+                try:
+                    values[ctrl['id']] = get_control(fd, ctrl['id'], ctrl['type'])
+                except OSError:
+                    logging.debug('unable to read control %s', ctrl['name'])
+            continue
+        for idx, ctrl in enumerate(class_ctrls):
+            ext_ctrl = ext_ctrl_array[idx]
+            if ctrl['type'] == V4L2_CTRL_TYPE_INTEGER64:
+                values[ctrl['id']] = ext_ctrl.value64
+            else:
+                values[ctrl['id']] = ext_ctrl.value
+    return values
+
+
+def set_controls(fd, values):
+    """
+    Sets several controls with a single VIDIOC_S_EXT_CTRLS, controls of different classes can be
+    mixed. Drivers may have applied some of the controls when this fails.
+
+    Args:
+        fd: the open device
+        values: list of (ctrl, value) tuples with ctrl as returned by query_controls()
+    """
+    if not values:
+        return
+    ext_ctrl_array = (v4l2_ext_control * len(values))()
+    for idx, (ctrl, value) in enumerate(values):
+        ext_ctrl_array[idx].id = ctrl['id']
+        if ctrl['type'] == V4L2_CTRL_TYPE_INTEGER64:
+            ext_ctrl_array[idx].value64 = value
+        else:
+            ext_ctrl_array[idx].value = value
+    ext_ctrls = v4l2_ext_controls(
+        which=V4L2_CTRL_WHICH_CUR_VAL,
+        count=len(values),
+        controls=ctypes.cast(ext_ctrl_array, ctypes.POINTER(v4l2_ext_control)),
+    )
+    _ioctl(fd, VIDIOC_S_EXT_CTRLS, ext_ctrls)
+
+
+def control_snapshot(fd):
+    """
+    Reads the metadata and current value of every control in one pass, keyed by the v4l2-ctl
+    style name e.g. {'brightness': {'id': ..., 'minimum': 0, 'maximum': 255, 'value': 128, ...}}
+    """
+    controls = [c for c in query_controls(fd) if c['type'] != V4L2_CTRL_TYPE_CTRL_CLASS]
+    values = get_controls(fd, controls)
+    snapshot = {}
+    for ctrl in controls:
+        ctrl['value'] = values.get(ctrl['id'])
+        snapshot[name_to_var(ctrl['name'])] = ctrl
+    return snapshot
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_control_snapshot(device, max_age=0):
+    """
+    Returns control_snapshot() for the device, reusing one taken within the last max_age seconds
+    so pollers don't hit the device more than needed.
+    """
+    if max_age:
+        with _snapshots_lock:
+            cached = _snapshots.get(device)
+        if cached is not None and time.monotonic() - cached[0] <= max_age:
+            return cached[1]
+    with open_device(device) as fd:
+        snapshot = control_snapshot(fd)
+    with _snapshots_lock:
+        _snapshots[device] = (time.monotonic(), snapshot)
+    return snapshot
+
+
+def invalidate_control_snapshot(device=None):
+    with _snapshots_lock:
+        if device is None:
+            _snapshots.clear()
+        else:
+            _snapshots.pop(device, None)
+
+
+def get_v4l2_settings(fd):
+    """
+    Builds the same structure as video.get_v4l2_settings() which only reports the fields
+    v4l2-ctl prints for each control type, as strings.
+    """
+    v4l2_settings = {}
+    for name, ctrl in control_snapshot(fd).items():
+        settings = {
+            'min': None,
+            'max': None,
+            'step': None,
+            'default': None,
+            'value': None,
+        }
+        if ctrl['type'] in (V4L2_CTRL_TYPE_INTEGER, V4L2_CTRL_TYPE_INTEGER64):
+            settings.update(
+                {
+                    'min': str(ctrl['minimum']),
+                    'max': str(ctrl['maximum']),
+                    'step': str(ctrl['step']),
+                    'default': str(ctrl['default']),
+                }
+            )
+        elif ctrl['type'] in (V4L2_CTRL_TYPE_MENU, V4L2_CTRL_TYPE_INTEGER_MENU):
+            settings.update(
+                {
+                    'min': str(ctrl['minimum']),
+                    'max': str(ctrl['maximum']),
+                    'default': str(ctrl['default']),
+                }
+            )
+        elif ctrl['type'] in (V4L2_CTRL_TYPE_BOOLEAN, V4L2_CTRL_TYPE_BITMASK):
+            settings['default'] = str(ctrl['default'])
+        if ctrl['value'] is not None:
+            settings['value'] = str(ctrl['value'])
+        v4l2_settings[name] = settings
+    return v4l2_settings
+
+
+def _device_sort_key(device):
+    m = re.search(r'(\d+)$', device)
+    return int(m.group(1)) if m else 0
+
+
+def list_devices():
+    """
+    Groups the /dev/video nodes by the physical device they belong to, the same way
+    `v4l2-ctl --list-devices` does, returning (description, [nodes]) tuples where the
+    description matches the v4l2-ctl heading e.g. 'HD Pro Webcam C920 (usb-0000:01:00.0-1.2):'
+    """
+    groups = {}
+    for device in sorted(glob.glob('/dev/video*'), key=_device_sort_key):
+        try:
+            with open_device(device) as fd:
+                cap = query_capabilities(fd)
+        except OSError:
+            logging.debug('unable to query %s', device)
+            continue
+        key = (cap['card'], cap['bus_info'])
+        groups.setdefault(key, []).append((device, cap))
+    devices = []
+    for (card, bus_info), nodes in groups.items():
+        # prefer the node which can actually capture, uvc metadata nodes can't
+        nodes.sort(key=lambda node: not node[1]['device_caps'] & V4L2_CAP_VIDEO_CAPTURE)
+        devices.append(('{} ({}):'.format(card, bus_info), [node for node, _ in nodes]))
+    return devices
+
+
+def probe_device(device):
+    """Returns (v4l2_options, video_options) for a single /dev/video node"""
+    with open_device(device) as fd:
+        return get_v4l2_settings(fd), find_resolutions(fd)
+
+
+if __name__ == '__main__':
+    import json
+
+    for description, device_nodes in list_devices():
+        v4l2_options, video_options = probe_device(device_nodes[0])
+        print(description, device_nodes[0])
+        print(json.dumps({'v4l2_options': v4l2_options, 'video_options': video_options}, indent=2))
@@ -1,3 +1,4 @@
+import errno
 import logging
 import re
 import subprocess
@@ -6,6 +7,7 @@ from flask import current_app as app
 from flask import redirect, render_template, request
 from flask.views import MethodView
 
+from picam import controls, encoders, sysfs, v4l2
 from picam.utils import render_json
 
 
@@ -58,6 +60,7 @@ def adjust_video_setting(device, setting, value):
         setting: the control to change
         value: the value to change it to
     """
+    v4l2.invalidate_control_snapshot(device)
     result = subprocess.run(['v4l2-ctl', '-d', device, '-c', '{}={}'.format(setting, value)])
     if result.returncode != 0:
         logging.error('non-zero return code changing webcam setting')
@@ -71,6 +74,7 @@ def adjust_video_settings(device, settings):
         device: the v4l2 device e.g. /dev/video0
         settings: the controls to change
     """
+    v4l2.invalidate_control_snapshot(device)
     # special case for using cameractls to adjust a Razer Kiyo Pro Ultra
     if len(settings) == 1 and 'exp_iso' in list(settings.keys()):
         _, val = list(settings.items())[0]
@@ -105,7 +109,22 @@ def find_serial(device_name):
     return serial
 
 
-def get_device_settings(video_device):
+def get_device_settings(video_device, max_age=0):
+    """
+    Returns the current value of each control as a string e.g. {'brightness': '128', ...}
+
+    Args:
+        video_device: the v4l2 device e.g. /dev/video0
+        max_age: reuse values read within this many seconds
+    """
+    try:
+        snapshot = v4l2.get_control_snapshot(video_device, max_age)
+    except OSError:
+        logging.info('unable to read controls of %s, falling back to v4l2-ctl', video_device)
+    else:
+        return {
+            name: str(ctrl['value']) for name, ctrl in snapshot.items() if ctrl['value'] is not None
+        }
     v4l2_settings = get_v4l2_settings(video_device)
     camera_settings = ','.join(v4l2_settings.keys())
     v4l2_cmd = subprocess.run(
@@ -157,11 +176,33 @@ def v4l2h264enc_available():
     return cmd.returncode == 0
 
 
-def find_video_devices():
-    """
-    fetches devices from v4l2 and creates a dict with the device
-    name as the key and the description in value
-    """
+def _apply_device_quirks(device, description, v4l2_options, video_options, usb_devices):
+    usb_info = usb_devices.get(device)
+    if usb_info is not None:
+        serial = usb_info['serial']
+        quirks = usb_info['quirks']
+    elif sysfs.available():
+        # not a usb device e.g. the pi camera module or codecs
+        serial = ''
+        quirks = sysfs.find_quirks(product=description)
+    else:
+        serial = find_serial(device)
+        quirks = sysfs.find_quirks(product=description)
+    if serial == '' and quirks:
+        # some devices do not report a unique serial so use a fixed one
+        serial = quirks['serial']
+    for ctl, overrides in quirks.get('v4l2_options', {}).items():
+        v4l2_options.setdefault(ctl, {}).update(overrides)
+    return {
+        'serial': serial,
+        'description': description,
+        'v4l2_options': v4l2_options,
+        'video_options': video_options,
+    }
+
+
+def _list_video_devices_v4l2_ctl():
+    """lists the devices by parsing the output of v4l2-ctl"""
     device_list = (
         subprocess.run(
             ["v4l2-ctl", "--list-devices"],
@@ -171,38 +212,11 @@ def find_video_devices():
         .split('\n')
     )
     video_devices = [d.strip() for d in device_list]
-    devices = {}
+    devices = []
     while len(video_devices):
         description = video_devices.pop(0)
         device = video_devices.pop(0)
-        serial = find_serial(device)
-        if serial == '' and 'Cam Link' in description:
-            # cam link does not report unique serial so set one
-            serial = 'CAMLINK'
-        if serial == '' and 'Kiyo Pro Ultra' in description:
-            # cam link does not report unique serial so set one
-            serial = 'KIYOPROULTRA'
-        elif serial == '' and 'Kiyo Pro' in description:
-            # cam link does not report unique serial so set one
-            serial = 'KIYOPRO'
-        v4l2_options = get_v4l2_settings(device)
-        if serial in ('KIYOPRO', 'KIYOPROULTRA'):
-            v4l2_options.update({'exposure_time_absolute': {'min': 10}})
-            v4l2_options.update({'exposure_time_absolute': {'max': 156}})
-        if serial in ('KIYOPROULTRA'):
-            # add a psuedo property for exp_shutter speed and exp_iso
-            v4l2_options.update({'exp_shutter': {'default': 30}})
-            v4l2_options.update({'exp_iso': {'default': 400}})
-        devices.update(
-            {
-                device: {
-                    'serial': serial,
-                    'description': description,
-                    'v4l2_options': v4l2_options,
-                    'video_options': find_resolutions(device),
-                }
-            }
-        )
+        devices.append((device, description))
         # probably a better way to handle this but seems to work for now
         # loop until a blank line
         while device != '' and len(video_devices):
@@ -212,12 +226,102 @@ def find_video_devices():
     return devices
 
 
+def list_video_devices():
+    """
+    Returns (device, description) for the capture node of each video device without probing
+    their controls or formats. The devices are queried with ioctls directly, falling back to
+    v4l2-ctl if that isn't possible on this system.
+    """
+    if v4l2.available():
+        try:
+            return [(nodes[0], description) for description, nodes in v4l2.list_devices()]
+        except OSError:
+            logging.exception('native v4l2 enumeration failed, falling back to v4l2-ctl')
+    return _list_video_devices_v4l2_ctl()
+
+
+def probe_video_device(device, description, usb_devices=None):
+    """
+    Probes the controls and formats of a single video device, see find_video_devices()
+
+    Args:
+        device: the v4l2 device e.g. /dev/video0
+        description: the description from list_video_devices()
+        usb_devices: the usb details from sysfs.resolve_video_devices() if already resolved
+    """
+    if usb_devices is None:
+        usb_devices = sysfs.resolve_video_devices()
+    try:
+        v4l2_options, video_options = v4l2.probe_device(device)
+    except OSError:
+        logging.info('unable to probe %s natively, falling back to v4l2-ctl', device)
+        v4l2_options = get_v4l2_settings(device)
+        video_options = find_resolutions(device)
+    return _apply_device_quirks(device, description, v4l2_options, video_options, usb_devices)
+
+
+def find_video_devices():
+    """
+    fetches devices from v4l2 and creates a dict with the device
+    name as the key and the description in value
+    """
+    devices = {}
+    usb_devices = sysfs.resolve_video_devices()
+    for device, description in list_video_devices():
+        devices.update({device: probe_video_device(device, description, usb_devices)})
+    return devices
+
+
+# how long the dashboard can reuse control values while polling
+CONTROL_SNAPSHOT_TTL = 0.2
+
+# controls which aren't v4l2 controls but are set through cameractrls
+PSEUDO_CONTROLS = {'exp_iso', 'exp_shutter'}
+
+
 class VideoDeviceApiHandler(MethodView):
+    def get(self, serial):
+        for video_device, device_info in app.device_inventory.video_devices().items():
+            if device_info['serial'] == serial:
+                try:
+                    snapshot = v4l2.get_control_snapshot(video_device, max_age=CONTROL_SNAPSHOT_TTL)
+                except OSError as e:
+                    app.logger.info('unable to read the controls of %s: %s', video_device, e)
+                    # unplugged since the inventory was probed, or busy
+                    gone = e.errno in (errno.ENOENT, errno.ENODEV)
+                    resp = render_json(
+                        {'status': 'not found' if gone else 'unavailable', 'error': e.strerror}
+                    )
+                    resp.status_code = 404 if gone else 503
+                    return resp
+                writer = controls.find_control_writer(video_device)
+                return render_json(
+                    {
+                        'status': 'ok',
+                        'data': snapshot,
+                        'writes': writer.status() if writer else None,
+                    }
+                )
+        resp = render_json({'status': 'not found'})
+        resp.status_code = 404
+        return resp
+
     def post(self, serial):
         app.logger.info('updating video setting(s) for %s', serial)
         data = request.json
-        adjust_video_settings(data['video_device'], data['settings'])
-        return render_json({'status': 'ok'})
+        settings = data['settings']
+        if PSEUDO_CONTROLS.intersection(settings.keys()):
+            adjust_video_settings(data['video_device'], settings)
+            return render_json({'status': 'ok'})
+        try:
+            writer = controls.get_control_writer(data['video_device'])
+        except OSError:
+            app.logger.info('unable to open %s, using v4l2-ctl', data['video_device'])
+            adjust_video_settings(data['video_device'], settings)
+            return render_json({'status': 'ok'})
+        # applied in the background, the result is reported by get() under this seq
+        seq = writer.submit(settings)
+        return render_json({'status': 'ok', 'seq': seq})
 
 
 class VideoDeviceHandler(MethodView):
@@ -270,7 +374,7 @@ class VideoDeviceHandler(MethodView):
         video_configs = app.picam_config.video_devices
         v4l2_options = {}
         video_options = None
-        for _, device_info in find_video_devices().items():
+        for _, device_info in app.device_inventory.video_devices().items():
             if serial == device_info['serial']:
                 description = device_info['description']
                 device_config = video_configs.get(serial, {})
@@ -336,6 +440,13 @@ class VideoDeviceHandler(MethodView):
             elif encoding == 'mjpeg':
                 resolutions = video_options['MJPG'].keys()
                 framerates = video_options['MJPG'][resolution]
+            elif encoding == encoders.AUTO:
+                # the trials can pick any of the formats, offer what the first one supports
+                auto_format = next((f for f in ('MJPG', 'H264', 'YUYV') if f in encodings), None)
+                # a device without any of them has nothing to offer
+                if auto_format is not None:
+                    resolutions = video_options[auto_format].keys()
+                    framerates = video_options[auto_format].get(resolution, [])
             else:
                 resolutions = list(video_options['YUYV'].keys())
                 if resolution not in resolutions:
@@ -366,10 +477,8 @@ class VideoDeviceHandler(MethodView):
             del app.picam_config.video_devices[serial]
             return redirect('/devices')
 
-        video_devices = find_video_devices()
-
         v4l2_options = {}
-        for _, device_info in video_devices.items():
+        for _, device_info in app.device_inventory.video_devices().items():
             if device_info['serial'] == serial:
                 v4l2_options = device_info['v4l2_options']
                 break
@@ -0,0 +1,138 @@
+"""
+Latest-wins write queue shared by the live video control and audio mixer apis.
+"""
+
+import abc
+import copy
+import logging
+import threading
+import time
+
+from picam.events import event_bus
+
+
+class CoalescingWriter(abc.ABC):
+    """
+    Applies writes for one device from a worker thread.
+
+    Pending writes are coalesced per key so only the newest value of a control is written, and
+    batches are written at most once every min_interval seconds so a dragged slider can't queue
+    up more work than the device keeps up with. Subclasses implement write() and can reset any
+    state in on_error() when a write fails, e.g. after the device was unplugged.
+    """
+
+    # event published on the dashboard event bus after each batch
+    ack_event = 'control-ack'
+
+    def __init__(self, target, min_interval=0.05):
+        self.target = target
+        self.min_interval = min_interval
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._seq = 0
+        self._last_apply = 0.0
+        self._closed = False
+        self._status = {
+            'submitted_seq': 0,
+            'applied_seq': 0,
+            'coalesced': 0,
+            'error': None,
+            'controls': {},
+        }
+        self._thread = threading.Thread(
+            target=self._run,
+            name='writer-{}'.format(target),
+            daemon=True,
+        )
+        self._thread.start()
+
+    @abc.abstractmethod
+    def write(self, settings):
+        """
+        Writes the settings to the device.
+
+        Returns:
+            dict of each key to the details to report for it e.g. {'gain': {'value': 32}}
+
+        Raises:
+            OSError if the device couldn't be written
+        """
+
+    def on_error(self, error):
+        pass
+
+    def submit(self, settings):
+        """Queues the settings and returns the sequence number of the write"""
+        with self._cond:
+            self._seq += 1
+            submitted = time.monotonic()
+            for key, value in settings.items():
+                if key in self._pending:
+                    self._status['coalesced'] += 1
+                self._pending[key] = (value, self._seq, submitted)
+            self._status['submitted_seq'] = self._seq
+            self._cond.notify()
+            return self._seq
+
+    def status(self):
+        with self._cond:
+            return copy.deepcopy(self._status)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                wait = self._last_apply + self.min_interval - time.monotonic()
+                if wait > 0:
+                    # let more writes coalesce until the next slot
+                    self._cond.wait(wait)
+                    continue
+                batch = self._pending
+                self._pending = {}
+            self._apply(batch)
+            self._last_apply = time.monotonic()
+
+    def _apply(self, batch):
+        settings = {key: value for key, (value, _, _) in batch.items()}
+        try:
+            results = self.write(settings)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # anything escaping would end the worker and every later write to the device
+            logging.warning(
+                'failed writing %s to %s: %s',
+                settings,
+                self.target,
+                e,
+                exc_info=not isinstance(e, OSError),
+            )
+            with self._cond:
+                self._status['error'] = str(e)
+            self.on_error(e)
+            return
+        applied = time.monotonic()
+        with self._cond:
+            self._status['error'] = None
+            for key, (value, seq, submitted) in batch.items():
+                entry = {
+                    'requested': value,
+                    'seq': seq,
+                    'latency': round(applied - submitted, 4),
+                }
+                entry.update(results.get(key, {}))
+                self._status['controls'][key] = entry
+                self._status['applied_seq'] = max(self._status['applied_seq'], seq)
+            ack = {
+                'device': self.target,
+                'seq': self._status['applied_seq'],
+                'controls': {key: self._status['controls'][key] for key in batch},
+            }
+        event_bus.publish(self.ack_event, ack)
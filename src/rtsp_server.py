@@ -1,27 +1,45 @@
 #!/usr/bin/env python3
 
+# the server is one script run by systemd, its mount handling has grown past the default limit
+# pylint: disable=too-many-lines
+
+import json
 import logging
+import signal
 import subprocess
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import gi
 import yaml
 
-from fractions import Fraction
 from picam import (
     audio,
+    bitrate,
+    capture,
+    controls,
+    encoder_trial,
+    encoders,
+    metrics,
+    sysfs,
+    timeline as startup_timeline,
     video,
 )
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstVideo', '1.0')
+gi.require_version('GstRtsp', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 
 # pylint: disable=wrong-import-position,wrong-import-order
 from gi.repository import (
+    Gio,
     GLib,
     Gst,
+    GstRtsp,
     GstRtspServer,
+    GstVideo,
 )
 
 Gst.init(None)
@@ -29,14 +47,61 @@ mainloop = GLib.MainLoop()
 
 server = GstRtspServer.RTSPServer()
 mounts = server.get_mount_points()
+timeline = startup_timeline.StartupTimeline()
+# the main loop source of the server once it's attached
+server_state = {'source_id': None}
+
+# mount path -> {'device', 'pipeline'} of every factory added to the server
+mount_table = {}
+# configs are the ones the current mounts were created from
+reload_state = {'running': False, 'requested': False, 'timeout_id': None, 'configs': None}
+# mount path -> the running media of each mount, used by the metrics
+media_table = {}
+# video device -> SharedCapture of the devices with renditions
+capture_table = {}
+# mount path -> {'media', 'idle_since'} of the medias kept prepared without clients
+media_holds = {}
+# (addresses, ports, ttl) -> the RTSPAddressPool shared by every mount with that range, so
+# mounts left on the default range get different groups instead of all taking the first one
+address_pools = {}
+# rtsp client -> mount path -> (monotonic time of its DESCRIBE, whether the media was prepared)
+client_connects = {}
+# mount path -> monotonic time a keyframe was last forced for a joining client
+keyframe_requests = {}
+# seconds between keyframes forced for joining clients, a burst of them shares the first one
+KEYFRAME_MIN_INTERVAL = 1.0
+# the client's transport is only added to the sinks once it's handled the PLAY
+KEYFRAME_DELAY_MS = 100
+# lazy prepares the media for the first client and tears it down after the last one leaves,
+# or idle_timeout seconds later; always-on prepares it on startup and keeps it prerolled
+LIFECYCLE_POLICIES = ('lazy', 'always-on')
+IDLE_CHECK_INTERVAL_MS = 1000
+# pts of buffers waiting in an encoder to be timed
+ENCODER_PENDING_LIMIT = 100
+# how often the receiver reports are checked for adaptive bitrate
+BITRATE_INTERVAL_MS = 1000
+RTP_VIDEO_CLOCK_RATE = 90000
+AUDIO_RATE = 32000
+# waits for the config file to settle before reloading since the web ui truncates then writes it
+RELOAD_DELAY_MS = 500
+# seconds between removing the sessions of clients which went away without a TEARDOWN
+SESSION_CLEANUP_INTERVAL = 10
+# administratively scoped so it stays on the local network, a ttl of 1 keeps it on the subnet
+MULTICAST_DEFAULTS = {'addresses': '239.255.42.1-239.255.42.254', 'ports': '5000-5999', 'ttl': 1}
+# how long sent packets are kept for retransmission, it has to fit in the clients' latency
+RETRANSMISSION_TIME_MS = 500
 
 logging.basicConfig(level=logging.INFO)
 
 
+def config_path():
+    script_dir = os.path.dirname(__file__)
+    return f'{script_dir}/picam.yaml'
+
+
 def load_configs():
     configs = None
-    script_dir = os.path.dirname(__file__)
-    with open(f'{script_dir}/picam.yaml', 'r', encoding='UTF-8') as settings_file:
+    with open(config_path(), 'r', encoding='UTF-8') as settings_file:
         try:
             configs = yaml.safe_load(settings_file)
         except Exception:  # pylint: disable=broad-exception-caught
@@ -91,10 +156,24 @@ def setup_pi_camera_device(video_device):
     ).format(video_device, camera_settings)
     pipeline = '( {} ! h264parse config-interval=2 ! rtph264pay name=pay0 pt=96 )'.format(launch)
     mount_path = '/picam'
-    return (pipeline, mount_path)
+    return [(pipeline, mount_path, {})]
 
 
 def set_v4l2_controls(video_device, v4l2_options):
+    """
+    Applies the configured controls in dependency order with as few ioctls as possible,
+    falling back to v4l2-ctl if the device can't be accessed directly.
+    """
+    try:
+        report = controls.apply_controls(video_device, v4l2_options)
+    except OSError:
+        logging.info('unable to apply controls to %s directly, using v4l2-ctl', video_device)
+        set_v4l2_controls_v4l2_ctl(video_device, v4l2_options)
+    else:
+        controls.log_report(video_device, report)
+
+
+def set_v4l2_controls_v4l2_ctl(video_device, v4l2_options):
     # run through all of the options and set the "auto" flags first
     # errors can happen if setting "absolute" values if corresponding "auto" isn't set properly
     for ctl, val in v4l2_options.items():
@@ -124,208 +203,1382 @@ def set_v4l2_controls(video_device, v4l2_options):
         adjust_video_settings(video_device, '{}={}'.format(ctl, val))
 
 
-def setup_vp8enc_pipeline(width, height, framerate):
-    keyframe_interval = 2 * framerate
-    return (
-        "video/x-raw,width={width},height={height},framerate={framerate} "
-        "! videoscale ! video/x-raw,width=1024,height=576 "
-        "! videoconvert ! video/x-raw,width={width},height={height},framerate={framerate},format=I420 "
-        "! vp8enc end-usage=cbr deadline=1 threads=8 keyframe-max-dist={keyframe_interval} target-bitrate=4000000 "
-        "! rtpvp8pay name=pay0 pt=96 "
-    ).format(
-        width=width,
-        height=height,
-        framerate=framerate,
-        keyframe_interval=keyframe_interval,
+def setup_uvc_device(
+    serial,
+    video_device,
+    config_options,
+    apply_controls=True,
+    video_options=None,
+    model=None,
+    audio_launch=None,
+    mounted_encoding=None,
+):
+    """
+    Creates gstreamer pipeline for the video device.
+
+    Args:
+        serial: the serial of the device
+        video_device: the v4l2 device e.g. /dev/video0
+        config_options: the device config options which include the v4l2 configs
+        apply_controls: False to leave the device's controls alone e.g. when they haven't changed
+        video_options: the formats the device supports, needed for `encoding: auto`
+        model: the kind of camera `encoding: auto` remembers its choice for
+        audio_launch: an audio stream to add to the device's media, see build_device_audio()
+        mounted_encoding: the encoding the device's running mount streams with when reloading,
+            the trials can't open a device which is in use
+
+    Returns:
+        a list of (pipeline, mount_path, mount_options), one for each rendition of the device
+    """
+    logging.info('setting up video device %s', video_device)
+    quirks = sysfs.quirks_for_serial(serial)
+
+    if apply_controls and not quirks.get('persistent_controls', False):
+        # some webcams like the kiyos maintain configurations so don't require presetting each time
+        with timeline.stage(video_device, 'controls'):
+            set_v4l2_controls(
+                video_device,
+                config_options.get('v4l2', {}),
+            )
+
+    framerate = config_options.get('framerate', '30')
+    if framerate not in (60, 48, 30, 24):
+        # 59.940
+        framerate = '7013/117'
+    else:
+        framerate = f'{framerate}/1'
+
+    width, height = config_options.get('resolution', '1280x720').split('x')
+
+    # default to the built-in h264 encoding if possible
+    encoding = config_options['encoding']
+    encoder_options = config_options.get('encoder', {})
+    uvch264 = quirks.get('uvch264', True)
+    if encoding == encoders.AUTO and mounted_encoding and not apply_controls:
+        # the config is unchanged, keep what the running mount picked
+        encoding = mounted_encoding
+    elif encoding == encoders.AUTO:
+        with timeline.stage(video_device, 'encoder'):
+            encoding = encoder_trial.choose_encoding(
+                video_device,
+                model or serial,
+                config_options,
+                video_options,
+                framerate,
+                uvch264,
+                mounted_encoding,
+            )
+    if encoding not in encoders.ENCODER_PROFILES:
+        logging.warning('unknown encoding %s for %s, using h264', encoding, video_device)
+        encoding = 'h264'
+    # kiyos do not support uvch264src unfortunately but do better anyways
+    launch = encoders.build_video_source(video_device, encoding, encoder_options, uvch264)
+    if config_options.get('renditions'):
+        return setup_renditions(
+            video_device,
+            launch,
+            encoding,
+            width,
+            height,
+            framerate,
+            config_options,
+            audio_launch,
+        )
+    encoder_options = check_zero_copy(video_device, encoding, encoder_options)
+    video_format = encoders.build_pipeline(encoding, width, height, framerate, encoder_options)
+
+    streams = ['{} ! {}'.format(launch, video_format)]
+    if audio_launch:
+        streams.append(audio_launch)
+    pipeline = '( {} )'.format(' '.join(streams))
+    mount_path = config_options['endpoint']
+    mount_options = {
+        'bitrate_control': encoders.get_bitrate_control(encoding, encoder_options),
+        'device_encoding': encoding,
+        'lifecycle': get_lifecycle(mount_path, config_options),
+        'max_clients': config_options.get('max_clients'),
+        'multicast': get_multicast(mount_path, config_options),
+        'retransmission': get_retransmission(mount_path, config_options),
+    }
+    return [(pipeline, mount_path, mount_options)]
+
+
+def get_multicast(mount_path, config_options):
+    """
+    Returns the multicast addresses of a mount from its config or None for unicast only:
+
+        multicast:
+            addresses: 224.3.0.1-224.3.0.10
+            # two for each stream, rtp and rtcp
+            ports: 5000-5099
+            ttl: 1
+            # e.g. lo to test on one machine, the kernel's route for 224.0.0.0/4 otherwise
+            iface: wlan0
+
+    Clients which don't ask for multicast still get unicast. Mounts with the same range, e.g.
+    `multicast: true` for the defaults, take different addresses from it.
+    """
+    multicast = config_options.get('multicast')
+    if not multicast:
+        return None
+    if multicast is True:
+        multicast = {}
+    options = dict(MULTICAST_DEFAULTS, **multicast)
+    try:
+        first, last = options['addresses'].split('-')
+        min_port, max_port = (int(port) for port in str(options['ports']).split('-'))
+        ttl = int(options['ttl'])
+    except (AttributeError, TypeError, ValueError):
+        logging.warning('invalid multicast for %s, it will only be unicast', mount_path)
+        return None
+    return {
+        'addresses': [first.strip(), last.strip()],
+        'ports': [min_port, max_port],
+        'ttl': ttl,
+        'iface': options.get('iface'),
+    }
+
+
+def get_retransmission(mount_path, config_options):
+    """
+    Returns the retransmission of a mount from its config or None when lost packets are only
+    recovered by the next keyframe:
+
+        retransmission: true
+        # or keep the packets for longer, up to the latency of the clients
+        retransmission:
+            time_ms: 1000
+    """
+    retransmission = config_options.get('retransmission')
+    if not retransmission:
+        return None
+    if retransmission is True:
+        retransmission = {}
+    try:
+        time_ms = int(retransmission.get('time_ms', RETRANSMISSION_TIME_MS))
+    except (AttributeError, TypeError, ValueError):
+        logging.warning('invalid retransmission for %s, it will be turned off', mount_path)
+        return None
+    return {'time_ms': time_ms}
+
+
+def get_lifecycle(mount_path, config_options):
+    """
+    Returns the lifecycle policy of a mount from its config:
+
+        lifecycle: always-on
+        # or tear the media down a minute after the last client leaves
+        lifecycle: lazy
+        idle_timeout: 60
+    """
+    policy = config_options.get('lifecycle', 'lazy')
+    if policy not in LIFECYCLE_POLICIES:
+        logging.warning(
+            'unknown lifecycle %s for %s, must be one of %s',
+            policy,
+            mount_path,
+            ', '.join(LIFECYCLE_POLICIES),
+        )
+        policy = 'lazy'
+    try:
+        idle_timeout = float(config_options.get('idle_timeout') or 0)
+    except (TypeError, ValueError):
+        logging.warning('invalid idle_timeout for %s', mount_path)
+        idle_timeout = 0
+    return {'policy': policy, 'idle_timeout': idle_timeout}
+
+
+def check_zero_copy(video_device, encoding, encoder_options):
+    """falls back to converting in software when zero_copy is on without the elements it needs"""
+    if not encoder_options.get('zero_copy'):
+        return encoder_options
+    required = encoders.ENCODER_PROFILES[encoding].get('zero_copy_elements', ())
+    missing = [name for name in required if Gst.ElementFactory.find(name) is None]
+    if not missing:
+        return encoder_options
+    logging.warning(
+        '%s not available, %s falls back to converting in software',
+        ', '.join(missing),
+        video_device,
     )
+    return dict(encoder_options, zero_copy=False)
 
 
-def setup_mjpeg_pipeline(width, height, framerate):
-    return (
-        "image/jpeg,width={},height={},framerate={} "
-        "! queue leaky=downstream "
-        "! jpegparse "
-        "! rtpjpegpay name=pay0 pt=26 "
-    ).format(width, height, framerate)
+def setup_renditions(
+    video_device,
+    launch,
+    encoding,
+    width,
+    height,
+    framerate,
+    config_options,
+    audio_launch=None,
+):
+    """
+    Creates a mount for the device's endpoint and one for each of its renditions, all fed from
+    a single capture of the device, see picam.capture.
 
+        renditions:
+            - endpoint: /playfield-low
+              encoding: x264enc
+              size: 640x360
+              bitrate: 800
 
-def setup_x264enc_pipeline(width, height, framerate):
-    fraction = Fraction(framerate)
-    keyframe_interval = 2 * fraction.numerator
-    return (
-        "video/x-raw,width={width},height={height},framerate={framerate} "
-        "! videoconvert ! video/x-raw,format=I420 "
-        "! queue max-size-buffers=4 leaky=downstream "
-        "! x264enc bitrate=5600 speed-preset=superfast tune=zerolatency key-int-max={keyframe_interval} "
-        "! video/x-h264,profile=high "
-        "! h264parse config-interval=2 "
-        "! rtph264pay name=pay0 pt=96 "
-    ).format(
-        width=width,
-        height=height,
-        framerate=framerate,
-        keyframe_interval=keyframe_interval,
+    Args:
+        launch: the device's source element(s)
+        encoding: the device's own encoding, which decides the format it's captured in
+        audio_launch: an audio stream for the device's own endpoint, it stays in sync with the
+            video because capture.SharedCapture rebases the frames onto the media's clock
+    """
+    encoder_options = config_options.get('encoder', {})
+    renditions = [
+        {'endpoint': config_options['endpoint'], 'encoding': encoding, 'encoder': encoder_options}
+    ]
+    renditions.extend(config_options['renditions'])
+    rendition_mounts = []
+    for idx, rendition in enumerate(renditions):
+        rendition_encoding = rendition.get('encoding', encoding)
+        if rendition_encoding not in encoders.ENCODER_PROFILES:
+            logging.warning('unknown encoding %s for %s', rendition_encoding, rendition['endpoint'])
+            continue
+        decode = encoders.build_rendition_input(encoding, rendition_encoding)
+        if decode is None:
+            logging.warning(
+                '%s can not be made from the %s capture of %s',
+                rendition['endpoint'],
+                encoding,
+                video_device,
+            )
+            continue
+        overrides = dict(rendition.get('encoder') or {})
+        if rendition.get('size'):
+            overrides['output_size'] = rendition['size']
+        if rendition.get('bitrate'):
+            overrides['bitrate'] = rendition['bitrate']
+        overrides = check_zero_copy(video_device, rendition_encoding, overrides)
+        video_format = encoders.build_pipeline(
+            rendition_encoding,
+            width,
+            height,
+            framerate,
+            overrides,
+        )
+        streams = [capture.build_rendition_source(decode) + video_format]
+        if audio_launch and idx == 0:
+            # the other renditions would need the card opened again
+            streams.append(audio_launch)
+        pipeline = '( {} )'.format(' '.join(streams))
+        mount_options = {
+            'bitrate_control': encoders.get_bitrate_control(rendition_encoding, overrides),
+            'capture': {
+                'device': video_device,
+                'branch': 'r{}'.format(idx),
+                # the camera's own h264 or mjpeg, its keyframes come from the capture
+                'passthrough': (
+                    rendition_encoding == encoding
+                    and encoders.ENCODER_PROFILES[encoding]['input_format'] != 'YUYV'
+                ),
+            },
+            'device_encoding': encoding,
+            # renditions can have their own policy, the device's applies otherwise
+            'lifecycle': get_lifecycle(rendition['endpoint'], dict(config_options, **rendition)),
+            'max_clients': rendition.get('max_clients', config_options.get('max_clients')),
+            # the device's range applies unless overridden, each rendition takes its own group
+            'multicast': get_multicast(rendition['endpoint'], dict(config_options, **rendition)),
+            'retransmission': get_retransmission(
+                rendition['endpoint'], dict(config_options, **rendition)
+            ),
+        }
+        rendition_mounts.append((pipeline, rendition['endpoint'], mount_options))
+
+    capture_launch = capture.build_capture_launch(
+        launch,
+        encoders.build_capture_caps(encoding, width, height, framerate, encoder_options),
+        [mount_options['capture']['branch'] for _, _, mount_options in rendition_mounts],
     )
+    for _, _, mount_options in rendition_mounts:
+        # a change to any rendition rebuilds the capture and so every mount of the device
+        mount_options['capture']['launch'] = capture_launch
+    return rendition_mounts
 
 
-def setup_jpegenc_pipeline(width, height, framerate):
-    # scale video down to get enough performance out of the software encoder
-    # slight quality hit at the expense of latency
-    return (
-        "video/x-raw,width={width},height={height},framerate={framerate} "
-        "! videoscale ! video/x-raw,width=1280,height=720 "
-        "! queue max-size-buffers=2 leaky=downstream "
-        "! jpegenc "
-        "! rtpjpegpay name=pay0 pt=96"
-    ).format(
-        width=width,
-        height=height,
-        framerate=framerate,
+def setup_video_mount(
+    video_device,
+    description,
+    usb_devices,
+    configs,
+    previous_configs=None,
+    audio_devices=None,
+    mounted_encodings=None,
+):
+    """
+    Probes a video device and applies its controls, runs on the startup thread pool.
+    When reloading, controls are only applied again if the device's config changed.
+
+    Args:
+        audio_devices: the sound cards from audio.find_audio_devices(), for the devices
+            streaming a mic in the same session
+        mounted_encodings: device -> the encoding of its running mounts when reloading
+
+    Returns:
+        a list of (pipeline, mount_path, mount_options), empty if the device isn't configured
+    """
+    with timeline.stage(video_device, 'probe'):
+        device_info = video.probe_video_device(video_device, description, usb_devices)
+    logging.info(device_info['description'])
+    if 'bcm2835-v4l2' in device_info['description']:
+        return setup_pi_camera_device(video_device)
+    serial = device_info['serial']
+    if serial in configs['video_devices'].keys():
+        config_options = configs['video_devices'][serial]
+        previous_options = (previous_configs or {}).get('video_devices', {}).get(serial)
+        usb_info = (usb_devices or {}).get(video_device) or {}
+        return setup_uvc_device(
+            serial,
+            video_device,
+            config_options,
+            apply_controls=config_options != previous_options,
+            video_options=device_info['video_options'],
+            model='{} {}'.format(usb_info.get('usb_id', ''), device_info['description']).strip(),
+            audio_launch=build_device_audio(serial, config_options, configs, audio_devices),
+            mounted_encoding=(mounted_encodings or {}).get(video_device),
+        )
+    return []
+
+
+def combined_audio_serial(serial, config_options):
+    """the audio device a video device streams in the same session, `audio: true` for its own"""
+    audio_serial = config_options.get('audio')
+    if audio_serial is True:
+        return serial
+    return audio_serial or None
+
+
+def combined_audio_serials(configs):
+    """the audio devices streamed together with a camera, they don't get mounts of their own"""
+    serials = set()
+    for serial, config_options in (configs.get('video_devices') or {}).items():
+        audio_serial = combined_audio_serial(serial, config_options)
+        if audio_serial:
+            serials.add(audio_serial)
+    return serials
+
+
+def build_device_audio(serial, config_options, configs, audio_devices):
+    """
+    Returns the audio stream to add to a video device's pipeline as pay1 or None. Both streams
+    are in one media so they share its clock and base time and reach the client lip synced
+    over a single session.
+    """
+    audio_serial = combined_audio_serial(serial, config_options)
+    if not audio_serial:
+        return None
+    device_info = (audio_devices or {}).get(audio_serial)
+    if device_info is None:
+        logging.warning('audio device %s for %s not found', audio_serial, serial)
+        return None
+    audio_configs = (configs.get('audio_devices') or {}).get(audio_serial) or {}
+    return build_audio_launch(
+        device_info['alsa_idx'],
+        audio_configs.get('audio_rate', AUDIO_RATE),
+        payloader='pay1',
+        payload_type=97,
     )
 
 
-def setup_v4l2h264enc_pipeline(width, height, framerate):
+def build_audio_launch(alsa_idx, audio_rate, payloader='pay0', payload_type=96):
     return (
-        "video/x-raw,width={width},height={height},framerate={framerate} "
-        "! videoscale ! video/x-raw,width=1280,height=720 "
-        "! videoconvert ! video/x-raw,format=I420 "
-        "! v4l2h264enc extra-controls=encode,h264_level=13,h264_profile=4,video_bitrate=10000000 "
-        "! h264parse config-interval=2 "
-        "! rtph264pay name=pay0 pt=96 "
+        'alsasrc device=hw:{alsa_idx} do-timestamp=1 '
+        '! audio/x-raw,rate={audio_rate} '
+        '! queue ! voaacenc bitrate=160000 '
+        '! rtpmp4apay name={payloader} pt={payload_type}'
     ).format(
-        width=width,
-        height=height,
-        framerate=framerate,
+        alsa_idx=alsa_idx,
+        audio_rate=audio_rate,
+        payloader=payloader,
+        payload_type=payload_type,
     )
 
 
-def setup_uvc_device(serial, video_device, config_options):
+def setup_audio_mount(serial, device_info, audio_configs, combined=()):
     """
-    Creates gstreamer pipeline for the video device.
+    Creates the gstreamer pipeline for an audio device.
 
     Args:
-        serial: the serial of the device
-        video_device: the v4l2 device e.g. /dev/video0
-        config_options: the device config options which include the v4l2 configs
+        combined: the audio devices streamed together with a camera, a card can only be opened
+            once so they are left out
+
+    Returns:
+        a list with the (pipeline, mount_path, mount_options), empty if the device isn't
+        configured
     """
-    logging.info('setting up video device %s', video_device)
+    audio_rate = AUDIO_RATE
+    audio_path = None
+    alsa_idx = device_info['alsa_idx']
+    if serial in combined:
+        logging.info('audio device %s is streamed with its camera', serial)
+        return []
+    if serial in list(audio_configs.keys()):
+        audio_path = audio_configs[serial]['endpoint']
+        audio_rate = audio_configs[serial].get('audio_rate', audio_rate)
+    if not audio_path:
+        return []
+    pipeline = '( {} )'.format(build_audio_launch(alsa_idx, audio_rate))
+    mount_options = {
+        'lifecycle': get_lifecycle(audio_path, audio_configs[serial]),
+        'max_clients': audio_configs[serial].get('max_clients'),
+        'multicast': get_multicast(audio_path, audio_configs[serial]),
+        'retransmission': get_retransmission(audio_path, audio_configs[serial]),
+    }
+    return [(pipeline, audio_path, mount_options)]
 
-    if serial not in ['KIYOPRO', 'KIYOPROULTRA']:
-        # kiyo webcams maintain configurations so don't require presetting each time
-        set_v4l2_controls(
-            video_device,
-            config_options.get('v4l2', {}),
+
+def add_mount(device, pipeline, mount_path, mount_options=None):
+    """adds the factory for a prepared pipeline, attaching the server with the first one"""
+    logging.info(pipeline)
+    mount_options = mount_options or {}
+    if mount_options.get('capture'):
+        setup_capture(mount_options['capture'])
+    with timeline.stage(device, 'factory', mount=mount_path):
+        factory = GstRtspServer.RTSPMediaFactory()
+        factory.set_launch(pipeline)
+        factory.set_shared(True)
+        factory.connect('media-configure', on_media_configure, mount_path, mount_options)
+        if mount_options.get('multicast'):
+            setup_multicast(factory, mount_path, mount_options['multicast'])
+        if mount_options.get('retransmission'):
+            setup_retransmission(factory, mount_path, mount_options['retransmission'])
+        mounts.add_factory(mount_path, factory)
+    mount_table[mount_path] = {
+        'device': device,
+        'pipeline': pipeline,
+        'options': mount_options,
+        'factory': factory,
+    }
+    attach_server()
+    if (mount_options.get('lifecycle') or {}).get('policy') == 'always-on':
+        preroll_mount(mount_path)
+
+
+def setup_multicast(factory, mount_path, multicast):
+    """
+    Gives the factory addresses for clients asking for multicast. Its media is shared so each
+    stream is sent to the group once however many clients join it.
+    """
+    first, last = multicast['addresses']
+    min_port, max_port = multicast['ports']
+    key = (first, last, min_port, max_port, multicast['ttl'])
+    pool = address_pools.get(key)
+    if pool is None:
+        pool = GstRtspServer.RTSPAddressPool()
+        if not pool.add_range(first, last, min_port, max_port, multicast['ttl']):
+            logging.warning('invalid multicast range %s-%s for %s', first, last, mount_path)
+            return
+        address_pools[key] = pool
+    factory.set_address_pool(pool)
+    factory.set_max_mcast_ttl(multicast['ttl'])
+    if multicast['iface']:
+        factory.set_multicast_iface(multicast['iface'])
+    logging.info(
+        '%s multicast on %s-%s ports %s-%s ttl %s',
+        mount_path,
+        first,
+        last,
+        min_port,
+        max_port,
+        multicast['ttl'],
+    )
+
+
+def setup_retransmission(factory, mount_path, retransmission):
+    """
+    Offers the AVPF profile next to AVP and keeps the packets sent for the retransmission time,
+    an AVPF client which NACKs a lost packet gets it again through an RTX stream. Clients which
+    only ask for AVP are streamed to as before.
+    """
+    factory.set_profiles(GstRtsp.RTSPProfile.AVP | GstRtsp.RTSPProfile.AVPF)
+    factory.set_retransmission_time(retransmission['time_ms'] * Gst.MSECOND)
+    # before 1.20 the retransmission time alone turns it on
+    if hasattr(factory, 'set_do_retransmission'):
+        factory.set_do_retransmission(True)
+    logging.info('%s retransmission for %s ms', mount_path, retransmission['time_ms'])
+
+
+def close_mount_sessions(mount_path):
+    """
+    Drops the clients of a mount so its shared media is torn down and releases the device,
+    they are left streaming from the old pipeline otherwise.
+    """
+
+    def media_filter(_session, session_media, _user_data):
+        matched, _ = session_media.matches(mount_path)
+        if matched:
+            return GstRtspServer.RTSPFilterResult.REMOVE
+        return GstRtspServer.RTSPFilterResult.KEEP
+
+    def session_filter(_pool, session, _user_data):
+        session.filter(media_filter, None)
+        if not session.filter(None, None):
+            return GstRtspServer.RTSPFilterResult.REMOVE
+        return GstRtspServer.RTSPFilterResult.KEEP
+
+    server.get_session_pool().filter(session_filter, None)
+
+
+def remove_mount(mount_path):
+    with timeline.stage(mount_table[mount_path]['device'], 'remove', mount=mount_path):
+        mounts.remove_factory(mount_path)
+        release_media(mount_path)
+        close_mount_sessions(mount_path)
+    capture_options = mount_table.pop(mount_path)['options'].get('capture')
+    if capture_options:
+        release_capture(capture_options['device'])
+
+
+def preroll_mount(mount_path):
+    """prepares an always-on mount's media before any client asks for it"""
+    with timeline.stage(mount_table[mount_path]['device'], 'preroll', mount=mount_path):
+        # the factory shares the media with the clients since the url has the server's port
+        _, url = GstRtsp.RTSPUrl.parse(
+            'rtsp://127.0.0.1:{}{}'.format(server.get_service(), mount_path)
         )
+        media = mount_table[mount_path]['factory'].construct(url)
+        if media is None or not media.prepare(None):
+            logging.warning('unable to preroll %s', mount_path)
+            return
+    hold_media(mount_path, media)
 
-    framerate = config_options.get('framerate', '30')
-    if framerate not in (60, 48, 30, 24):
-        # 59.940
-        framerate = '7013/117'
+
+def hold_media(mount_path, media):
+    """
+    Keeps the media prepared between clients, the server unprepares a shared media as soon as
+    its last client leaves otherwise. Each hold is one more prepare of the media, undone by
+    release_media().
+    """
+    if mount_path in media_holds:
+        return
+    media_holds[mount_path] = {'media': media, 'idle_since': time.monotonic()}
+
+    def on_unprepared(_media):
+        # e.g. an error tore it down, the next client prepares it again
+        hold = media_holds.get(mount_path)
+        if hold is not None and hold['media'] is media:
+            del media_holds[mount_path]
+
+    media.connect('unprepared', on_unprepared)
+
+
+def hold_lazy_media(mount_path, media):
+    """called on the main loop once a lazy mount with an idle_timeout has been prepared"""
+    if mount_path not in media_holds and media.prepare(None):
+        hold_media(mount_path, media)
+    return False
+
+
+def release_media(mount_path):
+    hold = media_holds.pop(mount_path, None)
+    if hold is not None:
+        hold['media'].unprepare()
+
+
+def check_idle_media():
+    """tears down the medias of lazy mounts which have been without clients for idle_timeout"""
+    now = time.monotonic()
+    for mount_path, hold in list(media_holds.items()):
+        mounted = mount_table.get(mount_path)
+        if mounted is None:
+            continue
+        lifecycle = mounted['options'].get('lifecycle') or {}
+        if lifecycle.get('policy') != 'lazy':
+            continue
+        if count_clients(mount_path):
+            hold['idle_since'] = None
+        elif hold['idle_since'] is None:
+            hold['idle_since'] = now
+        elif now - hold['idle_since'] >= lifecycle['idle_timeout']:
+            logging.info(
+                'tearing down %s after %ss without clients',
+                mount_path,
+                lifecycle['idle_timeout'],
+            )
+            release_media(mount_path)
+    return GLib.SOURCE_CONTINUE
+
+
+def count_clients(mount_path, sessions=None):
+    """the sessions streaming the mount"""
+    if sessions is None:
+        sessions = server.get_session_pool().filter(None, None)
+    clients = 0
+    for session in sessions:
+        for session_media in session.filter(None, None):
+            matched, _ = session_media.matches(mount_path)
+            if matched:
+                clients += 1
+    return clients
+
+
+def on_client_connected(_server, client):
+    client_connects[client] = {}
+    client.connect('describe-request', on_describe_request)
+    client.connect('pre-setup-request', on_pre_setup_request)
+    client.connect('play-request', on_play_request)
+    client.connect('closed', lambda closed: client_connects.pop(closed, None))
+
+
+def find_mount_path(path):
+    """the mount a request is for, clients add the stream or a / to the mount's path"""
+    factory, matched = mounts.match(path)
+    if factory is None:
+        return path
+    return path[:matched]
+
+
+def on_pre_setup_request(_client, ctx):
+    """turns new sessions away from a mount which already has max_clients"""
+    if ctx.session is not None:
+        # another stream of a session the client already has
+        return GstRtsp.RTSPStatusCode.OK
+    mount_path = find_mount_path(ctx.uri.abspath)
+    mounted = mount_table.get(mount_path)
+    max_clients = mounted['options'].get('max_clients') if mounted else None
+    if max_clients and count_clients(mount_path) >= max_clients:
+        logging.info('%s already has %s clients, refusing another', mount_path, max_clients)
+        metrics.registry.sample('picam_clients_refused_total', mount=mount_path).value += 1
+        return GstRtsp.RTSPStatusCode.SERVICE_UNAVAILABLE
+    return GstRtsp.RTSPStatusCode.OK
+
+
+def on_describe_request(client, ctx):
+    """the start of a client connecting to a mount, time to first frame is measured from here"""
+    mount_path = find_mount_path(ctx.uri.abspath)
+    # warm if the media was already prepared for another client or by its lifecycle
+    warm = mount_path in media_holds or mount_path in media_table
+    client_connects.setdefault(client, {})[mount_path] = (time.monotonic(), warm)
+
+
+def on_play_request(client, ctx):
+    mount_path = find_mount_path(ctx.uri.abspath)
+    started, warm = client_connects.get(client, {}).pop(mount_path, (time.monotonic(), True))
+    if ctx.media is None:
+        return
+    measure_first_frame(ctx.media, mount_path, started, warm)
+    rtsp_configs = (reload_state['configs'] or {}).get('rtsp', {})
+    if warm and rtsp_configs.get('keyframe_on_join', True):
+        # a cold media starts with a keyframe anyway
+        GLib.timeout_add(KEYFRAME_DELAY_MS, request_keyframe, ctx.media, mount_path)
+
+
+def request_keyframe(media, mount_path):
+    """
+    Asks the encoder for a keyframe so a client joining a running stream doesn't wait for the
+    rest of the gop, rate limited per mount.
+    """
+    rtsp_configs = (reload_state['configs'] or {}).get('rtsp', {})
+    min_interval = rtsp_configs.get('keyframe_min_interval', KEYFRAME_MIN_INTERVAL)
+    now = time.monotonic()
+    last = keyframe_requests.get(mount_path)
+    limited = last is not None and now - last < min_interval
+    metrics.registry.sample(
+        'picam_keyframe_requests_total',
+        mount=mount_path,
+        result='limited' if limited else 'sent',
+    ).value += 1
+    if limited:
+        return False
+    keyframe_requests[mount_path] = now
+    payloader = media.get_element().get_by_name('pay0')
+    if payloader is not None:
+        # encoders, and uvch264src through h264parse, handle the upstream force-key-unit
+        payloader.get_static_pad('sink').push_event(force_keyframe_event())
+    capture_options = (mount_table.get(mount_path) or {}).get('options', {}).get('capture')
+    if capture_options and capture_options.get('passthrough'):
+        # the rendition streams what the camera encoded, the request has to go to the capture
+        shared = capture_table.get(capture_options['device'])
+        if shared is not None:
+            shared.force_keyframe(capture_options['branch'], force_keyframe_event())
+    return False
+
+
+def force_keyframe_event():
+    return GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+
+
+def measure_first_frame(media, mount_path, started, warm):
+    """
+    Times how long a client waited for its first frame, the next keyframe going into the
+    payloader since the frames in between are of no use to a new client.
+    """
+    payloader = media.get_element().get_by_name('pay0')
+    if payloader is None:
+        return
+    ttff_sum = metrics.registry.sample('picam_time_to_first_frame_seconds_sum', mount=mount_path)
+    ttff_count = metrics.registry.sample(
+        'picam_time_to_first_frame_seconds_count',
+        mount=mount_path,
+    )
+
+    def on_frame(_pad, info):
+        if info.get_buffer().has_flags(Gst.BufferFlags.DELTA_UNIT):
+            return Gst.PadProbeReturn.OK
+        elapsed = time.monotonic() - started
+        ttff_sum.value += elapsed
+        ttff_count.value += 1
+        details = {'mount': mount_path, 'seconds': round(elapsed, 3), 'warm': warm}
+        logging.info('first frame %s', json.dumps(details))
+        return Gst.PadProbeReturn.REMOVE
+
+    payloader.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, on_frame)
+
+
+def setup_capture(capture_options):
+    """creates the shared capture for a rendition, replacing the device's old one if it changed"""
+    device = capture_options['device']
+    shared = capture_table.get(device)
+    if shared is not None and shared.launch == capture_options['launch']:
+        return
+    if shared is not None:
+        shared.close()
+    logging.info(capture_options['launch'])
+    capture_table[device] = capture.SharedCapture(device, capture_options['launch'])
+
+
+def release_capture(device):
+    """closes the device's shared capture once none of its renditions are mounted"""
+    for mounted in mount_table.values():
+        if (mounted['options'].get('capture') or {}).get('device') == device:
+            return
+    shared = capture_table.pop(device, None)
+    if shared is not None:
+        shared.close()
+
+
+def attach_capture(media, capture_options):
+    """feeds a rendition's new media from the shared capture for as long as it's prepared"""
+    shared = capture_table.get(capture_options['device'])
+    appsrc = media.get_element().get_by_name(capture.APPSRC_NAME)
+    if shared is None or appsrc is None:
+        logging.warning('%s has no capture to feed it', capture_options['device'])
+        return
+    branch = capture_options['branch']
+    shared.attach(branch, appsrc)
+    media.connect('unprepared', lambda _media: shared.detach(branch))
+
+
+def read_receiver_reports(media, seen):
+    """
+    Returns the worst (loss, jitter in ms) from the rtcp receiver reports of the media's
+    streams or None if no client has sent a new report.
+
+    Args:
+        seen: ssrc -> highest sequence number of the last report used, reports are only sent
+            every few seconds so the same one is read by several polls
+    """
+    worst = None
+    for idx in range(media.n_streams()):
+        stream = media.get_stream(idx)
+        session = stream.get_rtpsession()
+        if session is None:
+            continue
+        stream_clock_rate = get_clock_rate(stream)
+        stats = session.get_property('stats')
+        for source_stats in stats.get_value('source-stats') or []:
+            if not source_stats.get_value('have-rb'):
+                continue
+            ssrc = source_stats.get_value('ssrc')
+            highest_seq = source_stats.get_value('rb-exthighestseq')
+            if seen.get(ssrc) == highest_seq:
+                continue
+            seen[ssrc] = highest_seq
+            loss = source_stats.get_value('rb-fractionlost') / 256
+            # the clients' sources are receive only and report -1, the jitter is in the units
+            # of the stream they received
+            clock_rate = source_stats.get_value('clock-rate')
+            if clock_rate is None or clock_rate <= 0:
+                clock_rate = stream_clock_rate
+            jitter = source_stats.get_value('rb-jitter') * 1000 / clock_rate
+            if worst is None:
+                worst = (loss, jitter)
+            else:
+                worst = (max(worst[0], loss), max(worst[1], jitter))
+    return worst
+
+
+def get_clock_rate(stream):
+    """the rtp clock rate from the stream's caps, audio streams don't run at 90kHz"""
+    caps = stream.get_caps()
+    if caps is not None and caps.get_size():
+        found, clock_rate = caps.get_structure(0).get_int('clock-rate')
+        if found and clock_rate > 0:
+            return clock_rate
+    return RTP_VIDEO_CLOCK_RATE
+
+
+def set_encoder_bitrate(pipeline, control, bits_per_second):
+    element = pipeline.get_by_name(control['element'])
+    if element is None:
+        return False
+    value = bits_per_second // control['unit']
+    if 'extra_control' in control:
+        extra_controls = Gst.Structure.new_from_string(
+            'controls,{}={}'.format(control['extra_control'], value)
+        )
+        element.set_property('extra-controls', extra_controls)
     else:
-        framerate = f'{framerate}/1'
+        element.set_property(control['property'], value)
+    return True
 
-    width, height = config_options.get('resolution', '1280x720').split('x')
 
-    launch = 'v4l2src device={} io-mode=4 do-timestamp=1'.format(video_device)
+def setup_adaptive_bitrate(media, mount_path, control):
+    """polls the receiver reports of a new media and adjusts its encoder's bitrate"""
+    controller = bitrate.BitrateController(
+        mount_path,
+        control['bitrate'],
+        control['min_bitrate'],
+        control['max_bitrate'],
+    )
+    pipeline = media.get_element()
+    if pipeline.get_by_name(control['element']) is None:
+        logging.info('%s has no %s, adaptive bitrate disabled', mount_path, control['element'])
+        return
+    bitrate.register(controller)
+    seen = {}
 
-    # default to the built-in h264 encoding if possible
-    encoding = config_options['encoding']
-    if encoding == 'h264':
-        if serial not in ['KIYOPRO', 'KIYOPROULTRA']:
-            # better control over the iframe period, default is way too many seconds
-            # kiyos do not support the module unfortunately but do better anyways
-            # pylint: disable=line-too-long
-            launch = 'uvch264src device={} initial-bitrate=5000000 average-bitrate=5000000 auto-start=true iframe-period=2000 name=src0 fixed-framerate=true src0.vidsrc'.format(
-                video_device
+    def poll():
+        report = read_receiver_reports(media, seen)
+        if report is not None:
+            new_bitrate = controller.update(*report)
+            if new_bitrate is not None:
+                set_encoder_bitrate(pipeline, control, new_bitrate)
+        return GLib.SOURCE_CONTINUE
+
+    source_id = GLib.timeout_add(BITRATE_INTERVAL_MS, poll)
+
+    def on_unprepared(_media):
+        GLib.source_remove(source_id)
+        bitrate.unregister(mount_path)
+
+    media.connect('unprepared', on_unprepared)
+
+
+def count_buffers(sample):
+    """pad probe adding up the buffers, and buffers in lists, passing through"""
+
+    def probe(_pad, info):
+        if info.type & Gst.PadProbeType.BUFFER_LIST:
+            sample.value += info.get_buffer_list().length()
+        else:
+            sample.value += 1
+        return Gst.PadProbeReturn.OK
+
+    return probe
+
+
+def instrument_media(media, mount_path):
+    """adds the metrics of a media's pipeline, dropping them again once it's unprepared"""
+    instrument_pipeline(media.get_element(), mount_path)
+
+    def on_unprepared(_media):
+        metrics.registry.remove(mount=mount_path)
+
+    media.connect('unprepared', on_unprepared)
+
+
+def instrument_pipeline(pipeline, mount_path):
+    """
+    Adds the pad probes and bus handler feeding the metrics of a pipeline. Each probe takes the
+    GIL on the streaming thread for every buffer, so buffers are only counted at the stage
+    boundaries: out of the sources here and out of the encoder and payloader by their own
+    probes. They are only added while metrics are served.
+    """
+    buffer_probe = Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST
+    iterator = pipeline.iterate_recurse()
+    while True:
+        result, element = iterator.next()
+        if result != Gst.IteratorResult.OK:
+            break
+        name = element.get_name()
+        factory = element.get_factory()
+        if factory is not None and factory.get_name() == 'queue':
+            drops = metrics.registry.sample(
+                'picam_queue_drops_total',
+                mount=mount_path,
+                element=name,
             )
-    video_format = (
-        "video/x-h264,width={},height={},framerate={},profile=main "
-        "! h264parse config-interval=1 "
-        "! rtph264pay name=pay0 pt=96 "
-    ).format(width, height, framerate)
-
-    if encoding == 'mjpeg':
-        video_format = setup_mjpeg_pipeline(width, height, framerate)
-    elif encoding == 'jpegenc':
-        video_format = setup_jpegenc_pipeline(width, height, framerate)
-    elif encoding == 'v4l2h264enc':
-        video_format = setup_v4l2h264enc_pipeline(width, height, framerate)
-    elif encoding == 'x264enc':
-        video_format = setup_x264enc_pipeline(width, height, framerate)
-    elif encoding == 'vp8enc':
-        video_format = setup_vp8enc_pipeline(width, height, framerate)
-
-    pipeline = '( {} ! {} )'.format(launch, video_format)
-    mount_path = config_options['endpoint']
-    return (pipeline, mount_path)
+            # a leaky queue drops a buffer every time it overruns
+            element.connect('overrun', lambda _queue, s=drops: setattr(s, 'value', s.value + 1))
+        src_pad = element.get_static_pad('src')
+        if (
+            src_pad is None
+            or isinstance(element, Gst.Bin)
+            or element.get_static_pad('sink') is not None
+        ):
+            continue
+        sample = metrics.registry.sample('picam_buffers_total', mount=mount_path, element=name)
+        src_pad.add_probe(buffer_probe, count_buffers(sample))
+
+    encoder = pipeline.get_by_name('enc0')
+    if encoder is not None:
+        instrument_encoder(encoder, mount_path)
+    payloader = pipeline.get_by_name('pay0')
+    if payloader is not None:
+        instrument_payloader(payloader, mount_path)
+
+    bus = pipeline.get_bus()
+    bus.enable_sync_message_emission()
+    bus.connect('sync-message', on_bus_message, mount_path)
+
+
+BUS_MESSAGE_TYPES = {
+    Gst.MessageType.ERROR: 'error',
+    Gst.MessageType.WARNING: 'warning',
+    Gst.MessageType.QOS: 'qos',
+}
+
+
+def on_bus_message(_bus, message, mount_path):
+    message_type = BUS_MESSAGE_TYPES.get(message.type)
+    if message_type is not None:
+        sample = metrics.registry.sample(
+            'picam_bus_messages_total',
+            mount=mount_path,
+            type=message_type,
+        )
+        sample.value += 1
+
+
+def instrument_encoder(encoder, mount_path):
+    """times buffers from the encoder's sink to its src pad, matched up by their pts"""
+    name = encoder.get_name()
+    buffers = metrics.registry.sample('picam_buffers_total', mount=mount_path, element=name)
+    latency_sum = metrics.registry.sample(
+        'picam_encoder_latency_seconds_sum',
+        mount=mount_path,
+        element=name,
+    )
+    latency_count = metrics.registry.sample(
+        'picam_encoder_latency_seconds_count',
+        mount=mount_path,
+        element=name,
+    )
+    pending = {}
+
+    def on_input(_pad, info):
+        if len(pending) > ENCODER_PENDING_LIMIT:
+            # frames the encoder dropped never come out
+            pending.clear()
+        pending[info.get_buffer().pts] = time.monotonic()
+        return Gst.PadProbeReturn.OK
+
+    def on_output(_pad, info):
+        buffers.value += 1
+        started = pending.pop(info.get_buffer().pts, None)
+        if started is not None:
+            latency_sum.value += time.monotonic() - started
+            latency_count.value += 1
+        return Gst.PadProbeReturn.OK
+
+    encoder.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, on_input)
+    encoder.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_output)
+
+
+def instrument_payloader(payloader, mount_path):
+    """counts keyframes going into the payloader and the rtp packets and bytes coming out"""
+    keyframes = metrics.registry.sample('picam_keyframes_total', mount=mount_path)
+    keyframe_interval = metrics.registry.sample('picam_keyframe_interval_seconds', mount=mount_path)
+    output_bytes = metrics.registry.sample('picam_output_bytes_total', mount=mount_path)
+    output_packets = metrics.registry.sample('picam_output_packets_total', mount=mount_path)
+    buffers = metrics.registry.sample(
+        'picam_buffers_total',
+        mount=mount_path,
+        element=payloader.get_name(),
+    )
+    last_keyframe = [None]
+
+    def on_input(_pad, info):
+        if not info.get_buffer().has_flags(Gst.BufferFlags.DELTA_UNIT):
+            now = time.monotonic()
+            if last_keyframe[0] is not None:
+                keyframe_interval.value = round(now - last_keyframe[0], 3)
+            last_keyframe[0] = now
+            keyframes.value += 1
+        return Gst.PadProbeReturn.OK
+
+    def on_output(_pad, info):
+        if info.type & Gst.PadProbeType.BUFFER_LIST:
+            buffer_list = info.get_buffer_list()
+            output_packets.value += buffer_list.length()
+            buffers.value += buffer_list.length()
+            output_bytes.value += buffer_list.calculate_size()
+        else:
+            output_packets.value += 1
+            buffers.value += 1
+            output_bytes.value += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    payloader.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, on_input)
+    payloader.get_static_pad('src').add_probe(
+        Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+        on_output,
+    )
+
+
+def on_media_configure(_factory, media, mount_path, mount_options):
+    if metrics.registry.enabled:
+        instrument_media(media, mount_path)
+    media_table[mount_path] = media
+    media.connect('unprepared', lambda _media: media_table.pop(mount_path, None))
+    if mount_options.get('bitrate_control'):
+        setup_adaptive_bitrate(media, mount_path, mount_options['bitrate_control'])
+    if mount_options.get('capture'):
+        attach_capture(media, mount_options['capture'])
+    lifecycle = mount_options.get('lifecycle') or {}
+    if lifecycle.get('policy') == 'lazy' and lifecycle.get('idle_timeout'):
+        # prepared is emitted from the media's bus handler, take the hold on the main loop
+        media.connect(
+            'prepared',
+            lambda prepared: GLib.idle_add(hold_lazy_media, mount_path, prepared),
+        )
+
+
+def collect_client_metrics():
+    """
+    Counts the sessions on each mount and asks the udp sinks of each media what they sent to
+    each client, runs on the metrics thread when /metrics is scraped.
+    """
+    samples = []
+    sessions = server.get_session_pool().filter(None, None)
+    for mount_path in list(mount_table.keys()):
+        clients = count_clients(mount_path, sessions)
+        samples.append(('picam_clients', {'mount': mount_path}, clients))
+    for mount_path, media in list(media_table.items()):
+        samples.extend(collect_udp_client_metrics(mount_path, media))
+        samples.extend(collect_retransmission_metrics(mount_path, media))
+    return samples
+
+
+def find_media_elements(media, factory_name):
+    """
+    Returns the elements of a factory in a media's pipeline, the udp sinks and rtpbin are added
+    next to the bin from the launch line rather than in it.
+    """
+    element = media.get_element()
+    pipeline = element.get_parent() or element
+    found = []
+    iterator = pipeline.iterate_recurse()
+    while True:
+        result, child = iterator.next()
+        if result != Gst.IteratorResult.OK:
+            break
+        factory = child.get_factory()
+        if factory is not None and factory.get_name() == factory_name:
+            found.append(child)
+    return found
+
+
+def collect_udp_client_metrics(mount_path, media):
+    samples = []
+    for element in find_media_elements(media, 'multiudpsink'):
+        for client in (element.get_property('clients') or '').split(','):
+            if ':' not in client:
+                continue
+            host, port = client.rsplit(':', 1)
+            stats = element.emit('get-stats', host, int(port))
+            if stats is None:
+                continue
+            labels = {'mount': mount_path, 'client': client, 'sink': element.get_name()}
+            bytes_sent = stats.get_value('bytes-sent')
+            samples.append(('picam_client_bytes_sent_total', labels, bytes_sent))
+            samples.append(
+                ('picam_client_packets_sent_total', labels, stats.get_value('packets-sent'))
+            )
+    return samples
+
+
+def collect_retransmission_metrics(mount_path, media):
+    """the NACKs received and packets resent by each stream of a mount with retransmission"""
+    samples = []
+    for element in find_media_elements(media, 'rtprtxsend'):
+        labels = {'mount': mount_path, 'sender': element.get_name()}
+        samples.append(
+            ('picam_rtx_requests_total', labels, element.get_property('num-rtx-requests'))
+        )
+        samples.append(('picam_rtx_packets_total', labels, element.get_property('num-rtx-packets')))
+    return samples
+
+
+def collect_bitrate_metrics():
+    samples = []
+    for mount_path, stats in bitrate.get_stats().items():
+        samples.append(('picam_adaptive_bitrate', {'mount': mount_path}, stats['bitrate']))
+        for direction in ('increases', 'decreases'):
+            samples.append(
+                (
+                    'picam_adaptive_bitrate_changes_total',
+                    {'mount': mount_path, 'direction': direction[:-1]},
+                    stats[direction],
+                )
+            )
+    return samples
+
+
+def serve_metrics(configs):
+    port = configs.get('rtsp', {}).get('metrics_port', metrics.METRICS_PORT)
+    if not port:
+        return None
+    metrics.registry.add_collector(collect_client_metrics)
+    metrics.registry.add_collector(collect_bitrate_metrics)
+    return metrics.serve(port)
+
+
+def configure_server(configs):
+    """
+    Sizes the server's thread and session pools from the rtsp section of picam.yaml, they
+    can't be changed once the server is attached so changes need a restart.
+
+        rtsp:
+            # threads handling the clients, each with its own main context: 0 keeps every
+            # client on the main loop and -1 gives every client a thread of its own
+            max_threads: 4
+            max_sessions: 64
+            session_cleanup_interval: 10
+    """
+    rtsp_configs = configs.get('rtsp', {})
+    if rtsp_configs.get('max_threads') is not None:
+        server.get_thread_pool().set_max_threads(int(rtsp_configs['max_threads']))
+    if rtsp_configs.get('max_sessions') is not None:
+        server.get_session_pool().set_max_sessions(int(rtsp_configs['max_sessions']))
+    interval = rtsp_configs.get('session_cleanup_interval', SESSION_CLEANUP_INTERVAL)
+    if interval:
+        GLib.timeout_add_seconds(int(interval), cleanup_sessions)
+    logging.info(
+        'rtsp server with %s threads and %s sessions max',
+        server.get_thread_pool().get_max_threads(),
+        server.get_session_pool().get_max_sessions() or 'unlimited',
+    )
+
+
+def cleanup_sessions():
+    removed = server.get_session_pool().cleanup()
+    if removed:
+        logging.info('removed %d expired sessions', removed)
+    return GLib.SOURCE_CONTINUE
+
+
+def attach_server():
+    if server_state['source_id'] is not None:
+        return
+    server_state['source_id'] = server.attach(None)
+    timeline.mark('server', 'attach', port=server.get_service())
+
+
+def prepare_mounts(configs, mount_ready, all_ready, previous_configs=None):
+    """
+    Probes and configures every device concurrently on a thread pool.
+
+    Args:
+        configs: the loaded picam.yaml
+        mount_ready: called on the main loop with (device, pipeline, mount_path, mount_options)
+            for each mount of a configured device as soon as the device is ready
+        all_ready: called on the main loop with the list of devices which failed once every
+            device has been set up
+        previous_configs: the configs the running mounts were created from when reloading
+    """
+    startup_workers = configs.get('rtsp', {}).get('startup_workers', 4)
+    executor = ThreadPoolExecutor(max_workers=startup_workers, thread_name_prefix='startup')
+    pending = {}
+    failed = []
+
+    def job_done(future):
+        # runs on the main loop so factories are only ever touched from one thread
+        device = pending.pop(future)
+        try:
+            device_mounts = future.result()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception('failed to set up %s', device)
+            failed.append(device)
+        else:
+            for pipeline, mount_path, mount_options in device_mounts:
+                mount_ready(device, pipeline, mount_path, mount_options)
+        if not pending:
+            executor.shutdown(wait=False)
+            all_ready(failed)
+        return False
+
+    # the cameras streaming a mic in the same session need the sound cards
+    with timeline.stage('audio', 'probe'):
+        audio_devices = audio.find_audio_devices()
+
+    # read on the main loop, the jobs mustn't touch the mount table
+    mounted_encodings = {
+        mounted['device']: mounted['options'].get('device_encoding')
+        for mounted in mount_table.values()
+    }
+
+    # probe and configure each camera concurrently
+    with timeline.stage('video', 'list'):
+        usb_devices = sysfs.resolve_video_devices()
+        video_devices = video.list_video_devices()
+    for video_device, description in video_devices:
+        future = executor.submit(
+            setup_video_mount,
+            video_device,
+            description,
+            usb_devices,
+            configs,
+            previous_configs,
+            audio_devices,
+            mounted_encodings,
+        )
+        pending[future] = video_device
+
+    # creates the audio streams
+    combined = combined_audio_serials(configs)
+    for serial, device_info in audio_devices.items():
+        future = executor.submit(
+            setup_audio_mount,
+            serial,
+            device_info,
+            configs.get('audio_devices') or {},
+            combined,
+        )
+        pending[future] = 'hw:{}'.format(device_info['alsa_idx'])
+
+    for future in list(pending.keys()):
+        future.add_done_callback(lambda f: GLib.idle_add(job_done, f))
+    if not pending:
+        executor.shutdown(wait=False)
+        all_ready(failed)
+
+
+def apply_mount_changes(desired, failed):
+    """
+    Brings the mount table in line with the desired mounts, only touching the factories whose
+    pipeline or options changed so clients of the other streams stay connected.
+
+    Args:
+        desired: mount path -> (device, pipeline, mount_options) for every configured device
+        failed: devices which couldn't be set up, their running mounts are left alone
+    """
+    changes = {'added': [], 'removed': [], 'replaced': [], 'unchanged': []}
+    for mount_path in list(mount_table.keys()):
+        if mount_path in desired or mount_table[mount_path]['device'] in failed:
+            continue
+        remove_mount(mount_path)
+        changes['removed'].append(mount_path)
+    for mount_path, (device, pipeline, mount_options) in desired.items():
+        mounted = mount_table.get(mount_path)
+        if mounted is None:
+            add_mount(device, pipeline, mount_path, mount_options)
+            changes['added'].append(mount_path)
+        elif mounted['pipeline'] != pipeline or mounted['options'] != mount_options:
+            remove_mount(mount_path)
+            add_mount(device, pipeline, mount_path, mount_options)
+            changes['replaced'].append(mount_path)
+        else:
+            changes['unchanged'].append(mount_path)
+    return changes
+
+
+def reload_mounts():
+    """
+    Reloads picam.yaml and updates only the mounts whose devices or configs changed.
+    A reload requested while one is running is started again once it finishes.
+    """
+    global timeline  # pylint: disable=global-statement
+    reload_state['timeout_id'] = None
+    if reload_state['running']:
+        reload_state['requested'] = True
+        return False
+    try:
+        configs = load_configs()
+    except OSError as e:
+        logging.warning('unable to read %s, keeping the running mounts: %s', config_path(), e)
+        return False
+    if not configs:
+        logging.warning('%s is empty or invalid, keeping the running mounts', config_path())
+        return False
+
+    reload_state['running'] = True
+    started = time.monotonic()
+    timeline = startup_timeline.StartupTimeline('reload')
+    desired = {}
+
+    def mount_ready(device, pipeline, mount_path, mount_options):
+        desired[mount_path] = (device, pipeline, mount_options)
+
+    def all_ready(failed):
+        changes = apply_mount_changes(desired, failed)
+        reload_state['configs'] = configs
+        changes['failed'] = failed
+        changes['duration'] = round(time.monotonic() - started, 3)
+        logging.info('reloaded mounts %s', json.dumps(changes))
+        timeline.report()
+        finish_reload()
+
+    prepare_mounts(configs, mount_ready, all_ready, previous_configs=reload_state['configs'])
+    return False
+
+
+def finish_reload():
+    reload_state['running'] = False
+    if reload_state['requested']:
+        reload_state['requested'] = False
+        reload_mounts()
+
+
+def schedule_reload():
+    if reload_state['timeout_id'] is not None:
+        GLib.source_remove(reload_state['timeout_id'])
+    reload_state['timeout_id'] = GLib.timeout_add(RELOAD_DELAY_MS, reload_mounts)
+
+
+def on_config_changed(_monitor, _file, _other_file, event_type):
+    if event_type in (
+        Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+        Gio.FileMonitorEvent.CREATED,
+        Gio.FileMonitorEvent.MOVED_IN,
+        Gio.FileMonitorEvent.RENAMED,
+    ):
+        logging.info('%s changed, reloading', config_path())
+        schedule_reload()
+
+
+def on_sighup():
+    logging.info('received SIGHUP, reloading')
+    schedule_reload()
+    return True
+
+
+def watch_configs(configs):
+    """reloads on SIGHUP (systemctl reload picam) and whenever picam.yaml is written"""
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGHUP, on_sighup)
+    if not configs.get('rtsp', {}).get('watch_config', True):
+        return None
+    monitor = Gio.File.new_for_path(config_path()).monitor_file(Gio.FileMonitorFlags.NONE, None)
+    monitor.connect('changed', on_config_changed)
+    return monitor
 
 
 def main():
     configs = load_configs()
+    reload_state['configs'] = configs
 
-    # create the camera streams
-    for video_device, device_info in video.find_video_devices().items():
-        pipeline = None
-        mount_path = None
-        logging.info(device_info['description'])
-        if 'bcm2835-v4l2' in device_info['description']:
-            pipeline, mount_path = setup_pi_camera_device(video_device)
-        elif 'Cam Link' in device_info['description']:
-            serial = 'CAMLINK'
-            config_options = configs['video_devices'][serial]
-            pipeline, mount_path = setup_uvc_device(serial, video_device, config_options)
-        elif (
-            'Kiyo Pro Ultra' in device_info['description']
-            and 'KIYOPROULTRA' in configs['video_devices'].keys()
-        ):
-            serial = 'KIYOPROULTRA'
-            config_options = configs['video_devices'][serial]
-            pipeline, mount_path = setup_uvc_device(serial, video_device, config_options)
-        elif (
-            'Kiyo Pro' in device_info['description']
-            and 'KIYOPRO' in configs['video_devices'].keys()
-        ):
-            serial = 'KIYOPRO'
-            config_options = configs['video_devices'][serial]
-            pipeline, mount_path = setup_uvc_device(serial, video_device, config_options)
-        elif device_info['serial'] in configs['video_devices'].keys():
-            serial = device_info['serial']
-            config_options = configs['video_devices'][serial]
-            pipeline, mount_path = setup_uvc_device(serial, video_device, config_options)
-        if pipeline:
-            logging.info(pipeline)
-            factory = GstRtspServer.RTSPMediaFactory()
-            factory.set_launch(pipeline)
-            factory.set_shared(True)
-            mounts.add_factory(mount_path, factory)
+    def all_ready(_failed):
+        attach_server()
+        timeline.report()
+        # pick up any config changes made while starting up
+        finish_reload()
+
+    reload_state['running'] = True
+    configure_server(configs)
+    serve_metrics(configs)
+    server.connect('client-connected', on_client_connected)
+    GLib.timeout_add(IDLE_CHECK_INTERVAL_MS, check_idle_media)
+    prepare_mounts(configs, add_mount, all_ready)
+    # keep a reference to the monitor for as long as the main loop runs
+    monitor = watch_configs(configs)  # pylint: disable=unused-variable
 
-    # creates the audio streams
-    audio_configs = configs['audio_devices']
-    for serial, device_info in audio.find_audio_devices().items():
-        audio_rate = 32000
-        audio_path = None
-        alsa_idx = device_info['alsa_idx']
-        if serial in list(audio_configs.keys()):
-            audio_path = audio_configs[serial]['endpoint']
-            audio_rate = audio_configs[serial].get('audio_rate', audio_rate)
-        if audio_path:
-            launch = (
-                'alsasrc device=hw:{alsa_idx} do-timestamp=1 '
-                '! audio/x-raw,rate={audio_rate} '
-                '! queue ! voaacenc bitrate=160000 '
-                '! rtpmp4apay name=pay0 pt=96'
-            ).format(
-                alsa_idx=alsa_idx,
-                audio_rate=audio_rate,
-            )
-            pipeline = '( {} )'.format(launch)
-            logging.info(pipeline)
-            factory = GstRtspServer.RTSPMediaFactory()
-            factory.set_launch(pipeline)
-            factory.set_shared(True)
-            mounts.add_factory(audio_path, factory)
-
-    server.attach(None)
     mainloop.run()
 
 
@@ -0,0 +1,68 @@
+# pylint: disable=protected-access
+
+import unittest
+
+try:
+    import gi
+
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst
+except (ImportError, ValueError):
+    Gst = None
+
+
+@unittest.skipIf(Gst is None, 'needs GStreamer and PyGObject')
+class OnSampleTest(unittest.TestCase):
+    def setUp(self):
+        # pylint: disable=import-outside-toplevel
+        from picam import capture
+
+        Gst.init(None)
+        self.capture = capture.SharedCapture('test', '')
+        self.source = Gst.parse_launch(
+            'appsrc name=in format=time caps=video/x-raw,format=GRAY8,width=4,height=2 '
+            '! appsink name=sink_main sync=false'
+        )
+        self.rendition = Gst.parse_launch(
+            'appsrc name={} is-live=true format=time ! appsink name=out sync=false'.format(
+                capture.APPSRC_NAME
+            )
+        )
+        self.rendition.set_state(Gst.State.PLAYING)
+        self.source.set_state(Gst.State.PLAYING)
+
+    def tearDown(self):
+        self.source.set_state(Gst.State.NULL)
+        self.rendition.set_state(Gst.State.NULL)
+
+    def _push(self, data, pts):
+        buffer = Gst.Buffer.new_wrapped(data)
+        buffer.pts = pts
+        self.source.get_by_name('in').emit('push-buffer', buffer)
+        self.source.get_state(Gst.SECOND)
+        return buffer
+
+    def test_forwards_to_appsrc(self):
+        appsrc = self.rendition.get_by_name('capsrc')
+        self.capture._consumers['main'] = appsrc
+        pushed = self._push(b'\x01' * 8, 0)
+
+        result = self.capture._on_sample(self.source.get_by_name('sink_main'), 'main')
+
+        self.assertEqual(result, Gst.FlowReturn.OK)
+        sample = self.rendition.get_by_name('out').emit('try-pull-sample', Gst.SECOND)
+        self.assertIsNotNone(sample)
+        buffer = sample.get_buffer()
+        self.assertEqual(buffer.extract_dup(0, buffer.get_size()), b'\x01' * 8)
+        self.assertEqual(sample.get_caps().get_structure(0).get_value('width'), 4)
+        # the capture's buffer keeps its own timestamp
+        self.assertEqual(pushed.pts, 0)
+
+    def test_without_consumer(self):
+        self._push(b'\x02' * 8, 0)
+        result = self.capture._on_sample(self.source.get_by_name('sink_main'), 'main')
+        self.assertEqual(result, Gst.FlowReturn.OK)
+
+
+if __name__ == '__main__':
+    unittest.main()
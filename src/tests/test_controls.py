@@ -0,0 +1,69 @@
+import unittest
+
+from picam import controls, v4l2
+
+
+def _ctrl(ctrl_id, value, flags=0):
+    return {'id': ctrl_id, 'value': value, 'flags': flags}
+
+
+def _snapshot():
+    return {
+        'brightness': _ctrl(1, 128),
+        'exposure_auto': _ctrl(2, 3),
+        'exposure_absolute': _ctrl(3, 250),
+        'white_balance_temperature_auto': _ctrl(4, 0),
+        'white_balance_temperature': _ctrl(5, 4000),
+        'focus_auto': _ctrl(6, 1),
+        'focus_absolute': _ctrl(7, 0),
+        'exposure_dynamic_framerate': _ctrl(8, 0, v4l2.V4L2_CTRL_FLAG_READ_ONLY),
+    }
+
+
+def _names(stage):
+    return [(ctrl['id'], value) for ctrl, value in stage]
+
+
+class BuildPlanTest(unittest.TestCase):
+    def test_build_plan(self):
+        cases = [
+            # (settings, auto stage, values stage, skipped, rejected, unknown)
+            ({'brightness': 100}, [], [(1, 100)], [], [], []),
+            ({'brightness': '100'}, [], [(1, 100)], [], [], []),
+            # exposure_auto is in aperture priority so the absolute would be ignored
+            ({'exposure_absolute': 150}, [], [], ['exposure_absolute'], [], []),
+            # turning it to manual in the same write lets the absolute through, auto first
+            (
+                {'exposure_absolute': 150, 'exposure_auto': 1},
+                [(2, 1)],
+                [(3, 150)],
+                [],
+                [],
+                [],
+            ),
+            ({'white_balance_temperature': 4400}, [], [(5, 4400)], [], [], []),
+            (
+                {'white_balance_temperature': 4400, 'white_balance_temperature_auto': 1},
+                [(4, 1)],
+                [],
+                ['white_balance_temperature'],
+                [],
+                [],
+            ),
+            ({'focus_absolute': 10, 'focus_auto': '0'}, [(6, 0)], [(7, 10)], [], [], []),
+            ({'exposure_dynamic_framerate': 1}, [], [], [], ['exposure_dynamic_framerate'], []),
+            ({'brightness': 'bright'}, [], [], [], ['brightness'], []),
+            ({'zoom_absolute': 100}, [], [], [], [], ['zoom_absolute']),
+        ]
+        for settings, auto, values, skipped, rejected, unknown in cases:
+            with self.subTest(settings=settings):
+                plan = controls.build_plan(_snapshot(), settings)
+                self.assertEqual(_names(plan['auto']), auto)
+                self.assertEqual(_names(plan['values']), values)
+                self.assertEqual(list(plan['skipped']), skipped)
+                self.assertEqual(list(plan['rejected']), rejected)
+                self.assertEqual(plan['unknown'], unknown)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# pylint: disable=protected-access
+
+import unittest
+
+from picam import encoders
+
+
+class CoerceTest(unittest.TestCase):
+    def test_coerce(self):
+        cases = [
+            # (value, default, expected)
+            ('false', False, False),
+            ('False', False, False),
+            ('no', False, False),
+            ('0', False, False),
+            ('true', False, True),
+            ('on', False, True),
+            (True, False, True),
+            (0, True, False),
+            ('4000', 5600, 4000),
+            (4000.0, 5600, 4000),
+            ('1.5', 2.0, 1.5),
+            (3, 2.0, 3.0),
+            ('2', None, 2),
+            ('0.5', None, 0.5),
+            (1500, None, 1500),
+            ('1280x720', None, '1280x720'),
+            ('superfast', 'superfast', 'superfast'),
+            (None, 5600, None),
+        ]
+        for value, default, expected in cases:
+            with self.subTest(value=value, default=default):
+                result = encoders._coerce('param', value, default)
+                self.assertEqual(result, expected)
+                self.assertIs(type(result), type(expected))
+
+    def test_coerce_invalid(self):
+        cases = [
+            ('maybe', False),
+            ('fast', 5600),
+            ([1], 2.0),
+        ]
+        for value, default in cases:
+            with self.subTest(value=value, default=default):
+                with self.assertRaises(ValueError):
+                    encoders._coerce('param', value, default)
+
+
+class GetParametersTest(unittest.TestCase):
+    def test_overrides(self):
+        cases = [
+            # (encoding, overrides, expected subset of the parameters)
+            ('x264enc', None, {'bitrate': 5600, 'adaptive_bitrate': False}),
+            ('x264enc', {'bitrate': '4000'}, {'bitrate': 4000}),
+            ('x264enc', {'adaptive_bitrate': 'false'}, {'adaptive_bitrate': False}),
+            ('x264enc', {'adaptive_bitrate': 'yes'}, {'adaptive_bitrate': True}),
+            ('x264enc', {'output_size': '640x360'}, {'output_size': '640x360'}),
+            ('x264enc', {'output_size': '640'}, {'output_size': None}),
+            ('x264enc', {'leaky': 'sideways'}, {'leaky': 'downstream'}),
+            ('x264enc', {'bitrate': 'fast'}, {'bitrate': 5600}),
+            ('x264enc', {'unknown': 1}, {'bitrate': 5600}),
+            ('v4l2h264enc', {'gop': '2'}, {'gop': 2}),
+            ('v4l2h264enc', {'zero_copy': 'false'}, {'zero_copy': False}),
+            ('v4l2h264enc', {'zero_copy': 'true'}, {'zero_copy': True}),
+        ]
+        for encoding, overrides, expected in cases:
+            with self.subTest(encoding=encoding, overrides=overrides):
+                params = encoders.get_parameters(encoding, overrides)
+                self.assertEqual({name: params[name] for name in expected}, expected)
+                self.assertNotIn('unknown', params)
+
+    def test_unknown_encoding(self):
+        with self.assertRaises(KeyError):
+            encoders.get_parameters('h265')
+
+
+class KeyframeIntervalTest(unittest.TestCase):
+    def test_keyframe_interval(self):
+        cases = [
+            # (framerate, gop seconds, frames)
+            ('30', 2.0, 60),
+            ('60/1', 2.0, 120),
+            ('60000/1001', 2.0, 120),
+            ('30000/1001', 1, 30),
+            ('30', 0.01, 1),
+        ]
+        for framerate, gop, expected in cases:
+            with self.subTest(framerate=framerate, gop=gop):
+                self.assertEqual(encoders._keyframe_interval(framerate, gop), expected)
+
+    def test_quoted_gop_in_pipeline(self):
+        pipeline = encoders.build_pipeline('v4l2h264enc', 1280, 720, '30/1', {'gop': '2'})
+        self.assertIn('h264_i_frame_period=60', pipeline)
+
+
+class BuildHardwareInputTest(unittest.TestCase):
+    def test_build_hardware_input(self):
+        cases = [
+            # (overrides, expected conversion, expected io options)
+            (
+                {},
+                '! videoscale ! video/x-raw,width=1280,height=720 '
+                '! videoconvert ! video/x-raw,format=I420 ',
+                '',
+            ),
+            (
+                {'output_size': None},
+                '! videoconvert ! video/x-raw,format=I420 ',
+                '',
+            ),
+            (
+                {'zero_copy': True},
+                '! v4l2convert output-io-mode=dmabuf-import capture-io-mode=dmabuf '
+                '! video/x-raw,format=I420,width=1280,height=720 ',
+                'output-io-mode=dmabuf-import ',
+            ),
+        ]
+        for overrides, conversion, io_mode in cases:
+            with self.subTest(overrides=overrides):
+                params = encoders.get_parameters('v4l2h264enc', overrides)
+                self.assertEqual(encoders.build_hardware_input(params), (conversion, io_mode))
+
+
+if __name__ == '__main__':
+    unittest.main()
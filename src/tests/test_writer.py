@@ -0,0 +1,56 @@
+import threading
+import unittest
+
+from picam.writer import CoalescingWriter
+
+
+class FlakyWriter(CoalescingWriter):
+    """raises the queued errors in turn, then writes"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.written = []
+        self.failures = []
+        self.failed = threading.Event()
+        self.done = threading.Event()
+        super().__init__('test', min_interval=0)
+
+    def write(self, settings):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.written.append(settings)
+        self.done.set()
+        return {}
+
+    def on_error(self, error):
+        self.failures.append(error)
+        self.failed.set()
+
+
+class ApplyTest(unittest.TestCase):
+    def test_worker_survives_errors(self):
+        cases = [
+            OSError(19, 'No such device'),
+            ValueError('invalid value'),
+            KeyError('gain'),
+        ]
+        for error in cases:
+            with self.subTest(error=error):
+                writer = FlakyWriter([error])
+                try:
+                    writer.submit({'gain': 1})
+                    self.assertTrue(writer.failed.wait(1))
+                    self.assertEqual(writer.status()['error'], str(error))
+                    writer.submit({'gain': 2})
+                    self.assertTrue(writer.done.wait(1))
+                    # waits for the batch to finish applying
+                    writer.close()
+                    self.assertEqual(writer.failures, [error])
+                    self.assertEqual(writer.written, [{'gain': 2}])
+                    self.assertIsNone(writer.status()['error'])
+                finally:
+                    writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
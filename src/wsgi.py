@@ -10,7 +10,9 @@ from picam import (
     admin,
     audio,
     device,
+    events,
     index,
+    inventory,
     video,
     wifi,
 )
@@ -40,6 +42,7 @@ class PicamConfig:
                 self.video_devices = settings['video_devices']
                 self.audio_devices = settings['audio_devices']
                 self.pi = settings.get('pi', {})
+                self.rtsp = settings.get('rtsp', {})
             except Exception:  # pylint: disable=broad-exception-caught
                 logging.exception('failed to parse settings file')
 
@@ -48,6 +51,7 @@ class PicamConfig:
             'video_devices': self.video_devices,
             'audio_devices': self.audio_devices,
             'pi': self.pi,
+            'rtsp': self.rtsp,
         }
         script_dir = os.path.dirname(__file__)
         with open(f'{script_dir}/picam.yaml', 'w', encoding='UTF-8') as settings_file:
@@ -60,12 +64,18 @@ app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.secret_key = 'picamsecret'
 app.jinja_env.filters['intersect'] = intersect
 app.picam_config = PicamConfig()
+app.device_inventory = inventory.DeviceInventory()
+app.dashboard_publisher = events.DashboardPublisher(app, audio.get_recording_levels)
 
 # url paths
 app.add_url_rule(
     '/',
     view_func=index.IndexHandler.as_view('index'),
 )
+app.add_url_rule(
+    '/api/events',
+    view_func=index.DashboardEventsHandler.as_view('api-events'),
+)
 app.add_url_rule(
     '/admin',
     view_func=admin.AdminHandler.as_view('admin'),
@@ -104,7 +114,12 @@ app.add_url_rule(
 app.add_url_rule(
     '/api/video-device/<serial>',
     view_func=video.VideoDeviceApiHandler.as_view('api-video-device'),
-    methods=['POST'],
+    methods=['GET', 'POST'],
+)
+app.add_url_rule(
+    '/api/devices/refresh',
+    view_func=device.DevicesRefreshApiHandler.as_view('api-devices-refresh'),
+    methods=['GET', 'POST'],
 )
 app.add_url_rule(
     '/scaling-governor',